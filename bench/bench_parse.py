@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""页面解析微基准测试
+
+对比旧的解析方式(每个辅助函数各自etree.HTML解析一次，逐元素计算字符串XPath)
+与Page模型(每个响应只解析一次，使用预编译的etree.XPath)在样例页面上的耗时。
+
+在仓库根目录下运行:
+    $ python3 bench/bench_parse.py [-n 次数]
+"""
+
+import argparse
+import os
+import re
+import sys
+import timeit
+
+from lxml import etree
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from txffp import Page  # noqa: E402
+
+
+SAMPLES_DIR = os.path.join(BENCH_DIR, "samples")
+
+
+def load(name):
+    with open(os.path.join(SAMPLES_DIR, name + ".html"), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+# 旧的解析方式，与重构前APIHandler中的私有解析函数保持一致
+
+def legacy_has_next_page(xphtml):
+    has_more = xphtml.xpath('//label[@id="taiji_search_hasMore"]/text()')
+    return bool(has_more) and has_more[0] == "true"
+
+
+def legacy_query_apply(html):
+    inv_info = []
+    xphtml = etree.HTML(html)
+    for inv in xphtml.xpath("//table[@class='table_wdfp']"):
+        inv_info.append({
+            "datetime": inv.xpath("./tr[1]/td/table/tr[1]/th[1]/text()")[0][7:],
+            "type": inv.xpath("./tr[1]/td/table/tr[1]/th[3]/text()")[0],
+            "count": inv.xpath("./tr[2]/td/table/tr/td[3]/span/text()")[0],
+            "amount": re.match(
+                r"[^\d\.]*([\d\.]*)",
+                inv.xpath("./tr[1]/td/table/tr[1]/th[2]/span/text()")[0]).groups()[0],
+            "dwurl": os.path.join(
+                "https://pss.txffp.com/",
+                inv.xpath("./tr[1]/td/table/tr/th[4]/a[2]")[0].get("href")[1:],
+            ),
+        })
+    return inv_info, legacy_has_next_page(etree.HTML(html))
+
+
+def legacy_query_card(html):
+    xphtml = etree.HTML(html)
+    cardid_list = []
+    for card in xphtml.xpath("//dl[@class='etc_card_dl']/div/a"):
+        cardid_list.append((card.get("href")[40:-8], card.xpath("./dd[2]/text()")[0].strip()[-7:]))
+    return cardid_list, legacy_has_next_page(etree.HTML(html))
+
+
+def legacy_card_list(html):
+    xphtml = etree.HTML(html)
+    cardid_list = []
+    for card in xphtml.xpath("//dl[@class='etc_card_dl']/div/a"):
+        id = re.match(r"[^(]*\('([\w]*)'\)", card.get("onclick")).groups()[0]
+        car_num = re.match("[^:]*：(.*)", card.xpath("dd[2]/text()")[0]).groups()[0]
+        cardid_list.append((id, car_num))
+    return cardid_list, legacy_has_next_page(etree.HTML(html))
+
+
+def legacy_inv_manage(html):
+    xphtml = etree.HTML(html)
+    tradeid_list = []
+    for res in xphtml.xpath('//tr/td[@class="tab_tr_td10"]/input[@class="check_one"]'):
+        id = res.get("value")
+        if not id:
+            continue
+        id = re.match(r"[^_]*", id).group()
+        if id:
+            tradeid_list.append(id)
+    return tradeid_list, legacy_has_next_page(xphtml)
+
+
+def legacy_inv_apply(html):
+    xphtml = etree.HTML(html)
+    tmp = [
+        xphtml.xpath("//form[@id='checkForm']/input[@id='applyId']"),
+        xphtml.xpath("//form[@id='checkForm']/input[@id='id']"),
+        xphtml.xpath("//form[@id='checkForm']/input[@id='userType']"),
+    ]
+    return [i[0].get("value") if i else "" for i in tmp]
+
+
+# Page模型
+
+def page_query_apply(html):
+    page = Page(html)
+    return page.invoices(), page.has_more()
+
+
+def page_query_card(html):
+    page = Page(html)
+    return page.query_cards(), page.has_more()
+
+
+def page_card_list(html):
+    page = Page(html)
+    return page.cards(), page.has_more()
+
+
+def page_inv_manage(html):
+    page = Page(html)
+    return page.trade_ids(), page.has_more()
+
+
+def page_inv_apply(html):
+    return Page(html).apply_info()
+
+
+CASES = [
+    ("query_apply", legacy_query_apply, page_query_apply),
+    ("query_card", legacy_query_card, page_query_card),
+    ("card_list", legacy_card_list, page_card_list),
+    ("inv_manage", legacy_inv_manage, page_inv_manage),
+    ("inv_apply", legacy_inv_apply, page_inv_apply),
+]
+
+
+def best_of(func, html, number, repeat=5):
+    """返回单次调用的最短耗时(微秒)"""
+    return min(timeit.repeat(lambda: func(html), number=number, repeat=repeat)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="页面解析微基准测试")
+    parser.add_argument("-n", "--number", type=int, default=2000, help="每轮调用次数(默认2000)")
+    options = parser.parse_args()
+
+    print("%-12s %12s %12s %8s" % ("page", "legacy(us)", "page(us)", "speedup"))
+    for name, legacy, current in CASES:
+        html = load(name)
+        legacy_us = best_of(legacy, html, options.number)
+        current_us = best_of(current, html, options.number)
+        print("%-12s %12.1f %12.1f %7.2fx" % (name, legacy_us, current_us, legacy_us / current_us))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""端到端吞吐量基准测试
+
+在子进程中启动bench/mock_server.py，然后使用APIHandler对其执行inv_download_all
+和/或submit_apply_all，统计请求数/秒、字节数/秒、请求延迟的p50/p99以及总耗时。
+
+在仓库根目录下运行:
+    $ python3 bench/bench_throughput.py --scenario all --cards 100 --latency 30 --workers 8
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_server import add_site_arguments  # noqa: E402
+from txffp import HEADERS, APIHandler, JobLedger, RateController  # noqa: E402
+
+
+class RequestRecorder(object):
+    """通过requests的response钩子记录每个请求的延迟和响应大小"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+
+    def hook(self, response, *args, **kwargs):
+        length = response.headers.get("Content-Length")
+        with self.lock:
+            self.latencies.append(response.elapsed.total_seconds())
+            self.bytes += int(length) if length and length.isdigit() else 0
+            if response.status_code >= 400:
+                self.errors += 1
+
+    def reset(self):
+        with self.lock:
+            self.latencies = []
+            self.bytes = 0
+            self.errors = 0
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(int(round(pct / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def start_mock_server(options):
+    """启动模拟服务器子进程，返回(进程, 站点地址)"""
+    args = [sys.executable, os.path.join(BENCH_DIR, "mock_server.py"), "--port", "0"]
+    for name in ("cards", "invoices", "trades", "page_size", "latency", "jitter", "error_rate", "zip_size"):
+        args += ["--" + name.replace("_", "-"), str(getattr(options, name))]
+    if options.total_pages:
+        args.append("--total-pages")
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, universal_newlines=True)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.kill()
+        sys.exit("模拟服务器启动失败")
+    return process, url
+
+
+def run_scenario(name, func, recorder):
+    recorder.reset()
+    start = time.perf_counter()
+    func()
+    wall = time.perf_counter() - start
+    latencies = list(recorder.latencies)
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": recorder.errors,
+        "bytes": recorder.bytes,
+        "wall_seconds": round(wall, 3),
+        "requests_per_second": round(len(latencies) / wall, 1) if wall else 0.0,
+        "bytes_per_second": round(recorder.bytes / wall, 1) if wall else 0.0,
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端吞吐量基准测试")
+    parser.add_argument("--url", help="使用已启动的模拟服务器地址，不指定时自动启动")
+    parser.add_argument("--scenario", choices=("download", "invoice", "all"), default="all")
+    parser.add_argument("--month", default="201804")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--rps", type=float, default=0,
+                        help="全局每秒请求数上限，速率在上限内自适应调整，0表示不限制(默认0)")
+    parser.add_argument("--json", action="store_true", help="以JSON格式输出结果")
+    add_site_arguments(parser)
+    options = parser.parse_args()
+
+    process = None
+    url = options.url
+    if url is None:
+        process, url = start_mock_server(options)
+
+    logger = logging.getLogger("bench")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    recorder = RequestRecorder()
+    save_dir = tempfile.mkdtemp(prefix="txffp_bench_")
+    ledger = JobLedger(os.path.join(save_dir, "ledger.db"))
+    handler = APIHandler(
+        "", HEADERS,
+        site_url=url,
+        logger=logger,
+        pool_size=max(10, options.workers * 2),
+        rate_limiter=RateController(max_rate=options.rps),
+        workers=options.workers,
+        ledger=ledger,
+    )
+    handler.session.hooks["response"].append(recorder.hook)
+
+    results = []
+    try:
+        if options.scenario in ("download", "all"):
+            results.append(run_scenario(
+                "download", lambda: handler.inv_download_all(options.month, save_dir), recorder))
+        if options.scenario in ("invoice", "all"):
+            results.append(run_scenario(
+                "invoice", lambda: handler.submit_apply_all(options.month), recorder))
+    finally:
+        ledger.close()
+        shutil.rmtree(save_dir, ignore_errors=True)
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    transport = handler.transport_stats()
+    if options.json:
+        print(json.dumps({"results": results, "transport": transport}, ensure_ascii=False, indent=2))
+        return
+
+    print("%-10s %8s %7s %10s %10s %12s %9s %9s" % (
+        "scenario", "requests", "errors", "wall(s)", "req/s", "bytes/s", "p50(ms)", "p99(ms)"))
+    for r in results:
+        print("%-10s %8s %7s %10.2f %10.1f %12.0f %9.2f %9.2f" % (
+            r["scenario"], r["requests"], r["errors"], r["wall_seconds"], r["requests_per_second"],
+            r["bytes_per_second"], r["latency_p50_ms"], r["latency_p99_ms"]))
+    print("transport: %s" % transport)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""本地模拟的pss.txffp.com服务器
+
+提供APIHandler.APIS中的card_list、query_card、query_apply、inv_manage、inv_apply、
+inv_subapply接口以及发票zip文件的下载，页面结构与站点保持一致，用于离线压测。
+卡片数量、分页大小、延迟、错误率和zip文件大小均可配置。
+
+    $ python3 bench/mock_server.py --port 8800 --cards 200 --latency 50
+"""
+
+import argparse
+import hashlib
+import io
+import random
+import re
+import threading
+import time
+import zipfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def zip_entry(name):
+    """固定修改时间的zip条目，writestr默认使用当前时间会导致每次生成的内容不同"""
+    return zipfile.ZipInfo(name, date_time=(2018, 1, 1, 0, 0, 0))
+
+
+class MockSite(object):
+    """模拟站点的数据与状态，所有内容由卡片序号和月份确定性地生成"""
+
+    def __init__(self, cards=50, invoices_per_card=8, trades_per_card=20, page_size=6,
+                 latency=0.0, jitter=0.0, error_rate=0.0, zip_size=32 * 1024, total_pages=False,
+                 require_cookie=False, expire_after=0, seed=0):
+        self.cards = cards
+        self.invoices_per_card = invoices_per_card
+        self.trades_per_card = trades_per_card
+        self.page_size = page_size
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.zip_size = zip_size
+        self.total_pages = total_pages
+        self.require_cookie = require_cookie
+        self.expire_after = expire_after
+        self.random = random.Random(seed)
+        self.payload = b""
+        if zip_size:
+            self.payload = random.Random(seed).getrandbits(zip_size * 8).to_bytes(zip_size, "little")
+
+        self.lock = threading.Lock()
+        self.submitted = set()
+        self.applies = {}
+        self.apply_seq = 0
+        self.stats = {"requests": 0, "errors": 0, "bytes": 0}
+        self.sessions = {}
+
+    def expired(self, cookie):
+        """每个cookie(不含站点下发的JSESSIONID)只能使用expire_after次，之后视为失效"""
+        if not self.expire_after:
+            return False
+        key = "; ".join(sorted(
+            part.strip() for part in (cookie or "").split(";")
+            if part.strip() and not part.strip().startswith("JSESSIONID=")))
+        with self.lock:
+            count = self.sessions[key] = self.sessions.get(key, 0) + 1
+        return count > self.expire_after
+
+    def card_id(self, n):
+        return "4401%012d" % n
+
+    def plate(self, n):
+        return "粤A%05d" % n
+
+    def paged(self, items, page_no, page_size=None):
+        """返回(本页内容, 是否有下一页, 总页数)"""
+        page_size = page_size or self.page_size
+        start = (page_no - 1) * page_size
+        total = max(-(-len(items) // page_size), 1)
+        return items[start:start + page_size], start + page_size < len(items), total
+
+    def paging_labels(self, has_more, total):
+        labels = '<label id="taiji_search_hasMore">%s</label>' % ("true" if has_more else "false")
+        if self.total_pages:
+            labels += '<label id="taiji_search_totalPage">%s</label>' % total
+        return labels
+
+    def query_card(self, form):
+        cards, has_more, total = self.paged(list(range(self.cards)), int(form.get("pageNo") or 1))
+        body = "".join(
+            '<dl class="etc_card_dl"><div><a href="/pss/app/login/invoice/query/queryApply/%s/COMPANY">'
+            '<dd><img src="card.png"></dd><dd>ETC卡 %s</dd></a></div></dl>' % (self.card_id(n), self.plate(n))
+            for n in cards)
+        return body + self.paging_labels(has_more, total)
+
+    def card_list(self, form):
+        cards, has_more, total = self.paged(list(range(self.cards)), int(form.get("pageNo") or 1))
+        body = "".join(
+            '<dl class="etc_card_dl"><div><a onclick="toApply(\'%s\')">'
+            '<dd><img src="card.png"></dd><dd>车牌号：%s</dd></a></div></dl>' % (self.card_id(n), self.plate(n))
+            for n in cards)
+        return body + self.paging_labels(has_more, total)
+
+    def query_apply(self, form):
+        card_id = form.get("cardId", "")
+        month = form.get("month", "201801")
+        page_size = int(form.get("pageSize") or self.page_size)
+        invoices, has_more, total = self.paged(
+            list(range(self.invoices_per_card)), int(form.get("pageNo") or 1), page_size)
+        rows = []
+        for i in invoices:
+            day = i % 28 + 1
+            rows.append(
+                '<table class="table_wdfp">'
+                '<tr><td><table><tr><th>开票申请时间：%s-%s-%02d %02d:%02d:00</th><th>发票金额：<span>￥%d.%02d</span></th>'
+                '<th>通行费电子发票</th><th><a href="#">查看</a>'
+                '<a href="/pss/app/login/invoice/query/download/%s_%s_%d">下载</a></th></tr></table></td></tr>'
+                '<tr><td><table><tr><td>购方</td><td>已开票</td><td>数量：<span>%d</span></td></tr></table></td></tr>'
+                '</table>' % (month[:4], month[4:], day, i % 24, i % 60, 100 + i, i % 100,
+                              card_id, month, i, i % 5 + 1))
+        return "".join(rows) + self.paging_labels(has_more, total)
+
+    def trade_ids(self, card_id, month):
+        return ["%s%s%04d" % (card_id, month, i) for i in range(self.trades_per_card)]
+
+    def inv_manage(self, form):
+        card_id = form.get("id", "")
+        month = form.get("month", "")
+        with self.lock:
+            pending = [t for t in self.trade_ids(card_id, month) if t not in self.submitted]
+        trades, has_more, total = self.paged(pending, int(form.get("pageNo") or 1))
+        rows = "".join(
+            '<tr><td class="tab_tr_td10"><input type="checkbox" class="check_one" value="%s_1"></td>'
+            '<td>收费站</td></tr>' % t for t in trades)
+        return "<table>%s</table>%s" % (rows, self.paging_labels(has_more, total))
+
+    def inv_apply(self, form):
+        trades = [t for t in form.get("tradeIdList", "").split(",") if t]
+        with self.lock:
+            self.apply_seq += 1
+            apply_id = "A%010d" % self.apply_seq
+            self.applies[apply_id] = trades
+        return ('<form id="checkForm"><input id="applyId" value="%s"><input id="id" value="%s">'
+                '<input id="userType" value="COMPANY"></form>' % (apply_id, form.get("id", "")))
+
+    def inv_subapply(self, form):
+        with self.lock:
+            trades = self.applies.pop(form.get("applyId", ""), None)
+            if trades is None:
+                return '{"success": false, "msg": "applyId无效"}'
+            duplicated = [t for t in trades if t in self.submitted]
+            self.submitted.update(trades)
+        if duplicated:
+            return '{"success": false, "msg": "重复开票%s条"}' % len(duplicated)
+        return '{"success": true, "count": %s}' % len(trades)
+
+    def invoice_zip(self, key):
+        """生成发票zip文件，内容随发票不同而不同
+
+        同一张发票每次生成的内容完全相同。包含一个带发票字段的XML、一个OFD(zip容器，字段位于OFD.xml的CustomData)和一个PDF。
+        """
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        number = "%08d" % (int(digest[:8], 16) % 10 ** 8)
+        xml = ("<Invoice><InvoiceCode>044001900111</InvoiceCode><InvoiceNumber>%s</InvoiceNumber>"
+               "<IssueDate>20180101</IssueDate><TotalAmount>97.09</TotalAmount><TotalTax>2.91</TotalTax>"
+               "<TotalTax-includedAmount>100.00</TotalTax-includedAmount><SellerName>模拟高速公路</SellerName>"
+               "<Key>%s</Key></Invoice>" % (number, key))
+        ofd = io.BytesIO()
+        with zipfile.ZipFile(ofd, "w", zipfile.ZIP_STORED) as zf:
+            zf.writestr(zip_entry("OFD.xml"), '<ofd:OFD xmlns:ofd="http://www.ofdspec.org/2016"><ofd:DocBody><ofd:DocInfo>'
+                                   '<ofd:CustomDatas><ofd:CustomData Name="发票代码">044001900111</ofd:CustomData>'
+                                   '<ofd:CustomData Name="发票号码">%s</ofd:CustomData>'
+                                   '<ofd:CustomData Name="价税合计">100.00</ofd:CustomData></ofd:CustomDatas>'
+                                   '</ofd:DocInfo></ofd:DocBody></ofd:OFD>' % number)
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:
+            zf.writestr(zip_entry("%s.xml" % key), xml)
+            zf.writestr(zip_entry("%s.ofd" % key), ofd.getvalue())
+            zf.writestr(zip_entry("%s.pdf" % key), hashlib.sha256(key.encode()).digest() + self.payload +
+                        b"\ntrailer\n<< /Info << /Title (%s) /Producer (mock) >> >>\n%%%%EOF\n" % key.encode())
+        return buf.getvalue()
+
+    def delay(self):
+        if self.latency or self.jitter:
+            time.sleep(max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0))
+
+    def fail(self):
+        return self.error_rate and self.random.random() < self.error_rate
+
+
+ROUTES = {
+    "/pss/app/login/invoice/query/card": "query_card",
+    "/pss/app/login/cardList/manage": "card_list",
+    "/pss/app/login/invoice/query/queryApply": "query_apply",
+    "/pss/app/login/invoice/consumeTrans/manage": "inv_manage",
+    "/pss/app/login/invoice/consumeTrans/apply": "inv_apply",
+    "/pss/app/login/invoice/consumeTrans/submitApply": "inv_subapply",
+}
+DOWNLOAD_PREFIX = "/pss/app/login/invoice/query/download/"
+RANGE_RE = re.compile(r"bytes=(\d+)-$")
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写出，不关闭Nagle算法会叠加40ms的延迟确认
+    disable_nagle_algorithm = True
+    site = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, body, status=200, content_type="text/html; charset=utf-8", headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if "JSESSIONID" not in (self.headers.get("Cookie") or ""):
+            self.send_header("Set-Cookie", "JSESSIONID=mock%s; Path=/" % threading.get_ident())
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        with self.site.lock:
+            self.site.stats["requests"] += 1
+            self.site.stats["bytes"] += len(body)
+            if status >= 500:
+                self.site.stats["errors"] += 1
+
+    def precheck(self):
+        """模拟延迟、cookie失效和服务端错误，返回False表示已经返回了错误响应"""
+        self.site.delay()
+        if (self.site.require_cookie and not self.headers.get("Cookie")) or \
+                self.site.expired(self.headers.get("Cookie")):
+            self.send("<html>404</html>", status=404)
+            return False
+        if self.site.fail():
+            self.send("<html>503</html>", status=503)
+            return False
+        return True
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        form = dict((k, v[0]) for k, v in parse_qs(self.rfile.read(length).decode("utf-8")).items())
+        route = ROUTES.get(self.path.split("?")[0])
+        if route is None:
+            return self.send("<html>404</html>", status=404)
+        if not self.precheck():
+            return
+        body = getattr(self.site, route)(form)
+        self.send("<html><body>%s</body></html>" % body if not body.startswith("{") else body)
+
+    def do_GET(self):
+        if not self.path.startswith(DOWNLOAD_PREFIX):
+            return self.send("<html>404</html>", status=404)
+        if not self.precheck():
+            return
+        data = self.site.invoice_zip(self.path[len(DOWNLOAD_PREFIX):])
+        match = RANGE_RE.match(self.headers.get("Range") or "")
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                return self.send(b"", status=416, headers={"Content-Range": "bytes */%s" % len(data)})
+            return self.send(data[start:], status=206, content_type="application/zip", headers={
+                "Content-Range": "bytes %s-%s/%s" % (start, len(data) - 1, len(data))})
+        self.send(data, content_type="application/zip")
+
+
+class MockServer(object):
+    """在后台线程中运行模拟服务器，url属性为可传给APIHandler的站点地址"""
+
+    def __init__(self, site, host="127.0.0.1", port=0):
+        handler = type("BoundMockRequestHandler", (MockRequestHandler,), {"site": site})
+        self.site = site
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self.url = "http://%s:%s/" % self.httpd.server_address[:2]
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.httpd.serve_forever, name="mock-server", daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def add_site_arguments(parser):
+    parser.add_argument("--cards", type=int, default=50, help="卡片(车辆)数量(默认50)")
+    parser.add_argument("--invoices", type=int, default=8, help="每张卡片每月的发票数量(默认8)")
+    parser.add_argument("--trades", type=int, default=20, help="每张卡片每月待开票的交易数量(默认20)")
+    parser.add_argument("--page-size", type=int, default=6, help="列表每页条数(默认6)")
+    parser.add_argument("--latency", type=float, default=0.0, help="每个请求的平均延迟，毫秒(默认0)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="延迟的随机抖动范围，毫秒(默认0)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回503的概率(默认0)")
+    parser.add_argument("--zip-size", type=int, default=32 * 1024, help="每个发票zip文件的大致字节数(默认32768)")
+    parser.add_argument("--total-pages", action="store_true", help="在分页中输出taiji_search_totalPage标签")
+    parser.add_argument("--require-cookie", action="store_true", help="请求未携带cookie时返回404")
+    parser.add_argument("--expire-after", type=int, default=0,
+                        help="同一cookie请求N次后失效，之后返回404，0表示不失效(默认0)")
+
+
+def site_from_options(options):
+    return MockSite(
+        cards=options.cards,
+        invoices_per_card=options.invoices,
+        trades_per_card=options.trades,
+        page_size=options.page_size,
+        latency=options.latency / 1000.0,
+        jitter=options.jitter / 1000.0,
+        error_rate=options.error_rate,
+        zip_size=options.zip_size,
+        total_pages=options.total_pages,
+        require_cookie=options.require_cookie,
+        expire_after=options.expire_after,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地模拟的pss.txffp.com服务器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8800, help="监听端口，0表示随机端口(默认8800)")
+    add_site_arguments(parser)
+    options = parser.parse_args()
+
+    server = MockServer(site_from_options(options), options.host, options.port)
+    # 第一行输出服务器地址，供bench_throughput.py读取
+    print(server.url, flush=True)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import sys
+
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "bench"))
+
+from mock_server import MockServer, MockSite  # noqa: E402
+from txffp import HEADERS, APIHandler, JobLedger, RateController, RetryPolicy  # noqa: E402
+
+
+@pytest.fixture
+def site():
+    return MockSite(cards=2, invoices_per_card=8, trades_per_card=10, zip_size=256)
+
+
+@pytest.fixture
+def server(site):
+    server = MockServer(site).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_handler(server, tmp_path):
+    """创建连接到模拟服务器的APIHandler，结束时关闭任务账本"""
+    ledgers = []
+
+    def make_handler(cookie="token=test", **kwargs):
+        ledger = JobLedger(str(tmp_path / ("ledger%s.db" % len(ledgers))))
+        ledgers.append(ledger)
+        kwargs.setdefault("workers", 4)
+        return APIHandler(
+            cookie, HEADERS,
+            site_url=server.url,
+            logger=logging.getLogger("txffp.test"),
+            rate_limiter=RateController(max_rate=0),
+            retry_policy=RetryPolicy(max_retries=2, backoff=0.01),
+            ledger=ledger,
+            **kwargs
+        )
+
+    yield make_handler
+    for ledger in ledgers:
+        ledger.close()
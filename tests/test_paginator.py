@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+import pytest
+
+from txffp import Paginator, Pipeline
+
+LOGGER = logging.getLogger("txffp.test")
+
+
+def paginator(fetch, total=None, **kwargs):
+    return Paginator(
+        fetch,
+        has_more=lambda doc: doc["more"],
+        total_pages=(lambda doc: total) if total else None,
+        parse=lambda html: html,
+        logger=LOGGER,
+        **kwargs
+    )
+
+
+def test_pages_in_order_with_concurrent_prefetch():
+    """总页数已知时并发获取，仍按页码顺序返回"""
+    def fetch(page_num):
+        # 越靠前的页越慢，乱序完成
+        time.sleep((10 - page_num) * 0.002)
+        return {"page": page_num, "more": page_num < 10}
+
+    pages = paginator(fetch, total=10, workers=4)
+    assert [page_num for page_num, doc in pages] == list(range(1, 11))
+    assert pages.complete
+
+
+def test_follows_has_more_without_total():
+    pages = paginator(lambda page_num: {"more": page_num < 3})
+    assert [page_num for page_num, doc in pages] == [1, 2, 3]
+
+
+def test_skips_failed_page():
+    pages = paginator(lambda page_num: None if page_num == 2 else {"more": page_num < 4}, total=4, workers=2)
+    assert [page_num for page_num, doc in pages] == [1, 3, 4]
+    assert not pages.complete
+
+
+def test_stops_after_consecutive_failures():
+    """连续失败达到上限后不再返回已经预取的分页"""
+    fetched = []
+
+    def fetch(page_num):
+        fetched.append(page_num)
+        return None if page_num in (2, 3, 4) else {"more": True}
+
+    pages = paginator(fetch, total=20, workers=4, max_failures=3)
+    assert [page_num for page_num, doc in pages] == [1]
+    assert not pages.complete
+    assert max(fetched) < 20
+
+
+def test_pipeline_runs_all_stages():
+    results = []
+    lock = threading.Lock()
+
+    def collect(item):
+        with lock:
+            results.append(item)
+
+    pipeline = Pipeline(maxsize=2, logger=LOGGER)
+    pipeline.add_stage("double", lambda n: [n * 2], workers=3)
+    pipeline.add_stage("collect", collect, workers=2)
+    pipeline.run(range(50))
+    assert sorted(results) == [n * 2 for n in range(50)]
+    assert pipeline.counts == {"double": 50, "collect": 50}
+
+
+def test_pipeline_stops_on_error():
+    """任意阶段出错时停止接收新任务，所有线程退出后重新抛出异常"""
+    def fail(n):
+        if n == 3:
+            raise ValueError("boom")
+        return [n]
+
+    pipeline = Pipeline(maxsize=1, logger=LOGGER)
+    pipeline.add_stage("fail", fail, workers=2)
+    pipeline.add_stage("slow", lambda n: time.sleep(0.001), workers=1)
+    before = threading.active_count()
+    with pytest.raises(ValueError):
+        pipeline.run(range(1000))
+    assert pipeline.counts["fail"] < 1000
+    assert threading.active_count() == before
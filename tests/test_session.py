@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+
+import pytest
+
+from txffp import SessionExpiredException, SessionGuard
+
+MONTH = "201804"
+
+
+def write_cookie(path, cookie):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(cookie)
+
+
+def wait_for(predicate, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise AssertionError("等待超时")
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def cookie_path(tmp_path):
+    path = str(tmp_path / "cookie.txt")
+    write_cookie(path, "token=0")
+    return path
+
+
+def test_pause_and_resume_on_cookie_refresh(site, make_handler, cookie_path, tmp_path):
+    """多个线程同时遇到cookie失效时只暂停一次，cookie文件更新后全部下载完成"""
+    site.require_cookie = True
+    site.expire_after = 12
+    guard = SessionGuard(cookie_path, timeout=10, poll=0.02)
+    handler = make_handler("token=0", session_guard=guard)
+    save_dir = tmp_path / "out"
+    save_dir.mkdir()
+
+    result = []
+    worker = threading.Thread(target=lambda: result.append(handler.inv_download_all(MONTH, str(save_dir))))
+    worker.start()
+    cookies = 0
+    while worker.is_alive():
+        if guard.paused:
+            # 暂停期间只有一个线程负责等待，其他线程阻塞，不会重复暂停
+            assert guard.pauses == cookies
+            cookies += 1
+            write_cookie(cookie_path, "token=%s" % cookies)
+            wait_for(lambda: not guard.paused)
+        time.sleep(0.005)
+    worker.join()
+
+    assert result == [True]
+    assert cookies >= 1
+    assert guard.pauses == guard.generation == cookies
+    assert len(os.listdir(str(save_dir))) == site.cards * site.invoices_per_card
+
+
+def test_refresh_retries_same_cookie(site, make_handler, cookie_path):
+    """refresh()(SIGHUP)时即使cookie文件没有变化也重新尝试"""
+    site.require_cookie = True
+    site.expire_after = 1
+    guard = SessionGuard(cookie_path, timeout=10, poll=5)
+    handler = make_handler("token=0", session_guard=guard)
+    assert handler.check_session()
+
+    result = []
+    worker = threading.Thread(target=lambda: result.append(handler.check_session()))
+    worker.start()
+    wait_for(lambda: guard.paused)
+    site.expire_after = 0
+    guard.refresh()
+    worker.join(5)
+    assert result == [True]
+    assert guard.generation == 1
+
+
+def test_wait_timeout_raises(site, make_handler, cookie_path):
+    site.require_cookie = True
+    site.expire_after = 1
+    guard = SessionGuard(cookie_path, timeout=0.2, poll=0.02)
+    handler = make_handler("token=0", session_guard=guard)
+    assert handler.check_session()
+    with pytest.raises(SessionExpiredException):
+        handler.check_session()
+    # 超时后其他请求也立即失败
+    with pytest.raises(SessionExpiredException):
+        guard.wait()
+
+
+def test_cancel_releases_paused_requests(site, make_handler, cookie_path):
+    """cancel()(退出程序时)让暂停中的请求立即失败，不等待超时"""
+    site.require_cookie = True
+    site.expire_after = 1
+    guard = SessionGuard(cookie_path, timeout=60, poll=5)
+    handler = make_handler("token=0", session_guard=guard)
+    assert handler.check_session()
+
+    errors = []
+
+    def check():
+        try:
+            handler.check_session()
+        except SessionExpiredException as e:
+            errors.append(e)
+
+    worker = threading.Thread(target=check)
+    worker.start()
+    wait_for(lambda: guard.paused)
+    guard.cancel()
+    worker.join(2)
+    assert not worker.is_alive()
+    assert len(errors) == 1
+    # 取消后reset()不会恢复请求
+    guard.reset()
+    with pytest.raises(SessionExpiredException):
+        guard.wait()
+
+
+def test_genuine_404_does_not_pause(server, make_handler, cookie_path):
+    guard = SessionGuard(cookie_path, timeout=10, poll=0.02)
+    handler = make_handler("token=0", session_guard=guard)
+    assert handler.api_handler(server.url + "pss/app/login/missing", name="missing") is None
+    assert guard.pauses == 0
+    assert not guard.paused
+
+
+def test_without_guard_expiry_raises(site, make_handler):
+    site.require_cookie = True
+    site.expire_after = 1
+    handler = make_handler("token=0")
+    assert handler.check_session()
+    with pytest.raises(SessionExpiredException):
+        handler.check_session()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+import zipfile
+
+from txffp.storage import ArchiveWriter, archive_sizes
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def add_files(writer, tmp_path, names):
+    for name in names:
+        source = tmp_path / ("src_" + name)
+        source.write_bytes(name.encode("utf-8") * 100)
+        writer.add(name, str(source), {"amount": 1})
+
+
+def read_archive(path):
+    with zipfile.ZipFile(path) as archive:
+        assert archive.testzip() is None
+        manifest = json.loads(archive.read(ArchiveWriter.MANIFEST_NAME).decode("utf-8"))
+        return archive.namelist(), [record["name"] for record in manifest["invoices"]]
+
+
+def test_append_in_place(tmp_path):
+    """已有归档直接追加，原有条目不重写，归档中只保留一份清单"""
+    path = str(tmp_path / "invoices.zip")
+    writer = ArchiveWriter(path)
+    add_files(writer, tmp_path, ["a.zip", "b.zip"])
+    assert writer.close()
+    inode = os.stat(path).st_ino
+    with open(path, "rb") as f:
+        head = f.read(256)
+
+    writer = ArchiveWriter(path)
+    assert writer.names == {"a.zip", "b.zip"}
+    add_files(writer, tmp_path, ["c.zip"])
+    assert writer.close()
+    assert not os.path.exists(writer.journal_path)
+    assert os.stat(path).st_ino == inode
+    with open(path, "rb") as f:
+        assert f.read(256) == head
+    assert read_archive(path) == (["a.zip", "b.zip", "c.zip", "manifest.json"], ["a.zip", "b.zip", "c.zip"])
+    assert archive_sizes(path)["c.zip"] == len("c.zip") * 100
+
+    # 没有新增发票时不改动归档
+    assert not ArchiveWriter(path).close()
+
+
+def test_interrupted_append_is_rolled_back(tmp_path):
+    """追加过程中进程退出，下次打开时恢复成追加前的归档"""
+    path = str(tmp_path / "invoices.zip")
+    writer = ArchiveWriter(path)
+    add_files(writer, tmp_path, ["a.zip"])
+    writer.close()
+    with open(path, "rb") as f:
+        before = f.read()
+    source = tmp_path / "src_b.zip"
+    source.write_bytes(b"b" * 1000)
+
+    script = (
+        "import os, sys\n"
+        "sys.path.insert(0, %r)\n"
+        "from txffp.storage import ArchiveWriter\n"
+        "writer = ArchiveWriter(%r)\n"
+        "writer.add('b.zip', %r, {})\n"
+        "os._exit(0)\n"
+    ) % (ROOT_DIR, path, str(source))
+    subprocess.check_call([sys.executable, "-c", script])
+    assert os.path.exists(path + ArchiveWriter.JOURNAL_SUFFIX)
+
+    writer = ArchiveWriter(path)
+    assert writer.names == {"a.zip"}
+    with open(path, "rb") as f:
+        assert f.read() == before
+    add_files(writer, tmp_path, ["b.zip"])
+    writer.close()
+    assert read_archive(path) == (["a.zip", "b.zip", "manifest.json"], ["a.zip", "b.zip"])
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import os
+
+from txffp import PlateIndex, ResponseCache
+from txffp.config import CACHE_TTL_CLOSED, CACHE_TTL_OPEN
+
+MONTH = "201804"
+DOWNLOAD_PATH = "pss/app/login/invoice/query/download/"
+
+
+def invoice_key(site, card=0, n=0):
+    return "%s_%s_%d" % (site.card_id(card), MONTH, n)
+
+
+def test_download_all(site, make_handler, tmp_path):
+    handler = make_handler()
+    assert handler.inv_download_all(MONTH, str(tmp_path))
+    files = [name for name in os.listdir(str(tmp_path)) if name.endswith(".zip")]
+    assert len(files) == site.cards * site.invoices_per_card
+    assert handler.ledger.summary() == {"done": len(files)}
+
+
+def test_resume_partial_download(site, server, make_handler, tmp_path):
+    """已有的.part文件通过Range请求续传"""
+    handler = make_handler()
+    data = site.invoice_zip(invoice_key(site))
+    with open(str(tmp_path / "a.zip.part"), "wb") as f:
+        f.write(data[:100])
+    download = handler.download_file(server.url + DOWNLOAD_PATH + invoice_key(site), str(tmp_path), "a.zip")
+    assert download is not None
+    with open(download.path, "rb") as f:
+        assert f.read() == data
+
+
+def test_resume_with_mismatched_content_range(site, server, make_handler, tmp_path):
+    """返回的Content-Range与.part文件接不上时丢弃临时文件重新下载，而不是追加"""
+    handler = make_handler()
+    data = site.invoice_zip(invoice_key(site))
+    with open(str(tmp_path / "a.zip.part"), "wb") as f:
+        f.write(b"x" * 100)
+
+    get = handler.session.get
+
+    def shifted_get(url, headers=None, **kwargs):
+        if headers and "Range" in headers:
+            headers = dict(headers, Range="bytes=0-")
+        return get(url, headers=headers, **kwargs)
+
+    handler.session.get = shifted_get
+    download = handler.download_file(server.url + DOWNLOAD_PATH + invoice_key(site), str(tmp_path), "a.zip")
+    assert download is not None
+    with open(download.path, "rb") as f:
+        assert f.read() == data
+    assert not os.path.exists(str(tmp_path / "a.zip.part"))
+
+
+def test_submitted_trades_are_not_resubmitted(site, make_handler):
+    handler = make_handler(workers=1)
+    card_id = site.card_id(0)
+    handler.submit_apply(card_id, MONTH)
+    assert handler.ledger.trade_summary() == {"submitted": site.trades_per_card}
+    assert len(site.submitted) == site.trades_per_card
+
+    handler.submit_apply(card_id, MONTH)
+    assert site.apply_seq == 1
+
+
+def test_unknown_submission_is_not_retried(site, make_handler):
+    """submitApply的响应丢失时交易保持submitting，之后的运行不会再次提交"""
+    handler = make_handler(workers=1)
+    card_id = site.card_id(0)
+    handler.api_inv_subapply = lambda *args, **kwargs: None
+    handler.submit_apply(card_id, MONTH)
+    assert handler.ledger.trade_summary() == {"submitting": site.trades_per_card}
+
+    del handler.api_inv_subapply
+    handler.submit_apply(card_id, MONTH)
+    assert site.apply_seq == 1
+    assert not site.submitted
+
+
+def test_released_submission_is_resubmitted(site, make_handler):
+    """人工确认未开票并释放后，提交结果未知的交易会重新提交"""
+    handler = make_handler(workers=1)
+    card_id = site.card_id(0)
+    handler.api_inv_subapply = lambda *args, **kwargs: None
+    handler.submit_apply(card_id, MONTH)
+    del handler.api_inv_subapply
+
+    rows = handler.ledger.unknown_trades([MONTH])
+    assert [row[:2] + row[3:4] for row in rows] == [(card_id, MONTH, site.trades_per_card)]
+    assert handler.ledger.release_trades([rows[0][2]]) == site.trades_per_card
+    assert handler.ledger.unknown_trades() == []
+
+    handler.submit_apply(card_id, MONTH)
+    assert len(site.submitted) == site.trades_per_card
+    assert handler.ledger.trade_summary() == {"submitted": site.trades_per_card}
+
+
+def test_cache_cleared_when_account_changes(site, make_handler, tmp_path):
+    """换用其他账号的cookie后不会读到上一个账号缓存的卡片列表"""
+    cache = ResponseCache(str(tmp_path / "cache"))
+    handler = make_handler(cache=cache)
+    assert handler.check_session()
+    first = [card.id for card in handler.iter_cards(PlateIndex.QUERY)]
+
+    # 另一个公司的账号：卡片id不同
+    site.card_id = lambda n: "5501%012d" % n
+    handler = make_handler(cache=cache)
+    assert handler.check_session()
+    second = [card.id for card in handler.iter_cards(PlateIndex.QUERY)]
+    assert second != first
+    assert all(card_id.startswith("5501") for card_id in second)
+
+
+def test_plate_lookup_bypasses_cached_card_list(site, make_handler, tmp_path):
+    """车牌号索引未命中时重新获取卡片列表，不使用缓存"""
+    handler = make_handler(cache=ResponseCache(str(tmp_path / "cache")))
+    assert len(handler.lookup_plates(PlateIndex.QUERY, [site.plate(0)])) == 1
+
+    site.cards += 1
+    cards = handler.lookup_plates(PlateIndex.QUERY, [site.plate(site.cards - 1)])
+    assert [card.id for card in cards] == [site.card_id(site.cards - 1)]
+
+
+def test_open_month_list_is_cached_briefly(site, make_handler, tmp_path):
+    """open_months中的已结束月份(如守护模式同步的上个月)发票列表只短时间缓存"""
+    cache = ResponseCache(str(tmp_path / "cache"))
+    ttls = []
+    set_cache = cache.set
+    cache.set = lambda endpoint, params, body, ttl: (ttls.append(ttl), set_cache(endpoint, params, body, ttl))
+    handler = make_handler(cache=cache)
+    assert handler.api_query_apply(site.card_id(0), MONTH) is not None
+    handler.open_months = (MONTH,)
+    assert handler.api_query_apply(site.card_id(1), MONTH) is not None
+    assert ttls == [CACHE_TTL_CLOSED, CACHE_TTL_OPEN]
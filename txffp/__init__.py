@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""通行费发票批量下载和开票工具
+
+包内的名称在第一次访问时才导入对应的模块，例如只有访问APIHandler时才会导入requests和lxml:
+    from txffp import APIHandler, HEADERS, load_cookie
+
+from txffp import *只导入不依赖requests和lxml的名称(配置、异常、记录、存储和指标)，其他名称需要显式导入。
+"""
+
+import importlib
+
+# 公开名称 -> 所在的子模块
+_EXPORTS = {
+    "BASE_DIR": "config",
+    "HEADERS": "config",
+    "SITE_URL": "config",
+    "load_cookie": "config",
+    "read_cookie": "config",
+    "MonthException": "exceptions",
+    "SessionExpiredException": "exceptions",
+    "TxffpException": "exceptions",
+    "TypeException": "exceptions",
+    "create_logger": "log",
+    "parse_months": "months",
+    "ApplyInfo": "records",
+    "Card": "records",
+    "Download": "records",
+    "Estimate": "records",
+    "Invoice": "records",
+    "TradeId": "records",
+    "as_card": "records",
+    "ArchiveStore": "storage",
+    "JobLedger": "storage",
+    "PlateIndex": "storage",
+    "ResponseCache": "storage",
+    "SyncManifest": "storage",
+    "Metrics": "metrics",
+    "MetricsReporter": "metrics",
+    "Progress": "metrics",
+    "InvoiceIndex": "index",
+    "build_invoice_index": "index",
+    "Page": "parsers",
+    "parse_bundle": "parsers",
+    "BaseHandler": "transport",
+    "ChunkWriter": "transport",
+    "RateController": "transport",
+    "RetryPolicy": "transport",
+    "SessionGuard": "transport",
+    "APIHandler": "workflows",
+    "Paginator": "workflows",
+    "Pipeline": "workflows",
+    "Daemon": "daemon",
+    "main": "cli",
+}
+
+# from txffp import *只导入这些模块中的名称，不会导入requests、lxml和其他子模块
+_LIGHTWEIGHT = ("config", "exceptions", "log", "months", "records", "storage", "metrics")
+
+__all__ = sorted(name for name, module in _EXPORTS.items() if module in _LIGHTWEIGHT)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(importlib.import_module("." + module, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
@@ -0,0 +1,6 @@
+# -*- coding: utf-8 -*-
+"""python3 -m txffp"""
+
+from .cli import main
+
+main()
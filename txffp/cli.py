@@ -0,0 +1,517 @@
+# -*- coding: utf-8 -*-
+"""命令行入口
+
+只导入参数解析需要的模块，requests和lxml在真正执行任务时才会导入，
+--help和参数校验不需要等待它们加载。
+"""
+
+import argparse
+import contextlib
+import cProfile
+import io
+import json
+import logging
+import multiprocessing
+import os
+import pstats
+import signal
+import sys
+import time
+
+from .config import (
+    ACCOUNT_PROCESSES, APPLY_BATCH_SIZE, BASE_DIR, CACHE_DIR, COOKIE_FILE, DAEMON_INTERVAL, DAEMON_PREVIOUS_DAYS,
+    HEADERS, INITIAL_RPS, INVOICE_INDEX_FILE, LEDGER_FILE, LOG_FILE, LOGGER_NAME, LOG_FORMATS, LOG_LEVEL, LOG_LEVELS,
+    MAX_RETRIES, MAX_RPS, METRICS_FILE, METRICS_INTERVAL, MIN_RPS, PLATE_INDEX_FILE, POOL_SIZE, PROFILE_FILE,
+    PROGRESS_INTERVAL, QUEUE_SIZE, REPORT_FILE, SESSION_WAIT, SITE_URL, WORKERS, load_cookie, read_cookie,
+)
+from .exceptions import MonthException, SessionExpiredException, TypeException
+from .index import index_invoices, query_invoices
+from .log import create_logger, log_options, stop_logger
+from .metrics import MetricsReporter, ProgressDisplay, StackSampler
+from .months import parse_months
+from .storage import ArchiveStore, JobLedger, PlateIndex, ResponseCache, SyncManifest
+
+
+def load_accounts(path):
+    """读取多账号配置，返回[{"name", "cookie", "cookie_file", "email", "rps"}]
+
+    path可以是目录，目录下每个*.txt文件为一个账号的cookie，文件名即账号名；
+    也可以是JSON清单，内容为账号列表，例如:
+        [{"name": "company_a", "cookie_file": "a.txt", "email": "a@example.com", "rps": 5}]
+    清单中cookie_file的相对路径以清单所在目录为准，也可以直接使用cookie字段。
+    cookie_file为cookie失效后等待更新的文件，直接使用cookie字段时为None。
+    """
+    accounts = []
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            name, ext = os.path.splitext(filename)
+            if ext == ".txt":
+                cookie_file = os.path.join(path, filename)
+                accounts.append({
+                    "name": name,
+                    "cookie": read_cookie(cookie_file),
+                    "cookie_file": cookie_file,
+                    "email": None,
+                    "rps": None,
+                })
+        return accounts
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    with open(path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    for item in manifest:
+        cookie, cookie_file = item.get("cookie"), None
+        if cookie is None:
+            cookie_file = os.path.join(base_dir, item["cookie_file"])
+            cookie = read_cookie(cookie_file)
+        accounts.append({
+            "name": item["name"],
+            "cookie": cookie,
+            "cookie_file": cookie_file,
+            "email": item.get("email"),
+            "rps": item.get("rps"),
+        })
+    return accounts
+
+
+def create_cache(options, base_dir, account=None):
+    """根据命令行参数创建响应缓存，--no-cache时返回None
+
+    多账号模式下指定了--cache-dir时，每个账号使用其中以账号命名的子目录，避免读到其他账号的页面。
+    """
+    if options.no_cache:
+        return None
+    if options.cache_dir:
+        return ResponseCache(os.path.join(options.cache_dir, account) if account else options.cache_dir)
+    return ResponseCache(os.path.join(base_dir, CACHE_DIR))
+
+
+def output_path(path, default_name, base_dir, per_account=False):
+    """运行报告等输出文件的路径，多账号模式下只取文件名放在账号目录中"""
+    if per_account or not path:
+        return os.path.join(base_dir, os.path.basename(path or default_name))
+    return path
+
+
+@contextlib.contextmanager
+def instrument(event_handler, options, base_dir, ledger=None, per_account=False):
+    """在任务执行期间定期导出运行指标和输出进度，结束时写入最终报告；--profile时同时记录性能剖析"""
+    def extra():
+        info = {
+            "transport": event_handler.transport_stats(),
+            "rate": round(event_handler.rate_limiter.rate, 3),
+            "progress": event_handler.progress.snapshot(),
+        }
+        if ledger is not None:
+            info["invoices"] = ledger.summary()
+            info["trades"] = ledger.trade_summary()
+        if event_handler.cache is not None:
+            info["cache"] = event_handler.cache.stats()
+        if event_handler.sync is not None:
+            info["sync"] = event_handler.sync.stats()
+        return info
+
+    reporter = MetricsReporter(
+        event_handler.metrics,
+        report_path=output_path(options.report, REPORT_FILE, base_dir, per_account),
+        prom_path=output_path(options.metrics_file, METRICS_FILE, base_dir, per_account),
+        interval=options.metrics_interval,
+        extra=extra,
+        logger=event_handler.logger,
+    ).start()
+    if event_handler.session_guard is not None:
+        # cookie失效暂停时先写入一次运行报告
+        event_handler.session_guard.on_pause.append(reporter.write)
+    # 守护模式的进度通过控制接口查看，计划模式只有列表请求，都不定期输出进度
+    display = ProgressDisplay(
+        event_handler.progress,
+        interval=0 if options.plan or options.daemon else options.progress_interval,
+        logger=event_handler.logger,
+    ).start()
+
+    profiler = sampler = None
+    if options.profile:
+        profiler = cProfile.Profile()
+        sampler = StackSampler().start()
+        profiler.enable()
+    try:
+        yield reporter
+    finally:
+        display.stop()
+        if profiler is not None:
+            profiler.disable()
+            sampler.stop()
+            profile_path = os.path.join(base_dir, PROFILE_FILE)
+            profiler.dump_stats(profile_path)
+            sampler.write(profile_path + ".folded")
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(15)
+            event_handler.logger.info("性能剖析已保存至: %s(主线程)，%s.folded(所有线程的采样调用栈)\n%s",
+                                      profile_path, profile_path, stream.getvalue())
+        reporter.stop()
+        event_handler.logger.info("运行报告已保存至: %s, %s", reporter.report_path, reporter.prom_path)
+
+
+def create_sync(options, save_dir, logger=None):
+    """--sync时打开保存目录的同步清单，并登记目录中已有的文件"""
+    if not options.sync or not options.download or options.plan:
+        return None
+    sync = SyncManifest(save_dir)
+    sync.scan(logger)
+    return sync
+
+
+def create_archive(options, save_dir, prefix="invoices", logger=None):
+    """--archive时创建归档输出"""
+    if not options.archive or not options.download or options.plan:
+        return None
+    return ArchiveStore(save_dir, per_plate=options.archive == "plate", prefix=prefix, logger=logger)
+
+
+def create_handler(options, cookie, logger=None, ledger=None, rps=None, cache=None, plate_index=None, sync=None,
+                   archive=None, cookie_path=None):
+    """根据命令行参数创建APIHandler
+
+    指定cookie_path且--session-wait大于0时，cookie失效后暂停等待该文件更新，而不是结束程序。
+    """
+    from .transport import RateController, RetryPolicy, SessionGuard
+    from .workflows import APIHandler
+
+    session_guard = None
+    if cookie_path and options.session_wait > 0:
+        session_guard = SessionGuard(cookie_path, timeout=options.session_wait, logger=logger)
+    event_handler = APIHandler(
+        cookie, HEADERS,
+        req_sleep=options.waite,
+        logger=logger,
+        # 发票列表和文件下载两个阶段同时工作，连接池需要容纳两者的连接
+        pool_size=max(options.pool_size, (options.list_workers or options.workers) +
+                      (options.file_workers or options.workers)),
+        rate_limiter=RateController(
+            max_rate=options.rps if rps is None else rps,
+            initial_rate=MIN_RPS if options.waite else INITIAL_RPS,
+        ),
+        retry_policy=RetryPolicy(max_retries=options.retries),
+        workers=options.workers,
+        ledger=ledger,
+        resume=options.resume,
+        site_url=options.site_url,
+        cache=cache,
+        refresh_cache=options.refresh_cache,
+        plate_index=plate_index,
+        apply_batch_size=options.batch_size,
+        list_workers=options.list_workers,
+        file_workers=options.file_workers,
+        queue_size=options.queue_size,
+        sync=sync,
+        archive=archive,
+        session_guard=session_guard,
+    )
+    if session_guard is not None:
+        session_guard.on_pause.append(event_handler.save_state)
+    return event_handler
+
+
+def parse_plates(values):
+    """展开--plate参数，每个参数可以是逗号分隔的多个车牌号或通配符"""
+    plates = []
+    for value in values or []:
+        plates.extend(plate.strip() for plate in value.split(",") if plate.strip())
+    return plates
+
+
+def list_unknown_trades(ledger, months=None):
+    """输出提交结果未知的开票批次，需要在站点上确认这些交易是否已经开票"""
+    rows = ledger.unknown_trades(months)
+    if not rows:
+        print("没有提交结果未知的交易")
+        return
+    print("\t".join(["卡片", "月份", "applyId", "交易数", "提交时间"]))
+    for row in rows:
+        print("\t".join("%s" % ("" if value is None else value) for value in row))
+    print("在站点上确认这些交易未开票后，用--release-trades <applyId>释放，之后开票时会重新提交")
+
+
+def cancel_on_interrupt(event_handler):
+    """Ctrl-C时先取消会话等待，暂停中的工作线程随之结束，主线程才能等到它们退出"""
+    guard = event_handler.session_guard
+    if guard is None:
+        return
+
+    def interrupt(signum, frame):
+        guard.cancel()
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGINT, interrupt)
+
+
+def run_account(account, options, months):
+    """在独立的工作进程中执行一个账号的任务，返回该账号的执行摘要
+
+    每个账号使用自己的logger、输出子目录、任务账本和请求速率上限。
+    """
+    from .workflows import execute
+
+    name = account["name"]
+    account_dir = os.path.join(options.savedir or BASE_DIR, name)
+    os.makedirs(account_dir, exist_ok=True)
+    logger = create_logger("%s.%s" % (LOGGER_NAME, name), **log_options(options, account_dir, per_account=True))
+
+    summary = {"account": name, "status": "done", "error": "", "invoices": {}, "transport": {}}
+    start = time.monotonic()
+    ledger = JobLedger(os.path.join(account_dir, LEDGER_FILE))
+    sync = create_sync(options, account_dir, logger)
+    archive = create_archive(options, account_dir, name, logger)
+    event_handler = create_handler(
+        options, account["cookie"], logger, ledger, account["rps"], create_cache(options, account_dir, name),
+        PlateIndex(os.path.join(account_dir, PLATE_INDEX_FILE)), sync, archive, account["cookie_file"])
+    cancel_on_interrupt(event_handler)
+    try:
+        with instrument(event_handler, options, account_dir, ledger, per_account=True):
+            execute(event_handler, options, months, account_dir, account["email"] or options.email)
+    except SessionExpiredException as e:
+        logger.error("%s，已完成的任务可通过--resume跳过", e)
+        summary.update(status="expired", error=str(e))
+    except Exception as e:
+        logger.exception("账号[%s]执行失败", name)
+        summary.update(status="failed", error="%s: %s" % (type(e).__name__, e))
+    finally:
+        if archive is not None:
+            archive.close()
+        summary["invoices"] = ledger.summary()
+        summary["trades"] = ledger.trade_summary()
+        ledger.close()
+        if sync is not None:
+            summary["sync"] = sync.stats()
+            sync.close()
+    summary["transport"] = event_handler.transport_stats()
+    if event_handler.cache is not None:
+        summary["cache"] = event_handler.cache.stats()
+    summary["seconds"] = round(time.monotonic() - start, 1)
+    logger.info("账号[%s]任务结束: %s", name, summary)
+    # 工作进程退出时不会执行atexit，需要在返回前写出剩余的日志
+    stop_logger(logger.name)
+    return summary
+
+
+def run_accounts(options, months):
+    """多账号并行执行，每个账号一个工作进程，结束后输出汇总"""
+    logger = create_logger(**log_options(options, BASE_DIR))
+    accounts = load_accounts(options.accounts)
+    if not accounts:
+        logger.error("没有找到账号配置: %s", options.accounts)
+        return []
+
+    processes = max(min(options.processes, len(accounts)), 1)
+    logger.info("共%s个账号，使用%s个工作进程", len(accounts), processes)
+    with multiprocessing.Pool(processes) as pool:
+        summaries = pool.starmap(run_account, [(account, options, months) for account in accounts])
+
+    logger.info("多账号执行汇总:")
+    for summary in summaries:
+        logger.info("  %-16s %-8s %6.1fs 发票: %s 连接: %s %s",
+                    summary["account"], summary["status"], summary["seconds"], summary["invoices"],
+                    summary["transport"], summary["error"])
+    summary_path = os.path.join(options.savedir or BASE_DIR, "accounts_summary.json")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summaries, f, ensure_ascii=False, indent=2)
+    logger.info("汇总信息已保存至: %s", summary_path)
+    return summaries
+
+
+def run():
+    description = "如果请求失败，请更新你的cookie信息。\r\n如果在网络请求中出现异常等程序中断，可等待网络恢复后重试。"
+    parser = argparse.ArgumentParser(description=description)
+
+    unique_opts = parser.add_mutually_exclusive_group(required=True)
+    unique_opts.add_argument("-d", "--download", action="store_true", dest="download", help="下载发票文件，需要指定对象，以及月份和保存目录")
+    unique_opts.add_argument("-i", "--invoicev", action="store_true", dest="invoice", help="开票，需要指定开票月和对象")
+    unique_opts.add_argument("--build-index", action="store_true", dest="build_index", help="增量索引保存目录中已下载的发票，解析zip中的PDF/OFD/XML文件")
+    unique_opts.add_argument("-q", "--query", action="store", dest="query", help="按字段汇总发票索引中的金额，字段为plate、month、type的逗号分隔组合，例如：plate,month；可用--plate和-m过滤")
+    unique_opts.add_argument("--list-unknown-trades", action="store_true", dest="list_unknown_trades", help="列出任务账本中提交结果未知(提交时响应丢失)的开票批次，可用-m过滤月份；多账号模式下用--ledger指定账号子目录中的%s" % LEDGER_FILE)
+    unique_opts.add_argument("--release-trades", action="store", dest="release_trades", help="在站点上确认未开票后，释放任务账本中提交结果未知的批次，参数为逗号分隔的applyId或all，之后开票时这些交易会重新提交")
+
+    unique_opts_ = parser.add_mutually_exclusive_group(required=False)
+    unique_opts_.add_argument("-a", "--all", action="store_true", default=True, dest="all", help="执行全部")
+    unique_opts_.add_argument("-c", "--cardid", action="store", dest="cardid", help="指定车辆编号，注意：cardid不是指车牌号（不推荐）")
+    unique_opts_.add_argument("--plate", action="append", dest="plates", help="指定车牌号，可多次指定或用逗号分隔，支持通配符(如'粤B*')；通过本地索引查找卡片，索引未命中时才刷新")
+
+    parser.add_argument("-e", "--email", action="store", dest="email", help="开票时的发票文件接收邮箱地址")
+    parser.add_argument("-m", "--month", action="store", dest="month", help="目标年月份，例如2018年4月为：201804；支持区间和列表，例如：201801-201806,201809")
+    parser.add_argument("-s", "--savedir", action="store", dest="savedir", help="发票文件保存路径")
+    parser.add_argument("-w", "--waite", action="store_true", default=False, dest="waite", help="以最低速率(每秒%s次)起步，再根据站点响应情况逐步提速，可减轻对方服务器鸭梨" % MIN_RPS)
+    parser.add_argument("-p", "--pool-size", action="store", type=int, default=POOL_SIZE, dest="pool_size", help="HTTP连接池大小，同一会话内复用keep-alive连接(默认%s)" % POOL_SIZE)
+    parser.add_argument("--workers", action="store", type=int, default=WORKERS, dest="workers", help="并发工作线程数，大于1时下载以流水线方式执行(卡片发现→发票列表→文件下载→后处理)，开票时各卡片并发提交(默认%s)" % WORKERS)
+    parser.add_argument("--list-workers", action="store", type=int, dest="list_workers", help="并发下载时获取发票列表的线程数(默认与--workers相同)")
+    parser.add_argument("--file-workers", action="store", type=int, dest="file_workers", help="并发下载时下载发票文件的线程数(默认与--workers相同)")
+    parser.add_argument("--queue-size", action="store", type=int, default=QUEUE_SIZE, dest="queue_size", help="并发下载时流水线各阶段之间队列的最大长度，限制内存占用(默认%s)" % QUEUE_SIZE)
+    parser.add_argument("--rps", action="store", type=float, default=MAX_RPS, dest="rps", help="对站点的全局每秒请求数上限，实际速率在此上限内根据延迟和错误率自动调整，0表示不限制(默认%s)" % MAX_RPS)
+    parser.add_argument("--session-wait", action="store", type=int, default=SESSION_WAIT, dest="session_wait", help="cookie失效后暂停等待cookie.txt更新的最长秒数，更新后自动继续；0表示立即结束程序(默认%s)" % SESSION_WAIT)
+    parser.add_argument("--retries", action="store", type=int, default=MAX_RETRIES, dest="retries", help="请求失败(5xx、超时等)后的最大重试次数，重试间隔指数退避(默认%s)" % MAX_RETRIES)
+    parser.add_argument("--batch-size", action="store", type=int, default=APPLY_BATCH_SIZE, dest="batch_size", help="开票时每次提交的最大交易数量，多个分页的交易合并后分批提交(默认%s)" % APPLY_BATCH_SIZE)
+    parser.add_argument("--resume", action="store_true", default=False, dest="resume", help="根据任务账本跳过已经下载完成的卡片和发票文件，只下载缺失部分")
+    parser.add_argument("--sync", action="store_true", default=False, dest="sync", help="增量同步：保存目录中与同步清单一致的文件不再下载，内容相同的文件以硬链接只保存一份")
+    parser.add_argument("--archive", action="store", choices=("month", "plate"), dest="archive", help="归档输出：month把每月的发票写入一个zip归档，plate按车牌号每月一个归档，归档内附带manifest.json清单")
+    parser.add_argument("--plan", action="store_true", default=False, dest="plan", help="只估算工作量：与-d或-i一起使用，只请求卡片列表和各卡片每月列表的第一页，输出页数、发票或待开票交易数量、预计请求次数和耗时，不下载也不开票")
+    parser.add_argument("--progress-interval", action="store", type=float, default=PROGRESS_INTERVAL, dest="progress_interval", help="执行期间输出进度(完成数量、每秒完成数、每秒字节数、预计剩余时间)的间隔秒数，0表示不输出(默认%s)" % PROGRESS_INTERVAL)
+    parser.add_argument("--ledger", action="store", default=os.path.join(BASE_DIR, LEDGER_FILE), dest="ledger", help="任务账本(SQLite)文件路径(默认%s)" % LEDGER_FILE)
+    parser.add_argument("--no-cache", action="store_true", default=False, dest="no_cache", help="不使用响应缓存")
+    parser.add_argument("--refresh-cache", action="store_true", default=False, dest="refresh_cache", help="忽略已有的响应缓存，重新请求并刷新缓存")
+    parser.add_argument("--cache-dir", action="store", dest="cache_dir", help="响应缓存目录(默认%s)，多账号模式下每个账号使用以账号命名的子目录" % CACHE_DIR)
+    parser.add_argument("--accounts", action="store", dest="accounts", help="多账号模式：cookie文件目录(每个.txt文件一个账号)或JSON清单，每个账号在独立进程中执行，输出到保存路径下以账号命名的子目录")
+    parser.add_argument("--site-url", action="store", default=SITE_URL, dest="site_url", help="站点地址，可指向bench/mock_server.py启动的模拟服务器进行离线测试(默认%s)" % SITE_URL)
+    parser.add_argument("--report", action="store", dest="report", help="JSON运行报告路径，包含各接口的请求数、延迟分布、字节数、重试和错误以及解析耗时(默认%s)" % REPORT_FILE)
+    parser.add_argument("--metrics-file", action="store", dest="metrics_file", help="Prometheus textfile格式的指标文件路径(默认%s)" % METRICS_FILE)
+    parser.add_argument("--metrics-interval", action="store", type=float, default=METRICS_INTERVAL, dest="metrics_interval", help="运行期间导出运行报告和指标文件的间隔秒数，0表示只在结束时导出(默认%s)" % METRICS_INTERVAL)
+    parser.add_argument("--profile", action="store_true", default=False, dest="profile", help="记录性能剖析：主线程的cProfile数据保存为%s，所有线程的采样调用栈保存为%s.folded" % (PROFILE_FILE, PROFILE_FILE))
+    parser.add_argument("--index", action="store_true", default=False, dest="index", help="下载完成后增量索引保存目录中的发票")
+    parser.add_argument("--index-file", action="store", dest="index_file", help="发票索引(SQLite)文件路径(默认为保存路径下的%s)" % INVOICE_INDEX_FILE)
+    parser.add_argument("--index-processes", action="store", type=int, dest="index_processes", help="解析发票文件的进程数(默认为CPU核数)")
+    parser.add_argument("--daemon", action="store_true", default=False, dest="daemon", help="守护模式：常驻运行并保持会话，按--interval定时同步当月(每月前%s天包括上个月)的新发票，忽略-m" % DAEMON_PREVIOUS_DAYS)
+    parser.add_argument("--interval", action="store", type=float, default=DAEMON_INTERVAL, dest="interval", help="守护模式的同步间隔秒数(默认%s)" % DAEMON_INTERVAL)
+    parser.add_argument("--auto-invoice", action="store_true", default=False, dest="auto_invoice", help="守护模式下每轮先对新的交易开票，再下载发票")
+    parser.add_argument("--control-port", action="store", type=int, dest="control_port", help="守护模式的HTTP控制接口端口(只监听127.0.0.1)：GET /status、GET /metrics、GET /report、POST /sync")
+    parser.add_argument("--control-socket", action="store", dest="control_socket", help="守护模式的Unix socket控制接口路径，接口与--control-port相同")
+    parser.add_argument("-v", "--verbose", action="store_true", default=False, dest="verbose", help="输出调试日志，包括每个请求、卡片和发票的详细信息，等同于--log-level DEBUG")
+    parser.add_argument("--log-level", action="store", choices=LOG_LEVELS, default=logging.getLevelName(LOG_LEVEL), dest="log_level", help="日志级别(默认%s)" % logging.getLevelName(LOG_LEVEL))
+    parser.add_argument("--log-format", action="store", choices=LOG_FORMATS, default="text", dest="log_format", help="日志格式：text为文本，json为每行一条的JSON记录，包含请求接口、状态码、延迟、车牌号等结构化字段(默认text)")
+    parser.add_argument("--log-file", action="store", dest="log_file", help="日志文件路径(默认%s，多账号模式下位于各账号子目录)" % LOG_FILE)
+    parser.add_argument("--log-per-run", action="store_true", default=False, dest="log_per_run", help="每次运行写入单独的日志文件txffp_<启动时间>.log")
+    parser.add_argument("--processes", action="store", type=int, default=ACCOUNT_PROCESSES, dest="processes", help="多账号模式下同时执行的账号进程数(默认%s)" % ACCOUNT_PROCESSES)
+
+    options = parser.parse_args()
+    options.plates = parse_plates(options.plates)
+    options.run_id = time.strftime("%Y%m%d_%H%M%S")
+
+    def print_exit(text):
+        print(text)
+        sys.exit()
+
+    # 验证月份的合法性，查询索引时月份只用于过滤，可以不指定
+    months = None
+    if options.month or ((options.download or options.invoice) and not options.daemon):
+        try:
+            months = parse_months(options.month or "")
+        except MonthException as e:
+            print_exit(e)
+
+    if options.build_index or options.query is not None:
+        if not options.savedir and not (options.query is not None and options.index_file):
+            print_exit("你需要指定发票保存路径")
+        if options.savedir and not os.path.isdir(options.savedir):
+            print_exit("错误的目标路径")
+        if options.build_index:
+            index_invoices(options, options.savedir, create_logger(**log_options(options, BASE_DIR)))
+        else:
+            try:
+                query_invoices(options, months)
+            except TypeException as e:
+                print_exit(e)
+        return
+
+    if options.list_unknown_trades or options.release_trades:
+        if not os.path.isfile(options.ledger):
+            print_exit("任务账本不存在: %s" % options.ledger)
+        ledger = JobLedger(options.ledger)
+        try:
+            if options.list_unknown_trades:
+                list_unknown_trades(ledger, months)
+            else:
+                apply_ids = None
+                if options.release_trades != "all":
+                    apply_ids = [value.strip() for value in options.release_trades.split(",") if value.strip()]
+                print("已释放%s条交易，下次开票时会重新提交" % ledger.release_trades(apply_ids))
+        finally:
+            ledger.close()
+        return
+
+    if options.workers < 1:
+        print_exit("工作线程数至少为1")
+    if min(options.list_workers or 1, options.file_workers or 1, options.queue_size) < 1:
+        print_exit("流水线各阶段的线程数和队列长度至少为1")
+    if options.batch_size < 1:
+        print_exit("每批提交的交易数量至少为1")
+
+    # 判断路径信息是否存在
+    if options.download and not options.plan:
+        if not options.savedir:
+            print_exit("你需要指定一个保存路径")
+        else:
+            if not os.path.isdir(options.savedir):
+                print_exit("错误的目标路径")
+
+    if options.archive and (options.sync or options.index):
+        print_exit("归档输出模式不支持--sync和--index")
+
+    if options.daemon:
+        if not (options.download or options.invoice):
+            print_exit("守护模式需要与-d或-i一起使用")
+        if options.accounts:
+            print_exit("守护模式不支持多账号，请为每个账号分别启动")
+        if options.interval <= 0:
+            print_exit("同步间隔必须大于0")
+        if options.plan:
+            print_exit("守护模式不支持--plan")
+
+    if options.accounts:
+        if not os.path.exists(options.accounts):
+            print_exit("账号配置不存在: %s" % options.accounts)
+        if options.cardid:
+            print_exit("多账号模式不支持指定车辆编号")
+        run_accounts(options, months)
+        return
+
+    try:
+        cookie = load_cookie()
+    except OSError as e:
+        print_exit("读取cookie文件失败: %s" % e)
+
+    from .daemon import Daemon
+    from .workflows import execute
+
+    logger = create_logger(**log_options(options, BASE_DIR))
+    ledger = JobLedger(options.ledger)
+    sync = create_sync(options, options.savedir, logger)
+    archive = create_archive(options, options.savedir, logger=logger)
+    event_handler = create_handler(
+        options, cookie, logger=logger, ledger=ledger, cache=create_cache(options, BASE_DIR),
+        plate_index=PlateIndex(os.path.join(BASE_DIR, PLATE_INDEX_FILE)), sync=sync, archive=archive,
+        cookie_path=os.path.join(BASE_DIR, COOKIE_FILE))
+    # event_handler.set_max_page_num(12)
+    if event_handler.session_guard is not None and hasattr(signal, "SIGHUP"):
+        # 更新cookie.txt后可以发送SIGHUP立即继续，不必等待下一次检查
+        signal.signal(signal.SIGHUP, event_handler.session_guard.refresh)
+
+    try:
+        with instrument(event_handler, options, BASE_DIR, ledger):
+            if options.daemon:
+                daemon = Daemon(event_handler, options, options.savedir, options.email, options.interval)
+                signal.signal(signal.SIGTERM, daemon.stop)
+                signal.signal(signal.SIGINT, daemon.stop)
+                daemon.serve(options.control_port, options.control_socket)
+                daemon.run()
+            else:
+                cancel_on_interrupt(event_handler)
+                execute(event_handler, options, months, options.savedir, options.email)
+    except SessionExpiredException as e:
+        # 已完成的部分都记录在任务账本中，更新cookie后使用--resume继续
+        event_handler.logger.error("%s，已完成的任务可通过--resume跳过", e)
+        sys.exit("结束程序")
+    finally:
+        if archive is not None:
+            archive.close()
+        event_handler.logger.info(
+            "任务账本统计: %s", ledger.summary() if options.download else ledger.trade_summary())
+        ledger.close()
+        if sync is not None:
+            event_handler.logger.info("增量同步统计: %s", sync.stats())
+            sync.close()
+
+    event_handler.logger.info("连接复用统计: %s", event_handler.transport_stats())
+    if event_handler.cache is not None:
+        event_handler.logger.info("响应缓存统计: %s", event_handler.cache.stats())
+    event_handler.logger.info("任务完成")
+
+
+def main():
+    run()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""运行参数、站点信息和默认的文件名
+
+cookie不在导入时读取，由load_cookie在真正需要发出请求时读取。
+"""
+
+import logging
+import os
+
+
+BASE_DIR = os.path.dirname(os.path.abspath("__file__"))
+
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/66.0.3359.117 Safari/537.36",
+    "Host": "pss.txffp.com",
+    "Origin": "https://pss.txffp.com",
+}
+COOKIE_FILE = "cookie.txt"
+INVOICE_EMAIL = "Example@email.com"
+LOG_LEVEL = logging.INFO
+LOGGER_NAME = "txffp"
+LOG_FILE = "txffp.log"
+LOG_FORMATS = ("text", "json")
+LOG_LEVELS = ("DEBUG", "INFO", "WARNING", "ERROR")
+ACCOUNT_PROCESSES = 4
+POOL_SIZE = 10
+WORKERS = 1
+# 下载流水线各阶段之间队列的最大长度
+QUEUE_SIZE = 100
+MAX_RPS = 20
+INITIAL_RPS = 2
+MIN_RPS = 0.2
+SLOW_LATENCY = 5.0
+MAX_RETRIES = 3
+REQUEST_TIMEOUT = (10, 60)
+CHUNK_SIZE = 64 * 1024
+PART_SUFFIX = ".part"
+LEDGER_FILE = "txffp_ledger.db"
+# 每次开票提交的最大交易数量，多个分页的tradeid合并后按此大小分批
+APPLY_BATCH_SIZE = 100
+CACHE_DIR = ".txffp_cache"
+PLATE_INDEX_FILE = "txffp_plates.json"
+CACHE_MAX_BYTES = 200 * 1024 * 1024
+# 已结束月份的发票查询结果不会再变化，可以长期缓存；当月和卡片列表只短期缓存
+CACHE_TTL_CLOSED = 30 * 24 * 3600
+CACHE_TTL_OPEN = 10 * 60
+CACHE_TTL_CARDS = 6 * 3600
+SITE_URL = "https://pss.txffp.com/"
+REPORT_FILE = "txffp_report.json"
+METRICS_FILE = "txffp_metrics.prom"
+METRICS_INTERVAL = 60
+# 进度输出的间隔(秒)，以及计算速率和预计剩余时间时使用的时间窗口(秒)
+PROGRESS_INTERVAL = 5
+PROGRESS_WINDOW = 30
+PROFILE_FILE = "txffp.prof"
+INVOICE_INDEX_FILE = "txffp_invoices.db"
+MANIFEST_FILE = ".txffp_manifest.db"
+# cookie失效后等待cookie.txt更新的最长时间(秒)，以及检查文件的间隔(秒)
+SESSION_WAIT = 3600
+COOKIE_POLL_INTERVAL = 2
+# 守护模式的同步间隔(秒)，不短于当月发票查询结果的缓存时间
+DAEMON_INTERVAL = 900
+# 每月前几天同时同步上个月
+DAEMON_PREVIOUS_DAYS = 5
+
+
+def read_cookie(path):
+    """读取cookie文件内容"""
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+def load_cookie(path=None):
+    """读取当前目录下的cookie.txt(或指定的cookie文件)，文件不存在时抛出FileNotFoundError"""
+    return read_cookie(path or os.path.join(BASE_DIR, COOKIE_FILE))
+
+
+def __getattr__(name):
+    # 兼容以前的config.COOKIE用法，访问时才读取cookie文件
+    if name == "COOKIE":
+        return load_cookie()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""守护模式：定时同步和本地控制接口"""
+
+import datetime
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from .config import DAEMON_INTERVAL, DAEMON_PREVIOUS_DAYS
+from .exceptions import SessionExpiredException
+from .workflows import execute_download, execute_invoice
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    """守护模式的控制接口
+
+    GET /status 运行状态；GET /metrics Prometheus格式的指标；GET /report JSON运行报告；
+    POST /sync 立即执行一轮同步。
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        self.server.daemon.logger.debug("控制接口: " + format, *args)
+
+    def address_string(self):
+        # Unix socket的client_address为空字符串
+        return self.client_address[0] if self.client_address else "unix"
+
+    def send(self, body, status=200, content_type="application/json; charset=utf-8"):
+        if not isinstance(body, (str, bytes)):
+            body = json.dumps(body, ensure_ascii=False, indent=2)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        path = urlsplit(self.path).path
+        if path == "/status":
+            self.send(daemon.status())
+        elif path == "/metrics":
+            self.send(daemon.event_handler.metrics.prometheus(), content_type="text/plain; version=0.0.4")
+        elif path == "/report":
+            self.send(daemon.event_handler.metrics.snapshot())
+        else:
+            self.send({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        if urlsplit(self.path).path == "/sync":
+            self.server.daemon.trigger()
+            self.send({"triggered": True})
+        else:
+            self.send({"error": "not found"}, status=404)
+
+
+class ControlServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, daemon):
+        self.daemon = daemon
+        super(ControlServer, self).__init__(address, ControlHandler)
+
+
+class UnixControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, daemon):
+        self.daemon = daemon
+        if os.path.exists(path):
+            os.remove(path)
+        super(UnixControlServer, self).__init__(path, ControlHandler)
+
+
+class Daemon(object):
+    """常驻服务模式
+
+    进程内保持同一个APIHandler(会话、连接池、速率控制和缓存)，按固定间隔同步当月的发票：
+    下载时只下载新的发票，开票时只提交新的交易。每月前几天同时检查上个月，以免漏掉月底的发票。
+    可以通过本地HTTP端口或Unix socket触发同步、查看状态和指标。
+    """
+
+    def __init__(self, event_handler, options, savedir, email, interval=DAEMON_INTERVAL, logger=None):
+        self.event_handler = event_handler
+        self.options = options
+        self.savedir = savedir
+        self.email = email
+        self.interval = interval
+        self.logger = logger or event_handler.logger
+        self.__wakeup = threading.Event()
+        self.__stopping = threading.Event()
+        self.__lock = threading.Lock()
+        self.__servers = []
+        self.__state = {
+            "state": "starting",
+            "cycles": 0,
+            "months": [],
+            "last_started": None,
+            "last_finished": None,
+            "last_seconds": None,
+            "last_error": None,
+            "next_run": None,
+        }
+
+    def months(self, today=None):
+        """当月，以及每月前DAEMON_PREVIOUS_DAYS天内的上个月"""
+        today = today or datetime.date.today()
+        months = [today.strftime("%Y%m")]
+        if today.day <= DAEMON_PREVIOUS_DAYS:
+            months.insert(0, (today.replace(day=1) - datetime.timedelta(days=1)).strftime("%Y%m"))
+        return months
+
+    def trigger(self):
+        """立即执行一轮同步，正在同步时在本轮结束后再执行一轮"""
+        self.logger.info("收到同步请求")
+        self.__wakeup.set()
+
+    def stop(self, *args):
+        self.__stopping.set()
+        self.__wakeup.set()
+        # 暂停等待cookie的请求立即结束，不必等到--session-wait超时
+        if self.event_handler.session_guard is not None:
+            self.event_handler.session_guard.cancel()
+
+    def status(self):
+        with self.__lock:
+            status = dict(self.__state)
+        status["transport"] = self.event_handler.transport_stats()
+        if self.event_handler.ledger is not None:
+            status["invoices"] = self.event_handler.ledger.summary()
+            status["trades"] = self.event_handler.ledger.trade_summary()
+        if self.event_handler.sync is not None:
+            status["sync"] = self.event_handler.sync.stats()
+        return status
+
+    def __update(self, **state):
+        with self.__lock:
+            self.__state.update(state)
+
+    def __now(self):
+        return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def serve(self, port=None, socket_path=None, host="127.0.0.1"):
+        """启动控制接口"""
+        if port is not None:
+            server = ControlServer((host, port), self)
+            self.logger.info("控制接口: http://%s:%s/", *server.server_address[:2])
+            self.__servers.append(server)
+        if socket_path:
+            server = UnixControlServer(socket_path, self)
+            self.logger.info("控制接口: unix:%s", socket_path)
+            self.__servers.append(server)
+        for server in self.__servers:
+            threading.Thread(target=server.serve_forever, name="control", daemon=True).start()
+
+    def run(self):
+        """执行同步循环，直到收到SIGTERM/SIGINT"""
+        # 守护模式只处理新的发票和交易
+        self.event_handler.resume = True
+        self.logger.info("守护模式启动，同步间隔%s秒", self.interval)
+        try:
+            while not self.__stopping.is_set():
+                self.__wakeup.clear()
+                self.__cycle()
+                next_run = datetime.datetime.now() + datetime.timedelta(seconds=self.interval)
+                self.__update(state="idle", next_run=next_run.strftime("%Y-%m-%d %H:%M:%S"))
+                self.__wakeup.wait(self.interval)
+        finally:
+            for server in self.__servers:
+                server.shutdown()
+                server.server_close()
+                if isinstance(server, UnixControlServer) and os.path.exists(server.server_address):
+                    os.remove(server.server_address)
+            self.__update(state="stopped", next_run=None)
+            self.logger.info("守护模式已停止")
+
+    def __cycle(self):
+        months = self.months()
+        start = time.monotonic()
+        self.__update(state="running", months=months, last_started=self.__now())
+        self.logger.info("开始同步%s", months)
+        error = None
+        # 本轮同步的月份都还会开出新的发票，每张卡片都重新获取列表
+        self.event_handler.open_months = months
+        try:
+            if self.event_handler.session_guard is not None:
+                self.event_handler.session_guard.reset()
+            self.event_handler.check_session()
+            if self.options.invoice or self.options.auto_invoice:
+                execute_invoice(self.event_handler, self.options, months, self.email)
+            if self.options.download:
+                execute_download(self.event_handler, self.options, months, self.savedir)
+        except SessionExpiredException as e:
+            error = str(e)
+            if self.__stopping.is_set():
+                self.logger.warning("%s，本轮同步未完成", e)
+            else:
+                self.logger.error("%s，更新cookie后将在下一轮继续", e)
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+            self.logger.exception("同步失败")
+        finally:
+            self.event_handler.plate_index.save()
+            if self.event_handler.archive is not None:
+                self.event_handler.archive.close()
+        with self.__lock:
+            self.__state["cycles"] += 1
+        seconds = round(time.monotonic() - start, 1)
+        self.__update(last_finished=self.__now(), last_seconds=seconds, last_error=error)
+        self.logger.info("本轮同步结束，耗时%s秒", seconds)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""异常类型"""
+
+
+class TxffpException(Exception):
+    """本工具所有异常的基类"""
+    pass
+
+
+# 兼容旧名称，包级不导出，避免from txffp import *遮蔽内置的BaseException
+BaseException = TxffpException
+
+
+class TypeException(TxffpException):
+    pass
+
+
+class MonthException(TxffpException):
+    """月份格式错误"""
+    pass
+
+
+class SessionExpiredException(TxffpException):
+    """cookie失效或过期(站点返回404)"""
+    pass
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""已下载发票的本地索引"""
+
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .config import INVOICE_INDEX_FILE, LOGGER_NAME
+from .exceptions import TypeException
+
+
+class InvoiceIndex(object):
+    """已下载发票的本地SQLite索引
+
+    bundles表对应每个下载的zip，documents表对应zip中的每个发票文件。
+    按文件大小和修改时间判断zip是否需要重新索引，重复运行时只处理新增或变化的文件。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS bundles (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            plate TEXT,
+            datetime TEXT,
+            month TEXT,
+            amount REAL,
+            count INTEGER,
+            type TEXT,
+            error TEXT,
+            indexed_at TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS bundles_plate_month ON bundles (plate, month);
+        CREATE TABLE IF NOT EXISTS documents (
+            bundle_path TEXT NOT NULL,
+            name TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            invoice_code TEXT,
+            invoice_number TEXT,
+            issue_date TEXT,
+            amount TEXT,
+            tax TEXT,
+            total TEXT,
+            seller TEXT,
+            buyer TEXT,
+            meta TEXT,
+            error TEXT,
+            PRIMARY KEY (bundle_path, name)
+        );
+    """
+    GROUPS = ("plate", "month", "type")
+    DOCUMENT_FIELDS = ("invoice_code", "invoice_number", "issue_date", "amount", "tax", "total", "seller", "buyer")
+
+    def __init__(self, path):
+        self.path = path
+        self.__conn = sqlite3.connect(path, isolation_level=None)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.executescript(self.SCHEMA)
+
+    def pending(self, paths):
+        """返回尚未索引或自上次索引后发生变化的zip路径"""
+        indexed = dict((row[0], (row[1], row[2])) for row in
+                       self.__conn.execute("SELECT path, size, mtime FROM bundles"))
+        pending = []
+        for path in paths:
+            stat = os.stat(path)
+            if indexed.get(path) != (stat.st_size, stat.st_mtime):
+                pending.append(path)
+        return pending
+
+    def add(self, bundle, documents):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.__conn:
+            self.__conn.execute("BEGIN")
+            self.__conn.execute("DELETE FROM documents WHERE bundle_path = ?", (bundle["path"],))
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO bundles (path, size, mtime, plate, datetime, month, amount, count, type, "
+                "error, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (bundle["path"], bundle["size"], bundle["mtime"], bundle.get("plate"), bundle.get("datetime"),
+                 bundle.get("month"), bundle.get("amount"), bundle.get("count"), bundle.get("type"),
+                 bundle["error"], now))
+            self.__conn.executemany(
+                "INSERT OR REPLACE INTO documents (bundle_path, name, kind, %s, meta, error) "
+                "VALUES (?, ?, ?, %s, ?, ?)" % (", ".join(self.DOCUMENT_FIELDS),
+                                                ", ".join("?" * len(self.DOCUMENT_FIELDS))),
+                [(bundle["path"], doc["name"], doc["kind"]) +
+                 tuple(doc.get(field) for field in self.DOCUMENT_FIELDS) +
+                 (json.dumps(doc["meta"], ensure_ascii=False) if doc.get("meta") else None, doc.get("error"))
+                 for doc in documents])
+
+    def prune(self, paths):
+        """删除已经不在磁盘上的zip的索引记录"""
+        existing = set(paths)
+        removed = [row[0] for row in self.__conn.execute("SELECT path FROM bundles") if row[0] not in existing]
+        with self.__conn:
+            self.__conn.execute("BEGIN")
+            for path in removed:
+                self.__conn.execute("DELETE FROM bundles WHERE path = ?", (path,))
+                self.__conn.execute("DELETE FROM documents WHERE bundle_path = ?", (path,))
+        return len(removed)
+
+    def totals(self, groups=GROUPS, plates=None, months=None):
+        """按车牌号、月份、类型的任意组合汇总，返回[(分组值..., zip数, 发票数, 金额)]
+
+        plates支持通配符，months为月份列表。
+        """
+        for group in groups:
+            if group not in self.GROUPS:
+                raise TypeException("不支持的汇总字段: %s" % group)
+        where = []
+        params = []
+        if plates:
+            where.append("(%s)" % " OR ".join("plate GLOB ?" for _ in plates))
+            params.extend(plates)
+        if months:
+            where.append("month IN (%s)" % ", ".join("?" * len(months)))
+            params.extend(months)
+        columns = ", ".join(groups)
+        sql = "SELECT %s COUNT(*), SUM(count), ROUND(SUM(amount), 2) FROM bundles %s %s %s" % (
+            columns + "," if columns else "",
+            "WHERE " + " AND ".join(where) if where else "",
+            "GROUP BY " + columns if columns else "",
+            "ORDER BY " + columns if columns else "")
+        return self.__conn.execute(sql, params).fetchall()
+
+    def close(self):
+        self.__conn.close()
+
+
+def build_invoice_index(save_dir, index, processes=None, logger=None):
+    """增量索引保存目录中的发票zip，返回本次索引的文件数量"""
+    logger = logger or logging.getLogger(LOGGER_NAME)
+    # 记录使用绝对路径，相对路径和绝对路径指定同一目录时不会重新索引
+    save_dir = os.path.abspath(save_dir)
+    paths = []
+    for root, dirs, files in os.walk(save_dir):
+        paths.extend(os.path.join(root, name) for name in files if name.endswith(".zip"))
+    removed = index.prune(paths)
+    pending = index.pending(paths)
+    logger.info("共%s个发票文件，需要索引%s个，移除%s条失效记录", len(paths), len(pending), removed)
+    if not pending:
+        return 0
+
+    # 解析器依赖lxml，只在确实有文件需要索引时才导入
+    from .parsers import parse_bundle
+
+    start = time.monotonic()
+    if processes == 1 or len(pending) == 1:
+        for bundle, documents in map(parse_bundle, pending):
+            index.add(bundle, documents)
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for bundle, documents in pool.map(parse_bundle, pending, chunksize=16):
+                index.add(bundle, documents)
+    logger.info("发票索引完成，共%s个文件，耗时%.1f秒", len(pending), time.monotonic() - start)
+    return len(pending)
+
+
+def index_invoices(options, savedir, logger=None):
+    """增量索引保存目录中已下载的发票"""
+    index = InvoiceIndex(options.index_file or os.path.join(savedir, INVOICE_INDEX_FILE))
+    try:
+        return build_invoice_index(savedir, index, options.index_processes, logger)
+    finally:
+        index.close()
+
+
+def query_invoices(options, months):
+    """按--query指定的字段汇总发票索引并输出"""
+    groups = [group.strip() for group in options.query.split(",") if group.strip()]
+    index = InvoiceIndex(options.index_file or os.path.join(options.savedir, INVOICE_INDEX_FILE))
+    try:
+        rows = index.totals(groups, options.plates, months)
+    finally:
+        index.close()
+
+    titles = {"plate": "车牌号", "month": "月份", "type": "类型"}
+    print("\t".join([titles[group] for group in groups] + ["文件数", "发票数", "金额"]))
+    files = count = amount = 0
+    for row in rows:
+        print("\t".join("%s" % ("" if value is None else value) for value in row))
+        files += row[-3] or 0
+        count += row[-2] or 0
+        amount += row[-1] or 0
+    if groups:
+        print("\t".join(["合计"] + [""] * (len(groups) - 1) + [str(files), str(count), "%.2f" % amount]))
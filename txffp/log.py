@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""日志：后台线程写入的控制台/滚动文件日志，支持文本和JSON格式"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+from .config import BASE_DIR, LOG_FILE, LOG_LEVEL, LOGGER_NAME
+
+
+class QueueLogHandler(logging.handlers.QueueHandler):
+    """只把日志记录放入队列，消息的格式化和写文件都在后台线程中完成
+
+    标准的QueueHandler会在调用线程中先格式化消息，这里保留原始的msg和args，
+    工作线程记录一条日志只需要一次入队操作。
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class JsonFormatter(logging.Formatter):
+    """把日志记录格式化为单行JSON，通过extra传入的字段作为同名的键输出"""
+
+    RESERVED = frozenset(logging.LogRecord("", 0, "", 0, "", None, None).__dict__) | {"message", "asctime"}
+
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self.RESERVED:
+                data[key] = value
+        if record.exc_info:
+            data["exception"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+# 各logger对应的后台日志线程
+_log_listeners = {}
+
+
+def create_logger(name=LOGGER_NAME, log_file=None, level=LOG_LEVEL, fmt="text"):
+    """创建具名logger，同时输出到控制台和滚动日志文件
+
+    handler只在第一次创建时添加，同一进程内创建多个handler或多次调用不会重复输出日志。
+    logger本身只有一个QueueLogHandler，控制台输出、文件写入和日志滚动都由后台的QueueListener线程执行；
+    fmt为json时每条日志输出为一行JSON。
+    """
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.propagate = False
+    if logger.handlers:
+        return logger
+
+    ch = logging.StreamHandler()
+
+    fh = logging.handlers.RotatingFileHandler(
+            log_file or os.path.join(BASE_DIR, LOG_FILE),
+            maxBytes=1024 * 1024 * 1,
+            backupCount=5,
+            encoding="utf-8"
+        )
+
+    if fmt == "json":
+        formatter = JsonFormatter(datefmt="%Y-%m-%d %H:%M:%S")
+    else:
+        if name == LOGGER_NAME:
+            fmt = "%(asctime)s %(levelname)s: %(message)s"
+        else:
+            # 多账号运行时在日志中标明账号
+            fmt = "%(asctime)s %(levelname)s [%(name)s]: %(message)s"
+        formatter = logging.Formatter(fmt, "%Y-%m-%d %H:%M:%S")
+
+    ch.setFormatter(formatter)
+    fh.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, ch, fh)
+    listener.start()
+    _log_listeners[name] = listener
+    logger.addHandler(QueueLogHandler(log_queue))
+
+    return logger
+
+
+def stop_logger(name=LOGGER_NAME):
+    """写出队列中剩余的日志并停止后台日志线程，之后再次create_logger会重新创建"""
+    listener = _log_listeners.pop(name, None)
+    if listener is None:
+        return
+    logger = logging.getLogger(name)
+    for handler in list(logger.handlers):
+        if isinstance(handler, QueueLogHandler):
+            logger.removeHandler(handler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+
+@atexit.register
+def stop_loggers():
+    for name in list(_log_listeners):
+        stop_logger(name)
+
+
+def log_options(options, log_dir, per_account=False):
+    """根据命令行参数返回create_logger的日志文件、级别和格式参数
+
+    --log-per-run时每次运行写入一个以启动时间命名的日志文件；
+    多账号模式下各账号的日志文件使用--log-file的文件名，位于账号子目录中。
+    """
+    if options.log_file:
+        log_file = os.path.join(log_dir, os.path.basename(options.log_file)) if per_account else options.log_file
+    elif options.log_per_run:
+        log_file = os.path.join(log_dir, "txffp_%s.log" % options.run_id)
+    else:
+        log_file = os.path.join(log_dir, LOG_FILE)
+    level = logging.DEBUG if options.verbose else getattr(logging, options.log_level)
+    return {"log_file": log_file, "level": level, "fmt": options.log_format}
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""运行指标、指标导出和调用栈采样"""
+
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from .config import LOGGER_NAME, PROGRESS_INTERVAL, PROGRESS_WINDOW
+
+
+class Metrics(object):
+    """请求级别的运行指标
+
+    按接口记录请求数(按状态码)、延迟直方图、传输字节数、重试次数、错误类型和缓存命中，
+    按阶段记录页面解析耗时。所有方法都是线程安全的，内存占用与请求数量无关。
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.started_at = time.time()
+        self.endpoints = {}
+        self.parse = {}
+
+    def __endpoint(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = {
+                "requests": {}, "errors": {}, "retries": 0, "cache_hits": 0, "bytes": 0,
+                "latency_sum": 0.0, "latency_buckets": [0] * len(self.BUCKETS),
+            }
+        return stats
+
+    def request(self, endpoint, status, latency, nbytes=0):
+        """记录一次得到响应的请求，latency为秒"""
+        with self.__lock:
+            stats = self.__endpoint(endpoint)
+            stats["requests"][str(status)] = stats["requests"].get(str(status), 0) + 1
+            stats["bytes"] += nbytes
+            stats["latency_sum"] += latency
+            for i, bound in enumerate(self.BUCKETS):
+                if latency <= bound:
+                    stats["latency_buckets"][i] += 1
+                    break
+
+    def error(self, endpoint, error):
+        """记录一次错误，error为异常类名或http_状态码等错误类型"""
+        with self.__lock:
+            errors = self.__endpoint(endpoint)["errors"]
+            errors[error] = errors.get(error, 0) + 1
+
+    def retry(self, endpoint):
+        with self.__lock:
+            self.__endpoint(endpoint)["retries"] += 1
+
+    def cache_hit(self, endpoint):
+        with self.__lock:
+            self.__endpoint(endpoint)["cache_hits"] += 1
+
+    def add_bytes(self, endpoint, nbytes):
+        with self.__lock:
+            self.__endpoint(endpoint)["bytes"] += nbytes
+
+    @contextlib.contextmanager
+    def timed(self, stage):
+        """统计代码块的耗时，用于页面解析等本地处理阶段"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.__lock:
+                stats = self.parse.setdefault(stage, {"count": 0, "seconds": 0.0})
+                stats["count"] += 1
+                stats["seconds"] += elapsed
+
+    def __quantile(self, buckets, q):
+        """根据直方图估算分位数，返回所在区间的上界"""
+        total = sum(buckets)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for bound, count in zip(self.BUCKETS, buckets):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float("inf") else self.BUCKETS[-2]
+        return self.BUCKETS[-2]
+
+    def snapshot(self):
+        """返回可序列化为JSON的指标快照"""
+        with self.__lock:
+            endpoints = json.loads(json.dumps(self.endpoints, default=str))
+            parse = json.loads(json.dumps(self.parse))
+        for stats in endpoints.values():
+            buckets = stats.pop("latency_buckets")
+            count = sum(buckets)
+            stats["latency"] = {
+                "count": count,
+                "mean": round(stats.pop("latency_sum") / count, 4) if count else 0.0,
+                "p50": self.__quantile(buckets, 0.5),
+                "p90": self.__quantile(buckets, 0.9),
+                "p99": self.__quantile(buckets, 0.99),
+                "buckets": dict(("+Inf" if b == float("inf") else str(b), n) for b, n in zip(self.BUCKETS, buckets)),
+            }
+        for stats in parse.values():
+            stats["seconds"] = round(stats["seconds"], 4)
+        return {
+            "started_at": datetime.datetime.fromtimestamp(self.started_at).strftime("%Y-%m-%d %H:%M:%S"),
+            "elapsed_seconds": round(time.time() - self.started_at, 3),
+            "endpoints": endpoints,
+            "parse": parse,
+        }
+
+    def prometheus(self, prefix="txffp"):
+        """返回Prometheus textfile格式的指标"""
+        with self.__lock:
+            endpoints = json.loads(json.dumps(self.endpoints, default=str))
+            parse = json.loads(json.dumps(self.parse))
+
+        def label(**labels):
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                                     for k, v in sorted(labels.items()))
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+            for suffix, labels, value in samples:
+                lines.append("%s_%s%s%s %s" % (prefix, name, suffix, label(**labels), value))
+
+        metric("requests_total", "counter", "Requests by endpoint and HTTP status.", [
+            ("", {"endpoint": e, "status": status}, n)
+            for e, s in sorted(endpoints.items()) for status, n in sorted(s["requests"].items())])
+        samples = []
+        for e, s in sorted(endpoints.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, s["latency_buckets"]):
+                cumulative += count
+                samples.append(("_bucket", {"endpoint": e, "le": "+Inf" if bound == float("inf") else bound},
+                                cumulative))
+            samples.append(("_sum", {"endpoint": e}, round(s["latency_sum"], 6)))
+            samples.append(("_count", {"endpoint": e}, cumulative))
+        metric("request_duration_seconds", "histogram", "Request latency by endpoint.", samples)
+        metric("response_bytes_total", "counter", "Response bytes received by endpoint.", [
+            ("", {"endpoint": e}, s["bytes"]) for e, s in sorted(endpoints.items())])
+        metric("retries_total", "counter", "Retried requests by endpoint.", [
+            ("", {"endpoint": e}, s["retries"]) for e, s in sorted(endpoints.items())])
+        metric("cache_hits_total", "counter", "Responses served from the local cache.", [
+            ("", {"endpoint": e}, s["cache_hits"]) for e, s in sorted(endpoints.items())])
+        metric("errors_total", "counter", "Errors by endpoint and error class.", [
+            ("", {"endpoint": e, "error": error}, n)
+            for e, s in sorted(endpoints.items()) for error, n in sorted(s["errors"].items())])
+        metric("parse_seconds_total", "counter", "Time spent parsing pages by stage.", [
+            ("", {"stage": stage}, round(s["seconds"], 6)) for stage, s in sorted(parse.items())])
+        metric("parse_total", "counter", "Parsed pages by stage.", [
+            ("", {"stage": stage}, s["count"]) for stage, s in sorted(parse.items())])
+        metric("run_elapsed_seconds", "gauge", "Seconds since the run started.", [
+            ("", {}, round(time.time() - self.started_at, 3))])
+        return "\n".join(lines) + "\n"
+
+
+def format_seconds(seconds):
+    """把秒数格式化为H:MM:SS"""
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def format_bytes(nbytes):
+    """把字节数格式化为B/KB/MB/GB"""
+    if nbytes < 1024:
+        return "%dB" % nbytes
+    for unit in ("KB", "MB", "GB"):
+        nbytes /= 1024.0
+        if nbytes < 1024 or unit == "GB":
+            return "%.1f%s" % (nbytes, unit)
+
+
+class Progress(object):
+    """任务进度：工作总量、完成数量、失败数量和传输字节数
+
+    下载时的工作单位是发票文件，开票时是交易(tradeid)。总量随着列表翻页逐步增加，
+    listing大于0表示还有(卡片, 月份)的列表没有翻完，此时的总量只是下限。
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.bytes = 0
+        self.listing = 0
+
+    def start_listing(self):
+        with self.__lock:
+            self.listing += 1
+
+    def finish_listing(self):
+        with self.__lock:
+            self.listing -= 1
+
+    def add_total(self, count=1):
+        with self.__lock:
+            self.total += count
+
+    def advance(self, ok=True, count=1):
+        with self.__lock:
+            self.done += count
+            if not ok:
+                self.failed += count
+
+    def add_bytes(self, nbytes):
+        with self.__lock:
+            self.bytes += nbytes
+
+    def snapshot(self):
+        with self.__lock:
+            return {
+                "total": self.total,
+                "done": self.done,
+                "failed": self.failed,
+                "bytes": self.bytes,
+                "listing": self.listing > 0,
+                "elapsed_seconds": round(time.monotonic() - self.started_at, 1),
+            }
+
+
+class ProgressDisplay(object):
+    """定期输出任务进度：完成数量、每秒完成数、每秒字节数和预计剩余时间
+
+    每interval秒写一条日志，与其他日志一起输出到控制台和日志文件。速率按最近window秒内的变化计算，
+    下载停滞时速率会很快降为0，不会被之前的平均速率掩盖。
+    """
+
+    def __init__(self, progress, interval=PROGRESS_INTERVAL, window=PROGRESS_WINDOW, logger=None):
+        self.progress = progress
+        self.interval = interval
+        self.window = window
+        self.logger = logger or logging.getLogger(LOGGER_NAME)
+        self.__samples = collections.deque()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        if self.interval > 0:
+            self.__thread = threading.Thread(target=self.__loop, name="progress", daemon=True)
+            self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is None:
+            return
+        self.__thread.join()
+        self.__show()
+
+    def __loop(self):
+        while not self.__stop.wait(self.interval):
+            self.__show()
+
+    def line(self):
+        """返回当前进度的一行描述，同时记录一个速率采样点"""
+        snapshot = self.progress.snapshot()
+        now = time.monotonic()
+        self.__samples.append((now, snapshot["done"], snapshot["bytes"]))
+        while len(self.__samples) > 2 and now - self.__samples[1][0] >= self.window:
+            self.__samples.popleft()
+        start, done, nbytes = self.__samples[0]
+        if now - start < 0.001:
+            start, done, nbytes = self.progress.started_at, 0, 0
+        seconds = max(now - start, 0.001)
+        rate = (snapshot["done"] - done) / seconds
+        byte_rate = (snapshot["bytes"] - nbytes) / seconds
+
+        total, finished = snapshot["total"], snapshot["done"]
+        remaining = total - finished
+        if remaining <= 0 and not snapshot["listing"]:
+            eta = "0:00:00"
+        elif rate > 0:
+            eta = format_seconds(remaining / rate) + ("+" if snapshot["listing"] else "")
+        else:
+            eta = "未知"
+        percent = " (%.0f%%)" % (finished * 100.0 / total) if total else ""
+        return "进度: %s/%s%s%s 失败%s | %.1f个/秒 %s/秒 | 已用%s 预计剩余%s" % (
+            finished, total, "+" if snapshot["listing"] else "", percent, snapshot["failed"],
+            rate, format_bytes(byte_rate), format_seconds(now - self.progress.started_at), eta)
+
+    def __show(self):
+        try:
+            self.logger.info(self.line(), extra={"event": "progress"})
+        except Exception as e:
+            self.logger.warning("输出进度失败: %s: %s", type(e).__name__, e)
+
+
+class MetricsReporter(object):
+    """定期把运行指标写入JSON报告和Prometheus textfile
+
+    extra为返回附加信息(连接复用、任务账本等)的函数，附加信息只写入JSON报告。
+    interval为0时只在stop()时写入一次。
+    """
+
+    def __init__(self, metrics, report_path=None, prom_path=None, interval=0, extra=None, logger=None):
+        self.metrics = metrics
+        self.report_path = report_path
+        self.prom_path = prom_path
+        self.interval = interval
+        self.extra = extra
+        self.logger = logger or logging.getLogger(LOGGER_NAME)
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        if self.interval > 0:
+            self.__thread = threading.Thread(target=self.__loop, name="metrics", daemon=True)
+            self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        self.write()
+
+    def __loop(self):
+        while not self.__stop.wait(self.interval):
+            self.write()
+
+    def write(self):
+        try:
+            if self.report_path:
+                report = self.metrics.snapshot()
+                if self.extra is not None:
+                    report.update(self.extra())
+                self.__write_atomic(self.report_path, json.dumps(report, ensure_ascii=False, indent=2))
+            if self.prom_path:
+                self.__write_atomic(self.prom_path, self.metrics.prometheus())
+        except Exception as e:
+            self.logger.warning("写入运行指标失败: %s: %s", type(e).__name__, e)
+
+    @staticmethod
+    def __write_atomic(path, text):
+        # node_exporter等采集程序可能随时读取，先写临时文件再替换
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+
+class StackSampler(object):
+    """定时采样所有线程的调用栈，输出flamegraph.pl可用的折叠栈格式
+
+    cProfile只能统计启用它的线程，工作线程中的耗时通过采样补充。
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = {}
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__loop, name="sampler", daemon=True)
+        self.__thread.start()
+        return self
+
+    def stop(self):
+        self.__stop.set()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def __loop(self):
+        own = threading.get_ident()
+        while not self.__stop.wait(self.interval):
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(re.sub(r"_\d+$", "", names.get(ident, "thread")))
+                key = ";".join(reversed(stack))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def write(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in sorted(self.samples.items(), key=lambda item: -item[1]):
+                f.write("%s %s\n" % (stack, count))
@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+"""月份参数的解析"""
+
+import re
+
+from .exceptions import MonthException
+
+
+MONTH_RE = re.compile(r"^20[0-3]\d(0[1-9]|1[0-2])$")
+
+
+def parse_months(text):
+    """解析月份参数，返回按时间排序且去重的月份列表
+
+    支持单个月份(201804)、区间(201801-201812)以及逗号分隔的组合(201801-201803,201806)。
+    """
+    months = set()
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        start, _, end = item.partition("-")
+        end = end or start
+        for month in (start, end):
+            if not MONTH_RE.match(month):
+                raise MonthException("月份信息格式错误: %s" % month)
+        if start > end:
+            raise MonthException("月份区间起始月份晚于结束月份: %s" % item)
+        year, mon = int(start[:4]), int(start[4:])
+        while "%04d%02d" % (year, mon) <= end:
+            months.add("%04d%02d" % (year, mon))
+            year, mon = (year + 1, 1) if mon == 12 else (year, mon + 1)
+    if not months:
+        raise MonthException("未指定月份")
+    return sorted(months)
+
+
+def as_months(month):
+    """接受单个月份、月份表达式或月份列表，统一返回月份列表"""
+    if isinstance(month, (list, tuple)):
+        return list(month)
+    return parse_months(month)
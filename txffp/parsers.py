@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""站点页面和发票文件(XML/OFD/PDF)的解析"""
+
+import io
+import os
+import re
+import zipfile
+
+from lxml import etree
+
+from .config import SITE_URL
+from .records import ApplyInfo, Card, Invoice, TradeId
+
+
+# 页面解析使用的预编译XPath和正则表达式
+XP_HAS_MORE = etree.XPath('//label[@id="taiji_search_hasMore"]/text()')
+XP_TOTAL_PAGE = etree.XPath('//label[@id="taiji_search_totalPage"]/text()')
+XP_CARDS = etree.XPath("//dl[@class='etc_card_dl']/div/a")
+XP_CARD_PLATE = etree.XPath("./dd[2]/text()")
+XP_INVOICES = etree.XPath("//table[@class='table_wdfp']")
+XP_INV_DATETIME = etree.XPath("./tr[1]/td/table/tr[1]/th[1]/text()")
+XP_INV_AMOUNT = etree.XPath("./tr[1]/td/table/tr[1]/th[2]/span/text()")
+XP_INV_TYPE = etree.XPath("./tr[1]/td/table/tr[1]/th[3]/text()")
+XP_INV_DWLINK = etree.XPath("./tr[1]/td/table/tr/th[4]/a[2]")
+XP_INV_COUNT = etree.XPath("./tr[2]/td/table/tr/td[3]/span/text()")
+XP_TRADEIDS = etree.XPath('//tr/td[@class="tab_tr_td10"]/input[@class="check_one"]')
+XP_APPLY_INPUTS = etree.XPath("//form[@id='checkForm']/input[@id='applyId' or @id='id' or @id='userType']")
+RE_AMOUNT = re.compile(r"[^\d\.]*([\d\.]*)")
+RE_ONCLICK_ID = re.compile(r"[^(]*\('([\w]*)'\)")
+RE_PLATE = re.compile("[^:]*：(.*)")
+RE_TRADEID = re.compile(r"[^_]*")
+
+
+class Page(object):
+    """只解析一次的响应页面，所有字段都通过预编译的XPath提取"""
+    __slots__ = ("doc",)
+
+    def __init__(self, html):
+        self.doc = etree.HTML(html)
+
+    def has_more(self):
+        """判断是否存在下一页，返回True或者False"""
+        has_more = XP_HAS_MORE(self.doc)
+        return bool(has_more) and has_more[0] == "true"
+
+    def searchable(self):
+        """页面中是否有分页标签，cookie失效后站点返回的登录页面中没有"""
+        return bool(XP_HAS_MORE(self.doc))
+
+    def total_pages(self):
+        """读取taiji_search_totalPage标签中的总页数，页面未提供时返回None"""
+        total_page = XP_TOTAL_PAGE(self.doc)
+        if total_page and total_page[0].strip().isdigit():
+            return int(total_page[0].strip())
+        return None
+
+    def query_cards(self):
+        """发票查询页面的卡片列表，id取自链接地址"""
+        return [
+            Card(a.get("href")[40:-8], XP_CARD_PLATE(a)[0].strip()[-7:])
+            for a in XP_CARDS(self.doc)
+        ]
+
+    def cards(self):
+        """开票页面的卡片列表，id取自onclick事件"""
+        return [
+            Card(RE_ONCLICK_ID.match(a.get("onclick")).group(1), RE_PLATE.match(XP_CARD_PLATE(a)[0]).group(1))
+            for a in XP_CARDS(self.doc)
+        ]
+
+    def invoices(self, site_url=SITE_URL):
+        invoices = []
+        for inv in XP_INVOICES(self.doc):
+            invoices.append(Invoice(
+                XP_INV_DATETIME(inv)[0][7:],
+                XP_INV_TYPE(inv)[0],
+                XP_INV_COUNT(inv)[0],
+                RE_AMOUNT.match(XP_INV_AMOUNT(inv)[0]).group(1),
+                os.path.join(site_url, XP_INV_DWLINK(inv)[0].get("href")[1:]),
+            ))
+        return invoices
+
+    def trade_ids(self):
+        trade_ids = []
+        for checkbox in XP_TRADEIDS(self.doc):
+            raw = checkbox.get("value")
+            id = RE_TRADEID.match(raw).group() if raw else ""
+            if id:
+                trade_ids.append(TradeId(id, raw))
+        return trade_ids
+
+    def apply_info(self):
+        values = {}
+        for input_ in XP_APPLY_INPUTS(self.doc):
+            values.setdefault(input_.get("id"), input_.get("value") or "")
+        return ApplyInfo(values.get("applyId", ""), values.get("id", ""), values.get("userType", ""))
+
+
+RE_BUNDLE_NAME = re.compile(
+    r"^(?P<plate>.+?)_(?P<date>\d{8})_(?P<time>\d{4})_金额(?P<amount>[\d.]*)_数量(?P<count>\d*)_(?P<type>.+)\.zip$")
+RE_PDF_INFO = re.compile(rb"/(Title|Subject|Keywords|Author|Creator|Producer|CreationDate)\s*\(((?:\\.|[^\\)])*)\)")
+
+# 电子发票XML/OFD中各字段可能使用的标签名或自定义数据名称
+INVOICE_FIELDS = {
+    "invoice_code": ("InvoiceCode", "发票代码", "Fpdm", "FPDM"),
+    "invoice_number": ("InvoiceNumber", "InvoiceNo", "发票号码", "Fphm", "FPHM"),
+    "issue_date": ("IssueDate", "IssueTime", "开票日期", "开具日期", "Kprq", "KPRQ"),
+    "amount": ("TotalAmount", "TotalAmWithoutTax", "合计金额", "Hjje", "HJJE"),
+    "tax": ("TotalTax", "TotalTaxAm", "合计税额", "Hjse", "HJSE"),
+    "total": ("TotalTax-includedAmount", "TotalAmountWithTax", "价税合计", "Jshj", "JSHJ"),
+    "seller": ("SellerName", "销售方名称", "Xfmc", "XFMC"),
+    "buyer": ("BuyerName", "购买方名称", "Gfmc", "GFMC"),
+}
+FIELD_BY_NAME = dict((name, field) for field, names in INVOICE_FIELDS.items() for name in names)
+
+
+def parse_invoice_xml(data):
+    """从电子发票XML中按标签名提取字段，返回字段字典"""
+    fields = {}
+    root = etree.fromstring(data, etree.XMLParser(recover=True, resolve_entities=False))
+    if root is None:
+        return fields
+    for element in root.iter():
+        if not isinstance(element.tag, str):
+            continue
+        field = FIELD_BY_NAME.get(etree.QName(element).localname)
+        if field and field not in fields and element.text and element.text.strip():
+            fields[field] = element.text.strip()
+    return fields
+
+
+def parse_invoice_ofd(data):
+    """OFD是zip容器，字段取自OFD.xml的CustomData以及其中各XML文件的同名标签"""
+    fields = {}
+    with zipfile.ZipFile(io.BytesIO(data)) as ofd:
+        for name in ofd.namelist():
+            if not name.lower().endswith(".xml"):
+                continue
+            root = etree.fromstring(ofd.read(name), etree.XMLParser(recover=True, resolve_entities=False))
+            if root is None:
+                continue
+            for element in root.iter():
+                if not isinstance(element.tag, str):
+                    continue
+                key = element.get("Name") if etree.QName(element).localname == "CustomData" \
+                    else etree.QName(element).localname
+                field = FIELD_BY_NAME.get(key)
+                if field and field not in fields and element.text and element.text.strip():
+                    fields[field] = element.text.strip()
+    return fields
+
+
+def parse_invoice_pdf(data):
+    """只读取PDF文档信息字典中未压缩的元数据，发票正文需要PDF解析库，不在此处理"""
+    meta = {}
+    for key, value in RE_PDF_INFO.findall(data[-64 * 1024:]):
+        meta.setdefault(key.decode("ascii").lower(), value.decode("latin-1"))
+    return {"meta": meta} if meta else {}
+
+
+INVOICE_PARSERS = {
+    ".xml": parse_invoice_xml,
+    ".ofd": parse_invoice_ofd,
+    ".pdf": parse_invoice_pdf,
+}
+
+
+def parse_bundle(path):
+    """解析一个下载的发票zip，返回(bundle, documents)，在进程池中执行
+
+    bundle中的车牌号、开票时间、金额、数量和类型取自文件名(即站点发票列表中的数据)，
+    documents为zip中每个发票文件解析得到的字段。
+    """
+    stat = os.stat(path)
+    match = RE_BUNDLE_NAME.match(os.path.basename(path))
+    bundle = {"path": path, "size": stat.st_size, "mtime": stat.st_mtime, "error": None}
+    if match:
+        bundle.update(
+            plate=match.group("plate"),
+            datetime="%s %s" % (match.group("date"), match.group("time")),
+            month=match.group("date")[:6],
+            amount=float(match.group("amount") or 0),
+            count=int(match.group("count") or 0),
+            type=match.group("type"),
+        )
+    documents = []
+    try:
+        with zipfile.ZipFile(path) as bundle_zip:
+            for name in bundle_zip.namelist():
+                parser = INVOICE_PARSERS.get(os.path.splitext(name)[1].lower())
+                if parser is None:
+                    continue
+                document = {"name": name, "kind": os.path.splitext(name)[1][1:].lower()}
+                try:
+                    document.update(parser(bundle_zip.read(name)))
+                except Exception as e:
+                    document["error"] = "%s: %s" % (type(e).__name__, e)
+                documents.append(document)
+    except (zipfile.BadZipFile, OSError) as e:
+        bundle["error"] = "%s: %s" % (type(e).__name__, e)
+    return bundle, documents
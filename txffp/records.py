@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""解析结果和下载结果的记录类型"""
+
+
+class Record(object):
+    """轻量的只读记录基类，子类通过__slots__声明字段"""
+    __slots__ = ()
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def __iter__(self):
+        # 支持 id, car_num = card 这样的解包
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __hash__(self):
+        return hash(tuple(self))
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % (name, getattr(self, name)) for name in self.__slots__))
+
+    def as_dict(self):
+        return dict(zip(self.__slots__, self))
+
+
+class Card(Record):
+    """卡片信息：站点内部的卡片id及车牌号"""
+    __slots__ = ("id", "car_num")
+
+
+def as_card(card):
+    """接受Card或卡片id，统一返回Card；只有卡片id时以id代替车牌号"""
+    if isinstance(card, Card):
+        return card
+    return Card(card, card)
+
+
+class Invoice(Record):
+    """发票查询结果中的一条发票"""
+    __slots__ = ("datetime", "type", "count", "amount", "dwurl")
+
+
+class TradeId(Record):
+    """待开票的交易记录，raw为复选框的原始值"""
+    __slots__ = ("id", "raw")
+
+
+class ApplyInfo(Record):
+    """开票申请页面中的(apply_id, id, user_type)"""
+    __slots__ = ("apply_id", "id", "user_type")
+
+
+class Download(Record):
+    """下载完成的文件：保存路径、文件大小和sha256"""
+    __slots__ = ("path", "size", "sha256")
+
+
+class Estimate(Record):
+    """计划模式下一个(卡片, 月份)的工作量估算
+
+    只请求了列表的第一页：exact为True时只有一页，pages和items是准确值；
+    否则按页面上的总页数估算，页面没有提供总页数时为下限。done表示任务账本中已全部完成。
+    """
+    __slots__ = ("card", "month", "pages", "items", "exact", "done")
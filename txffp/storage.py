@@ -0,0 +1,684 @@
+# -*- coding: utf-8 -*-
+"""本地存储：任务账本、归档输出、同步清单、车牌号索引和响应缓存"""
+
+import datetime
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import zipfile
+
+from .config import CACHE_MAX_BYTES, CHUNK_SIZE, LOGGER_NAME, MANIFEST_FILE, PART_SUFFIX
+from .records import Card, Download
+
+
+class JobLedger(object):
+    """基于SQLite的任务账本
+
+    记录每个已发现的(卡片, 月份, 发票)及其下载状态、文件大小和sha256，
+    中断后重新运行时可以跳过已完成的部分。开票时记录每个tradeid的提交状态，
+    保证同一个tradeid不会被重复提交。多个工作线程共享同一个连接。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cards (
+            card_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            car_num TEXT,
+            status TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (card_id, month)
+        );
+        CREATE TABLE IF NOT EXISTS invoices (
+            card_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            url TEXT NOT NULL,
+            car_num TEXT,
+            filepath TEXT NOT NULL,
+            status TEXT NOT NULL,
+            size INTEGER,
+            sha256 TEXT,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (card_id, month, url)
+        );
+        CREATE TABLE IF NOT EXISTS trades (
+            card_id TEXT NOT NULL,
+            month TEXT NOT NULL,
+            trade_id TEXT NOT NULL,
+            apply_id TEXT,
+            status TEXT NOT NULL,
+            updated_at TEXT NOT NULL,
+            PRIMARY KEY (card_id, month, trade_id)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.executescript(self.SCHEMA)
+
+    def __execute(self, sql, params=()):
+        with self.__lock:
+            return self.__conn.execute(sql, params).fetchall()
+
+    @staticmethod
+    def __now():
+        return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def card_done(self, card_id, month):
+        """卡片该月份已全部下载完成，并且所有文件仍然完好地保存在磁盘上"""
+        rows = self.__execute(
+            "SELECT status FROM cards WHERE card_id = ? AND month = ?", (card_id, month))
+        if not rows or rows[0][0] != "done":
+            return False
+        files = self.__execute(
+            "SELECT filepath, size FROM invoices WHERE card_id = ? AND month = ?", (card_id, month))
+        return files_intact(files)
+
+    def mark_card(self, card_id, month, car_num, status):
+        self.__execute(
+            "INSERT OR REPLACE INTO cards (card_id, month, car_num, status, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (card_id, month, car_num, status, self.__now()))
+
+    def add_invoice(self, card_id, month, url, car_num, filepath):
+        """登记发现的发票，已登记的发票保持原有状态"""
+        self.__execute(
+            "INSERT OR IGNORE INTO invoices (card_id, month, url, car_num, filepath, status, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, 'pending', ?)",
+            (card_id, month, url, car_num, filepath, self.__now()))
+
+    def invoice_done(self, card_id, month, url, filepath):
+        """发票已下载完成，且磁盘上的文件仍然存在并且大小一致"""
+        rows = self.__execute(
+            "SELECT status, size, filepath FROM invoices WHERE card_id = ? AND month = ? AND url = ?",
+            (card_id, month, url))
+        if not rows or rows[0][0] != "done" or rows[0][2] != filepath:
+            return False
+        return files_intact([(filepath, rows[0][1])])
+
+    def finish_invoice(self, card_id, month, url, filepath, size, sha256):
+        self.__execute(
+            "UPDATE invoices SET status = 'done', filepath = ?, size = ?, sha256 = ?, updated_at = ? "
+            "WHERE card_id = ? AND month = ? AND url = ?",
+            (filepath, size, sha256, self.__now(), card_id, month, url))
+
+    def average_size(self):
+        """已下载发票文件的平均大小，没有记录时返回None"""
+        rows = self.__execute("SELECT AVG(size) FROM invoices WHERE status = 'done'")
+        return rows[0][0]
+
+    def summary(self):
+        """返回各状态的发票数量"""
+        return dict(self.__execute("SELECT status, COUNT(*) FROM invoices GROUP BY status"))
+
+    def submitted_trades(self, card_id, month):
+        """返回已提交或提交结果未知的tradeid集合，这些tradeid不能再次提交"""
+        rows = self.__execute(
+            "SELECT trade_id FROM trades WHERE card_id = ? AND month = ? "
+            "AND status IN ('submitting', 'submitted')", (card_id, month))
+        return set(row[0] for row in rows)
+
+    def mark_trades(self, card_id, month, trade_ids, apply_id, status):
+        """记录一批tradeid的提交状态
+
+        提交前标记为submitting，成功后为submitted，站点明确拒绝时为failed；
+        提交过程中出现异常时保持submitting，需要人工确认后用release_trades()释放才能再次提交。
+        """
+        now = self.__now()
+        with self.__lock:
+            with self.__conn:
+                self.__conn.execute("BEGIN")
+                self.__conn.executemany(
+                    "INSERT OR REPLACE INTO trades (card_id, month, trade_id, apply_id, status, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    [(card_id, month, trade_id, apply_id, status, now) for trade_id in trade_ids])
+
+    def unknown_trades(self, months=None):
+        """按批次返回提交结果未知(submitting)的交易：(卡片, 月份, applyId, 交易数, 提交时间)"""
+        sql = "SELECT card_id, month, apply_id, COUNT(*), MAX(updated_at) FROM trades WHERE status = 'submitting'"
+        params = []
+        if months:
+            sql += " AND month IN (%s)" % ",".join("?" * len(months))
+            params.extend(months)
+        sql += " GROUP BY card_id, month, apply_id ORDER BY month, card_id, apply_id"
+        return self.__execute(sql, params)
+
+    def release_trades(self, apply_ids=None):
+        """把提交结果未知的交易标记为released，之后开票时会重新提交
+
+        apply_ids为None时释放全部批次，返回释放的交易数量。应在站点上确认这些交易确实没有开票后再释放。
+        """
+        sql = "UPDATE trades SET status = 'released', updated_at = ? WHERE status = 'submitting'"
+        params = [self.__now()]
+        if apply_ids is not None:
+            sql += " AND apply_id IN (%s)" % ",".join("?" * len(apply_ids))
+            params.extend(apply_ids)
+        with self.__lock:
+            return self.__conn.execute(sql, params).rowcount
+
+    def trade_summary(self):
+        """返回各状态的tradeid数量"""
+        return dict(self.__execute("SELECT status, COUNT(*) FROM trades GROUP BY status"))
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
+
+
+class ArchiveWriter(object):
+    """流式写入一个合并的发票zip归档
+
+    新归档先写入同目录下的.part临时文件，close()时追加内嵌清单(manifest.json)后原子重命名为目标文件。
+    目标文件已存在时直接在原文件上追加：去掉末尾的旧清单和目录，写入新的发票后重新写入清单和目录，
+    已有的条目不会被复制或重写。追加前把被覆盖的末尾部分(清单和目录)保存到.journal文件，
+    追加期间归档暂时不可读；中断后下次打开时按.journal恢复成追加前的归档。
+    """
+
+    MANIFEST_NAME = "manifest.json"
+    JOURNAL_SUFFIX = ".journal"
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = path + PART_SUFFIX
+        self.journal_path = path + self.JOURNAL_SUFFIX
+        self.records = []
+        self.__names = None
+        self.__zip = None
+        self.__created = False
+
+    @property
+    def names(self):
+        """归档中已有的发票文件名，只读取zip的目录"""
+        if self.__names is None:
+            self.__recover()
+            self.__names = set()
+            if os.path.isfile(self.path):
+                with zipfile.ZipFile(self.path) as archive:
+                    self.__names.update(name for name in archive.namelist() if name != self.MANIFEST_NAME)
+        return self.__names
+
+    def __recover(self):
+        """上次追加时中断：截掉追加的内容，写回原来的清单和目录"""
+        if not os.path.isfile(self.journal_path):
+            return
+        with open(self.journal_path, "rb") as f:
+            offset = int(f.readline())
+            tail = f.read()
+        with open(self.path, "rb+") as f:
+            f.seek(offset)
+            f.write(tail)
+            f.truncate()
+            os.fsync(f.fileno())
+        os.remove(self.journal_path)
+
+    def __open(self):
+        # 追加期间归档不可读，先读出已有的条目名(必要时恢复上次中断的追加)
+        self.names
+        if not os.path.isfile(self.path):
+            self.__created = True
+            self.__zip = zipfile.ZipFile(self.tmp_path, "w", zipfile.ZIP_STORED, allowZip64=True)
+            return
+
+        archive = zipfile.ZipFile(self.path, "a", zipfile.ZIP_STORED, allowZip64=True)
+        manifest = archive.NameToInfo.get(self.MANIFEST_NAME)
+        offset = archive.start_dir
+        if manifest is not None:
+            self.records = json.loads(archive.read(manifest).decode("utf-8")).get("invoices", [])
+            # 清单总是最后一个条目，从它开始覆盖，旧清单不会留在归档中
+            if manifest.header_offset == max(info.header_offset for info in archive.infolist()):
+                archive.filelist.remove(manifest)
+                del archive.NameToInfo[self.MANIFEST_NAME]
+                offset = archive.start_dir = manifest.header_offset
+        self.__write_journal(offset)
+        self.__zip = archive
+
+    def __write_journal(self, offset):
+        """保存offset之后将被覆盖的内容，写完整后才重命名为.journal"""
+        with open(self.path, "rb") as src, open(self.tmp_path, "wb") as dst:
+            dst.write(b"%d\n" % offset)
+            src.seek(offset)
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(self.tmp_path, self.journal_path)
+
+    def add(self, name, source_path, record):
+        """把source_path的内容作为name写入归档，record写入内嵌清单"""
+        if self.__zip is None:
+            self.__open()
+        entry = zipfile.ZipInfo(name, date_time=time.localtime(os.path.getmtime(source_path))[:6])
+        with open(source_path, "rb") as src, self.__zip.open(entry, "w", force_zip64=True) as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        self.names.add(name)
+        self.records.append(dict(record, name=name))
+
+    def close(self):
+        """写入内嵌清单和目录，没有新增发票时不改动目标文件"""
+        if self.__zip is None:
+            return False
+        manifest = {
+            "updated_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "count": len(self.records),
+            "invoices": self.records,
+        }
+        self.__zip.writestr(self.MANIFEST_NAME, json.dumps(manifest, ensure_ascii=False, indent=2))
+        self.__zip.close()
+        self.__zip = None
+        path = self.tmp_path if self.__created else self.path
+        with open(path, "rb+") as f:
+            os.fsync(f.fileno())
+        if self.__created:
+            os.replace(self.tmp_path, self.path)
+            self.__created = False
+        else:
+            os.remove(self.journal_path)
+        return True
+
+
+class ArchiveStore(object):
+    """归档输出模式：按月份(或月份和车牌号)把发票写入合并的zip归档
+
+    发票先下载到保存目录下的暂存目录，再由单个线程逐个写入对应的归档后删除暂存文件。
+    """
+
+    STAGING_DIR = ".txffp_staging"
+
+    def __init__(self, save_dir, per_plate=False, prefix="invoices", logger=None):
+        self.save_dir = save_dir
+        self.per_plate = per_plate
+        self.prefix = prefix
+        self.logger = logger or logging.getLogger(LOGGER_NAME)
+        self.staging_dir = os.path.join(save_dir, self.STAGING_DIR)
+        os.makedirs(self.staging_dir, exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__writers = {}
+
+    def archive_path(self, month, plate):
+        if self.per_plate:
+            return os.path.join(self.save_dir, month, "%s_%s.zip" % (plate, month))
+        return os.path.join(self.save_dir, "%s_%s.zip" % (self.prefix, month))
+
+    def __writer(self, month, plate):
+        path = self.archive_path(month, plate)
+        writer = self.__writers.get(path)
+        if writer is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            writer = self.__writers[path] = ArchiveWriter(path)
+        return writer
+
+    def has(self, month, plate, name):
+        with self.__lock:
+            return name in self.__writer(month, plate).names
+
+    def add(self, month, plate, download, record):
+        """把下载完成的暂存文件写入归档并删除暂存文件，返回记录到任务账本中的归档条目路径"""
+        name = os.path.basename(download.path)
+        with self.__lock:
+            writer = self.__writer(month, plate)
+            writer.add(name, download.path, dict(
+                record, plate=plate, month=month, size=download.size, sha256=download.sha256))
+        os.remove(download.path)
+        return archive_member(writer.path, name)
+
+    def finish(self, month, plate):
+        """按车牌号归档时，某个(车牌号, 月份)处理完毕后立即完成其归档"""
+        if not self.per_plate:
+            return
+        with self.__lock:
+            writer = self.__writers.pop(self.archive_path(month, plate), None)
+            if writer is not None and writer.close():
+                self.logger.info("归档已更新: %s", writer.path)
+
+    def close(self):
+        with self.__lock:
+            writers, self.__writers = self.__writers, {}
+            for writer in writers.values():
+                if writer.close():
+                    self.logger.info("归档已更新: %s", writer.path)
+
+
+class SyncManifest(object):
+    """保存目录的内容清单，用于增量同步和按内容去重
+
+    清单(SQLite，位于保存目录下)记录每个文件的相对路径、大小、修改时间和sha256。
+    大小和修改时间与清单一致的文件视为完好，无需重新下载；新文件的sha256与已有文件相同时，
+    以硬链接代替新文件，相同内容在磁盘上只保存一份。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sha256 TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+    """
+    # 不记录在清单中的文件
+    IGNORED = (PART_SUFFIX, ".db", ".db-wal", ".db-shm", ".log", ".json", ".prom", ".tmp")
+
+    def __init__(self, save_dir, name=MANIFEST_FILE):
+        self.save_dir = os.path.abspath(save_dir)
+        self.path = os.path.join(self.save_dir, name)
+        self.__lock = threading.Lock()
+        self.__conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.__conn.execute("PRAGMA journal_mode=WAL")
+        self.__conn.executescript(self.SCHEMA)
+        self.linked = 0
+        self.skipped = 0
+
+    def __relpath(self, path):
+        return os.path.relpath(os.path.abspath(path), self.save_dir)
+
+    def __execute(self, sql, params=()):
+        with self.__lock:
+            return self.__conn.execute(sql, params).fetchall()
+
+    def scan(self, logger=None):
+        """把保存目录中清单未记录或已变化的文件计算sha256后登记(内容重复的文件同样改为硬链接)，
+        删除已不存在的文件记录"""
+        logger = logger or logging.getLogger(LOGGER_NAME)
+        known = dict((row[0], (row[1], row[2])) for row in self.__execute("SELECT path, size, mtime FROM files"))
+        seen = set()
+        hashed = 0
+        for root, dirs, files in os.walk(self.save_dir):
+            for name in files:
+                if name.endswith(self.IGNORED):
+                    continue
+                path = os.path.join(root, name)
+                relpath = self.__relpath(path)
+                seen.add(relpath)
+                stat = os.stat(path)
+                if known.get(relpath) == (stat.st_size, stat.st_mtime):
+                    continue
+                self.store(path, file_sha256(path))
+                hashed += 1
+        removed = [path for path in known if path not in seen]
+        for relpath in removed:
+            self.__execute("DELETE FROM files WHERE path = ?", (relpath,))
+        logger.info("同步清单: 共%s个文件，新登记%s个，移除%s条失效记录", len(seen), hashed, len(removed))
+
+    def __record(self, relpath, stat, sha256):
+        self.__execute(
+            "INSERT OR REPLACE INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+            (relpath, stat.st_size, stat.st_mtime, sha256))
+
+    def fresh(self, path):
+        """目标文件存在，且大小和修改时间与清单中记录的一致时返回其Download记录，否则返回None"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        rows = self.__execute("SELECT size, mtime, sha256 FROM files WHERE path = ?", (self.__relpath(path),))
+        if rows and rows[0][:2] == (stat.st_size, stat.st_mtime):
+            with self.__lock:
+                self.skipped += 1
+            return Download(path, stat.st_size, rows[0][2])
+        return None
+
+    def store(self, path, sha256):
+        """登记新下载的文件，已有相同内容的文件时改为指向它的硬链接，返回是否建立了链接"""
+        relpath = self.__relpath(path)
+        rows = self.__execute(
+            "SELECT path FROM files WHERE sha256 = ? AND path != ? LIMIT 1", (sha256, relpath))
+        linked = False
+        if rows:
+            source = os.path.join(self.save_dir, rows[0][0])
+            tmp_path = path + ".link" + PART_SUFFIX
+            try:
+                if os.path.isfile(source) and not os.path.samefile(source, path):
+                    if os.path.lexists(tmp_path):
+                        os.remove(tmp_path)
+                    os.link(source, tmp_path)
+                    os.replace(tmp_path, path)
+                    linked = True
+            except OSError:
+                # 跨文件系统或不支持硬链接时保留独立的副本
+                linked = False
+        self.__record(relpath, os.stat(path), sha256)
+        if linked:
+            with self.__lock:
+                self.linked += 1
+        return linked
+
+    def stats(self):
+        """返回文件数、不同内容数、文件总大小以及去重后实际占用的大小"""
+        rows = self.__execute(
+            "SELECT COUNT(*), COUNT(DISTINCT sha256), COALESCE(SUM(size), 0) FROM files")
+        unique = self.__execute(
+            "SELECT COALESCE(SUM(size), 0) FROM (SELECT sha256, MAX(size) AS size FROM files GROUP BY sha256)")
+        files, contents, total = rows[0]
+        return {
+            "files": files,
+            "contents": contents,
+            "bytes": total,
+            "stored_bytes": unique[0][0],
+            "skipped": self.skipped,
+            "linked": self.linked,
+        }
+
+    def close(self):
+        with self.__lock:
+            self.__conn.close()
+
+
+# 任务账本中归档条目的路径为"归档路径::条目名"
+ARCHIVE_MEMBER_SEP = "::"
+
+
+def archive_member(archive_path, name):
+    return archive_path + ARCHIVE_MEMBER_SEP + name
+
+
+def files_intact(files):
+    """[(路径, 大小)]中的文件是否都存在且大小一致，路径可以是archive_member()返回的归档条目"""
+    archives = {}
+    for path, size in files:
+        archive_path, sep, name = path.partition(ARCHIVE_MEMBER_SEP)
+        if not sep:
+            if not (os.path.isfile(path) and os.path.getsize(path) == size):
+                return False
+            continue
+        if archive_path not in archives:
+            archives[archive_path] = archive_sizes(archive_path)
+        if archives[archive_path].get(name) != size:
+            return False
+    return True
+
+
+# 归档路径 -> ((文件大小, 修改时间), {条目名: 大小})，归档没有变化时不再读取zip目录
+_archive_sizes = {}
+
+
+def archive_sizes(path):
+    """归档中各条目的大小，归档不存在或已损坏时返回空字典"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return {}
+    key = (stat.st_size, stat.st_mtime_ns)
+    cached = _archive_sizes.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    try:
+        with zipfile.ZipFile(path) as archive:
+            sizes = dict((info.filename, info.file_size) for info in archive.infolist())
+    except (OSError, zipfile.BadZipFile):
+        return {}
+    _archive_sizes[path] = (key, sizes)
+    return sizes
+
+
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class PlateIndex(object):
+    """车牌号到站点卡片id的本地索引
+
+    发票查询页面(query)和开票页面(apply)的卡片id取自不同的页面，分别保存。
+    path为None时只保存在内存中。
+    """
+
+    QUERY = "query"
+    APPLY = "apply"
+
+    def __init__(self, path=None):
+        self.path = path
+        self.__lock = threading.Lock()
+        self.__plates = {self.QUERY: {}, self.APPLY: {}}
+        self.__dirty = False
+        if path and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.__plates.update(json.load(f).get("plates", {}))
+
+    def update(self, kind, cards):
+        """记录页面上解析得到的卡片"""
+        with self.__lock:
+            plates = self.__plates[kind]
+            for card in cards:
+                if plates.get(card.car_num) != card.id:
+                    plates[card.car_num] = card.id
+                    self.__dirty = True
+
+    def lookup(self, kind, patterns):
+        """按车牌号或通配符(如粤B*)查找卡片，返回(卡片列表, 没有匹配的车牌号列表)"""
+        with self.__lock:
+            plates = dict(self.__plates[kind])
+        cards = []
+        missing = []
+        for pattern in patterns:
+            if any(c in pattern for c in "*?["):
+                matched = [plate for plate in sorted(plates) if fnmatch.fnmatchcase(plate, pattern)]
+            else:
+                matched = [pattern] if pattern in plates else []
+            if not matched:
+                missing.append(pattern)
+            for plate in matched:
+                card = Card(plates[plate], plate)
+                if card not in cards:
+                    cards.append(card)
+        return cards, missing
+
+    def save(self):
+        """有变动时写回索引文件"""
+        with self.__lock:
+            if not self.path or not self.__dirty:
+                return
+            data = {
+                "updated_at": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                "plates": self.__plates,
+            }
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+            self.__dirty = False
+
+
+class ResponseCache(object):
+    """api响应的磁盘缓存
+
+    以接口名称和请求参数作为键，每条缓存记录自己的过期时间；缓存目录总大小超过
+    max_bytes时按最近写入时间淘汰最旧的记录。写入采用临时文件加重命名，可多线程共享。
+    缓存键中不含账号，目录中另外记录缓存所属的账号，换用其他账号的cookie时由bind()清空。
+    """
+
+    ACCOUNT_FILE = "account"
+
+    def __init__(self, path, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.__lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        self.__size = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+    def __filepath(self, endpoint, params):
+        key = json.dumps([endpoint, sorted(params.items())], ensure_ascii=False, default=str)
+        return os.path.join(self.path, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, endpoint, params):
+        """返回未过期的缓存内容，不存在或已过期时返回None"""
+        filepath = self.__filepath(endpoint, params)
+        try:
+            with open(filepath, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            entry = None
+        if entry is None or entry["expires"] < time.time():
+            with self.__lock:
+                self.misses += 1
+            return None
+        with self.__lock:
+            self.hits += 1
+        return entry["body"]
+
+    def set(self, endpoint, params, body, ttl):
+        filepath = self.__filepath(endpoint, params)
+        data = json.dumps({"expires": time.time() + ttl, "endpoint": endpoint, "body": body}, ensure_ascii=False)
+        tmp_path = "%s.%s.tmp" % (filepath, threading.get_ident())
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        old_size = os.path.getsize(filepath) if os.path.isfile(filepath) else 0
+        os.replace(tmp_path, filepath)
+        with self.__lock:
+            self.__size += os.path.getsize(filepath) - old_size
+            if self.__size > self.max_bytes:
+                self.__evict()
+
+    def __evict(self):
+        """淘汰最旧的缓存记录，直到总大小降到上限的90%以下"""
+        entries = sorted(
+            (entry for entry in os.scandir(self.path) if entry.is_file() and entry.name.endswith(".json")),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        self.__size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.__size <= self.max_bytes * 0.9:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.__size -= size
+
+    def bind(self, account):
+        """缓存属于account(账号标识)，与记录的账号不同时清空缓存，返回是否清空了缓存"""
+        account_path = os.path.join(self.path, self.ACCOUNT_FILE)
+        with self.__lock:
+            try:
+                with open(account_path, "r", encoding="utf-8") as f:
+                    if f.read() == account:
+                        return False
+            except OSError:
+                pass
+            cleared = False
+            for entry in os.scandir(self.path):
+                if entry.is_file() and entry.name.endswith(".json"):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        continue
+                    cleared = True
+            self.__size = 0
+            with open(account_path, "w", encoding="utf-8") as f:
+                f.write(account)
+            return cleared
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.__size}
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""传输层：带连接池的会话、自适应限速、重试策略和分块写入"""
+
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .config import (
+    COOKIE_POLL_INTERVAL, INITIAL_RPS, LOGGER_NAME, MAX_RETRIES, MAX_RPS, MIN_RPS, POOL_SIZE, REQUEST_TIMEOUT,
+    SESSION_WAIT, SLOW_LATENCY, read_cookie,
+)
+from .exceptions import SessionExpiredException
+from .log import create_logger
+from .metrics import Metrics
+
+
+class RateController(object):
+    """自适应请求速率控制器，在多个工作线程之间共享
+
+    使用令牌桶控制发出请求的速率，并按AIMD方式调整：起步阶段每个成功请求使速率
+    增加increase(慢启动，约每秒翻倍)；第一次降速之后，请求成功且延迟正常时速率
+    每秒约增加increase。出现5xx、超时或响应变慢时速率乘以decrease，冷却时间内
+    只降速一次。max_rate小于等于0时不做任何限制。
+    """
+
+    def __init__(self, max_rate=MAX_RPS, initial_rate=INITIAL_RPS, min_rate=MIN_RPS,
+                 increase=1.0, decrease=0.7, slow_latency=SLOW_LATENCY, cooldown=1.0):
+        self.enabled = bool(max_rate) and max_rate > 0
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate) if self.enabled else min_rate
+        self.rate = max(min(initial_rate, max_rate), self.min_rate) if self.enabled else initial_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.slow_latency = slow_latency
+        self.cooldown = cooldown
+        self.__lock = threading.Lock()
+        self.__tokens = 1.0
+        self.__updated = time.monotonic()
+        self.__last_decrease = 0.0
+        self.__slow_start = True
+
+    def acquire(self):
+        """取得一个令牌，令牌不足时阻塞等待"""
+        if not self.enabled:
+            return
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__tokens + (now - self.__updated) * self.rate, 1.0)
+            self.__updated = now
+            # 令牌可以透支，透支部分即当前请求需要等待的时间
+            self.__tokens -= 1.0
+            wait = -self.__tokens / self.rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def record(self, latency=None, ok=True):
+        """反馈一次请求的结果，据此调整速率"""
+        if not self.enabled:
+            return
+        with self.__lock:
+            if ok and (latency is None or latency <= self.slow_latency):
+                step = self.increase if self.__slow_start else self.increase / self.rate
+                self.rate = min(self.rate + step, self.max_rate)
+                return
+            now = time.monotonic()
+            if now - self.__last_decrease >= self.cooldown:
+                self.rate = max(self.rate * self.decrease, self.min_rate)
+                self.__last_decrease = now
+                self.__slow_start = False
+
+
+class RetryPolicy(object):
+    """有上限的指数退避重试策略"""
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, max_retries=MAX_RETRIES, backoff=0.5, max_backoff=30.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt):
+        """第attempt次重试前的等待秒数，带随机抖动"""
+        delay = min(self.backoff * (2 ** (attempt - 1)), self.max_backoff)
+        return random.uniform(delay / 2, delay)
+
+    def retryable(self, status_code):
+        return status_code in self.RETRY_STATUS
+
+
+class ChunkWriter(object):
+    """在后台线程中写入文件块，使磁盘写入与网络读取重叠进行
+
+    队列长度有上限，网络读取过快时会阻塞等待，内存占用与文件大小无关。
+    """
+
+    def __init__(self, filepath, mode="wb", max_chunks=16, hasher=None):
+        self.__file = open(filepath, mode)
+        self.__hasher = hasher
+        self.__queue = queue.Queue(maxsize=max_chunks)
+        self.__error = None
+        self.written = 0
+        self.__thread = threading.Thread(target=self.__run, name="writer", daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        while True:
+            chunk = self.__queue.get()
+            if chunk is None:
+                break
+            if self.__error is not None:
+                continue
+            try:
+                self.__file.write(chunk)
+                self.written += len(chunk)
+                if self.__hasher is not None:
+                    self.__hasher.update(chunk)
+            except Exception as e:
+                self.__error = e
+
+    def write(self, chunk):
+        if self.__error is not None:
+            raise self.__error
+        self.__queue.put(chunk)
+
+    def close(self):
+        """等待剩余数据写入并落盘"""
+        self.__queue.put(None)
+        self.__thread.join()
+        try:
+            if self.__error is None:
+                self.__file.flush()
+                os.fsync(self.__file.fileno())
+        finally:
+            self.__file.close()
+        if self.__error is not None:
+            raise self.__error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class SessionGuard(object):
+    """会话失效时暂停所有请求，等待cookie文件更新后继续
+
+    每个请求发出前调用wait()，得到会话失效的响应时调用expired()。第一个发现失效的线程负责暂停：
+    依次调用on_pause中的函数保存状态，然后每poll秒检查一次cookie文件，内容变化(或收到SIGHUP时
+    调用refresh())后换上新的cookie并恢复所有请求；其他线程在wait()处阻塞，暂停之前发出的请求
+    再返回404也不会重复暂停。timeout秒内cookie没有更新或者调用了cancel()时，所有请求都抛出SessionExpiredException。
+    """
+
+    def __init__(self, cookie_path, timeout=SESSION_WAIT, poll=COOKIE_POLL_INTERVAL, logger=None):
+        self.cookie_path = cookie_path
+        self.timeout = timeout
+        self.poll = poll
+        self.logger = logger or logging.getLogger(LOGGER_NAME)
+        self.on_pause = []
+        # 每次换上新的cookie后加1，用来识别换cookie之前发出的请求
+        self.generation = 0
+        self.pauses = 0
+        self.__lock = threading.Lock()
+        self.__resumed = threading.Event()
+        self.__resumed.set()
+        self.__refresh = threading.Event()
+        self.__error = None
+        self.__cancelled = False
+
+    @property
+    def paused(self):
+        return not self.__resumed.is_set()
+
+    def wait(self):
+        """请求发出前调用，暂停期间阻塞到cookie更新，返回当前的cookie代数"""
+        self.__resumed.wait()
+        if self.__error is not None:
+            raise self.__error
+        return self.generation
+
+    def reset(self):
+        """清除上一次等待超时的错误，守护模式每轮同步开始时调用；cancel()之后不再清除"""
+        if not self.__cancelled:
+            self.__error = None
+
+    def cancel(self, *args):
+        """停止等待cookie，正在等待和之后的请求都抛出SessionExpiredException
+
+        程序退出(SIGTERM、Ctrl-C)时调用，避免暂停中的线程阻塞到--session-wait超时。
+        """
+        self.__cancelled = True
+        self.__error = SessionExpiredException("程序正在退出，已停止等待cookie更新")
+        self.__refresh.set()
+        self.__resumed.set()
+
+    def refresh(self, *args):
+        """立即重新读取cookie文件，可以直接作为信号处理函数"""
+        self.__refresh.set()
+
+    def expired(self, handler, generation):
+        """请求得到会话失效的响应时调用，返回后重新发送该请求
+
+        generation为发出请求前wait()的返回值。
+        """
+        if self.__cancelled:
+            raise self.__error
+        with self.__lock:
+            owner = generation == self.generation and not self.paused
+            if owner:
+                self.__resumed.clear()
+        if not owner:
+            self.wait()
+            return
+
+        start = time.monotonic()
+        try:
+            cookie = self.__wait_cookie(handler.cookie)
+        except SessionExpiredException as e:
+            self.__error = e
+            self.__resumed.set()
+            raise
+        handler.set_cookie(cookie)
+        with self.__lock:
+            self.generation += 1
+            self.pauses += 1
+        self.logger.warning("已重新读取cookie，暂停%.0f秒后继续执行", time.monotonic() - start)
+        self.__resumed.set()
+
+    def __wait_cookie(self, old):
+        self.logger.error("cookie失效或过期，已暂停所有请求；请更新%s(更新后也可以发送SIGHUP信号)，之后将自动继续",
+                          self.cookie_path)
+        for callback in self.on_pause:
+            try:
+                callback()
+            except Exception as e:
+                self.logger.warning("暂停时保存状态失败: %s: %s", type(e).__name__, e)
+
+        deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+        self.__refresh.clear()
+        while True:
+            refreshed = self.__refresh.wait(self.poll)
+            self.__refresh.clear()
+            if self.__cancelled:
+                raise self.__error
+            try:
+                cookie = read_cookie(self.cookie_path)
+            except OSError:
+                cookie = ""
+            # 收到SIGHUP时即使内容没有变化也重新尝试
+            if cookie and (cookie != old or refreshed):
+                return cookie
+            if deadline is not None and time.monotonic() > deadline:
+                raise SessionExpiredException("cookie失效或过期，%s秒内没有更新cookie" % self.timeout)
+
+
+class BaseHandler(object):
+
+    def __init__(self, cookie="", headers=None, req_sleep=False, logger=None, log_level=logging.INFO,
+                 pool_size=POOL_SIZE, rate_limiter=None, retry_policy=None, timeout=REQUEST_TIMEOUT, metrics=None,
+                 session_guard=None):
+        self.__cookie_text = cookie
+        self.headers = {}
+        self.req_sleep = req_sleep
+        self.pool_size = pool_size
+        # req_sleep时以最低速率起步，再由速率控制器根据站点状况逐步提速
+        self.rate_limiter = rate_limiter or RateController(
+            max_rate=MAX_RPS if req_sleep else 0, initial_rate=MIN_RPS)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.timeout = timeout
+        self.metrics = metrics or Metrics()
+        # 为None时cookie失效直接抛出SessionExpiredException，否则暂停等待cookie更新
+        self.session_guard = session_guard
+
+        if logger is None:
+            self.logger = self._logger(log_level)
+        else:
+            self.logger = logger
+
+        if not headers:
+            self._headers = {}
+        else:
+            self._headers = headers
+        self.session = self.__create_session()
+        self.__init_headers()
+
+    def __create_session(self):
+        """创建带连接池的会话，同一handler内的请求复用keep-alive连接"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers["Connection"] = "keep-alive"
+        return session
+
+    def __cookiejar_update(self):
+        """解析文本cookie，并写入会话的cookie jar"""
+        if not self.__cookie_text:
+            return
+
+        domain = self._headers.get("Host", "").split(":")[0]
+        for kv in self.__cookie_text.split(";"):
+            kv = kv.strip()
+            if not kv:
+                continue
+            k, v = kv.split("=", 1)
+            self.session.cookies.set(k, v, domain=domain, path="/")
+
+    @property
+    def cookie(self):
+        return self.__cookie_text
+
+    def set_cookie(self, cookie):
+        """换用新的cookie，会话中原有的cookie(包括站点下发的)全部清除"""
+        self.__cookie_text = cookie
+        self.session.cookies.clear()
+        self.__cookiejar_update()
+
+    def __flush_headers(self):
+        """刷新请求头，cookie由会话的cookie jar负责维护"""
+        self.headers.update(self._headers)
+
+    def __init_headers(self):
+        # 初始化cookie jar
+        self.__cookiejar_update()
+        """初始化请求头"""
+        self.__flush_headers()
+        self.logger.info("初始化请求头...")
+
+    def _logger(self, level=logging.INFO):
+        return create_logger(level=level)
+
+    def set_header(self, key, value):
+        """设置或添加键值对到headers中"""
+        self.headers[key] = value
+
+    def del_header(self, key):
+        """删除headers内的键值对"""
+        del self.headers[key]
+
+    def request_headers(self, **extra):
+        """返回单次请求使用的请求头副本，避免并发请求之间互相覆盖Referer等字段"""
+        headers = dict(self.headers)
+        headers.update(extra)
+        return headers
+
+    def transport_stats(self):
+        """返回连接复用统计信息: 请求数、新建连接数以及复用次数"""
+        requests_count = 0
+        connections = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                requests_count += pool.num_requests
+                connections += pool.num_connections
+        return {
+            "requests": requests_count,
+            "connections": connections,
+            "reused": max(requests_count - connections, 0),
+        }
+
+    def confirm_expired(self, generation):
+        """请求返回404时调用，cookie确已失效时等待更新，返回是否应该用新的cookie重新请求
+
+        generation为发出请求前session_guard.wait()的返回值。这里无法确认，直接视为失效；
+        APIHandler会先请求卡片列表确认。
+        """
+        self.session_guard.expired(self, generation)
+        return True
+
+    def api_handler(self, url, headers="", data="", method="post", retries=None, name=None, verify_session=True):
+        """请求api接口并返回解码后的页面，失败时按重试策略退避重试，最终失败返回None
+
+        name为运行指标中使用的接口名称，未指定时使用url的路径。
+        verify_session为False时404直接视为cookie失效，用于确认cookie是否有效的请求本身。
+        """
+        if method not in ("post", "get"):
+            raise Exception("错误的或不支持的请求方式[%s]" % method)
+        if retries is None:
+            retries = self.retry_policy.max_retries
+        endpoint = name or urlsplit(url).path
+
+        attempt = -1
+        while attempt < retries:
+            attempt += 1
+            if attempt:
+                delay = self.retry_policy.delay(attempt)
+                self.logger.warning("%.1f秒后第%s次重试api接口: %s", delay, attempt, url)
+                self.metrics.retry(endpoint)
+                time.sleep(delay)
+            generation = self.session_guard.wait() if self.session_guard is not None else 0
+            self.rate_limiter.acquire()
+            self.logger.debug("请求api接口: %s", url, extra={"event": "request", "endpoint": endpoint})
+            start = time.monotonic()
+            try:
+                if method == "post":
+                    response = self.session.post(url, data, headers=headers, timeout=self.timeout)
+                else:
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                self.rate_limiter.record(ok=False)
+                self.metrics.error(endpoint, type(e).__name__)
+                self.logger.error("api接口查询失败(method: %s): %s\n\turl: %s\n\theaders: %s"
+                                  "\n\tdata: %s", method, e, url, headers, data)
+                continue
+
+            latency = time.monotonic() - start
+            retryable = self.retry_policy.retryable(response.status_code)
+            self.rate_limiter.record(latency, ok=not retryable)
+            self.metrics.request(endpoint, response.status_code, latency, len(response.content))
+            if response.status_code != 200:
+                self.metrics.error(endpoint, "http_%s" % response.status_code)
+
+            if response.status_code == 404:
+                self.logger.error("得到了一个404响应，可能是cookie没有及时更新导致或者cookie过期等")
+                if self.session_guard is None:
+                    raise SessionExpiredException("cookie失效或过期，请更新cookie后重新运行")
+                if verify_session and not self.confirm_expired(generation):
+                    self.logger.error("cookie仍然有效，api接口不存在: %s", url)
+                    return
+                if not verify_session:
+                    self.session_guard.expired(self, generation)
+                # 换上新的cookie后重新请求，不计入重试次数
+                attempt -= 1
+                continue
+
+            if retryable:
+                self.logger.warning("api接口暂时不可用(method:%s)，状态码: [%s]", method, response.status_code)
+                continue
+
+            if response.status_code != 200:
+                self.logger.error("api接口信息获取失败(mthod:%s)，状态码: [%s],"
+                              "错误信息: [%s]", method, response.status_code, response.reason)
+                return
+
+            try:
+                html_text = response.content.decode("utf-8")
+            except UnicodeDecodeError as e:
+                self.metrics.error(endpoint, type(e).__name__)
+                self.logger.error("解码api响应内容失败")
+                return
+
+            self.logger.debug("得到应答: %s", url, extra={
+                "event": "response", "endpoint": endpoint, "status": response.status_code,
+                "latency": round(latency, 4), "size": len(response.content)})
+            return html_text
+
+        self.logger.error("api接口请求%s次均失败: %s", retries + 1, url)
@@ -0,0 +1,1175 @@
+# -*- coding: utf-8 -*-
+"""下载和开票流程：分页、下载流水线和APIHandler"""
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import requests
+
+from .config import (
+    APPLY_BATCH_SIZE, CACHE_TTL_CARDS, CACHE_TTL_CLOSED, CACHE_TTL_OPEN, CHUNK_SIZE, LOGGER_NAME, PART_SUFFIX,
+    QUEUE_SIZE, SITE_URL, WORKERS,
+)
+from .exceptions import SessionExpiredException, TypeException
+from .index import index_invoices
+from .metrics import Progress, format_bytes, format_seconds
+from .months import as_months
+from .parsers import Page
+from .records import Card, Download, Estimate, as_card
+from .storage import JobLedger, PlateIndex
+from .transport import BaseHandler, ChunkWriter
+
+# 206响应的Content-Range头，例如"bytes 1024-2047/4096"
+RE_CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-")
+
+
+class DownloadJob(object):
+    """下载流水线中一个(卡片, 月份)的进度
+
+    发票列表阶段登记发现的发票数量，后处理阶段汇总每个文件的下载结果；
+    列表获取完毕且所有文件都有了结果时，该任务结束。
+    """
+    __slots__ = ("card", "month", "listed", "complete", "total", "finished", "failed", "lock")
+
+    def __init__(self, card, month):
+        self.card = card
+        self.month = month
+        self.listed = False
+        self.complete = True
+        self.total = 0
+        self.finished = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+
+    def finish(self, ok):
+        """记录一个文件的下载结果，任务因此结束时返回True"""
+        with self.lock:
+            self.finished += 1
+            self.failed += not ok
+            return self.listed and self.finished == self.total
+
+    def close_listing(self):
+        """发票列表获取完毕，任务因此结束(没有发票或文件都已下载完)时返回True"""
+        with self.lock:
+            self.listed = True
+            return self.finished == self.total
+
+    @property
+    def done(self):
+        return self.complete and not self.failed
+
+
+class Paginator(object):
+    """通用分页器，逐页返回(page_num, 解析后的页面)
+
+    按页面上的taiji_search_hasMore判断是否存在下一页，不设固定页数上限。
+    处理第N页的同时在后台预取第N+1页；如果首页提供了总页数，则在workers个
+    线程内并发获取剩余分页，但仍然按页码顺序返回。
+    """
+
+    def __init__(self, fetch, has_more=Page.has_more, total_pages=Page.total_pages, parse=Page, workers=2,
+                 max_page=None, max_failures=3, logger=None):
+        self.fetch = fetch
+        self.has_more = has_more
+        self.total_pages = total_pages
+        self.parse = parse
+        self.workers = max(workers, 1)
+        self.max_page = max_page
+        self.max_failures = max_failures
+        self.logger = logger or logging.getLogger(LOGGER_NAME)
+        # 迭代结束后，若中途有分页获取失败则为False
+        self.complete = True
+
+    def __fetch(self, page_num):
+        html = self.fetch(page_num)
+        if html is None:
+            return None
+        return self.parse(html)
+
+    def __iter__(self):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="page") as pool:
+            pending = {1: pool.submit(self.__fetch, 1)}
+            next_page = 2
+            page_num = 1
+            total = None
+            failures = 0
+
+            while page_num in pending:
+                doc = pending.pop(page_num).result()
+                if doc is None:
+                    # 获取失败时跳过该页继续尝试下一页，连续失败过多则停止
+                    self.complete = False
+                    failures += 1
+                    more = failures < self.max_failures
+                    if more:
+                        self.logger.warning("第%s页响应数据为空，跳过该页", page_num)
+                    else:
+                        # 已经预取的分页不再返回，尚未开始的请求直接取消
+                        self.logger.error("连续%s页获取失败，停止翻页", failures)
+                        for future in pending.values():
+                            future.cancel()
+                        break
+                else:
+                    failures = 0
+                    if total is None and self.total_pages is not None:
+                        total = self.total_pages(doc)
+                    more = page_num < total if total else self.has_more(doc)
+
+                if more:
+                    limit = total or page_num + 1
+                    if self.max_page:
+                        limit = min(limit, self.max_page)
+                    window = self.workers if total else 1
+                    while next_page <= limit and len(pending) < window:
+                        pending[next_page] = pool.submit(self.__fetch, next_page)
+                        next_page += 1
+
+                if doc is not None:
+                    yield page_num, doc
+                page_num += 1
+
+
+class Pipeline(object):
+    """由有界队列连接的多阶段流水线
+
+    每个阶段由workers个线程执行handler(item)，handler返回的可迭代对象(通常是生成器)
+    中的每一项放入下一阶段的队列，最后一个阶段的输出被丢弃。队列有界，下游处理不过来时
+    上游阻塞等待，内存占用与任务总量无关。任意阶段抛出异常时流水线停止接收新任务，
+    run()在所有线程退出后重新抛出第一个异常。
+    """
+
+    __DONE = object()
+
+    def __init__(self, maxsize=QUEUE_SIZE, logger=None):
+        self.maxsize = max(int(maxsize), 1)
+        self.logger = logger or logging.getLogger(LOGGER_NAME)
+        self.stages = []
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__error = None
+        # 各阶段处理的任务数
+        self.counts = {}
+
+    def add_stage(self, name, handler, workers=1):
+        self.stages.append((name, handler, max(int(workers), 1)))
+        return self
+
+    def run(self, source):
+        """在当前线程中迭代source，把每一项送入第一个阶段，所有阶段处理完毕后返回"""
+        queues = [queue.Queue(self.maxsize) for _ in self.stages]
+        remaining = [workers for name, handler, workers in self.stages]
+        self.counts = dict((name, 0) for name, handler, workers in self.stages)
+        threads = []
+        for index, (name, handler, workers) in enumerate(self.stages):
+            for n in range(workers):
+                thread = threading.Thread(
+                    target=self.__work, args=(index, queues, remaining),
+                    name="%s_%s" % (name, n), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        try:
+            for item in source:
+                if self.__stop.is_set():
+                    break
+                self.__put(queues[0], item)
+        except BaseException as e:
+            self.__fail(e)
+        finally:
+            for _ in range(self.stages[0][2]):
+                self.__put(queues[0], self.__DONE)
+            for thread in threads:
+                thread.join()
+
+        if self.__error is not None:
+            raise self.__error
+
+    def __work(self, index, queues, remaining):
+        name, handler, workers = self.stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(queues) else None
+        while True:
+            item = inbox.get()
+            if item is self.__DONE:
+                break
+            if self.__stop.is_set():
+                # 出错后继续取出剩余任务，避免上游阻塞在已满的队列上
+                continue
+            try:
+                for output in handler(item) or ():
+                    if outbox is not None:
+                        self.__put(outbox, output)
+                with self.__lock:
+                    self.counts[name] += 1
+            except BaseException as e:
+                self.__fail(e)
+
+        with self.__lock:
+            remaining[index] -= 1
+            last = not remaining[index]
+        if last and outbox is not None:
+            for _ in range(self.stages[index + 1][2]):
+                self.__put(outbox, self.__DONE)
+
+    def __put(self, q, item):
+        while True:
+            if self.__stop.is_set() and item is not self.__DONE:
+                return
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __fail(self, error):
+        with self.__lock:
+            if self.__error is None:
+                self.__error = error
+                self.logger.error("流水线出现异常，停止处理: %s: %s", type(error).__name__, error)
+        self.__stop.set()
+
+
+class APIHandler(BaseHandler):
+
+    APIS = {
+        "inv_manage": {
+            "path": "pss/app/login/invoice/consumeTrans/manage",
+            "method": "post",
+        },
+        "inv_apply": {
+            "path": "pss/app/login/invoice/consumeTrans/apply",
+            "method": "post",
+        },
+        "inv_subapply": {
+            "path": "pss/app/login/invoice/consumeTrans/submitApply",
+            "method": "post",
+            # 提交开票不是幂等操作，失败后不自动重试
+            "retries": 0,
+        },
+        "card_list": {
+            "path": "pss/app/login/cardList/manage",
+            "method": "post",
+        },
+        "query_card": {
+            "path": "pss/app/login/invoice/query/card",
+            "method": "post",
+        },
+        "query_apply": {
+            "path": "pss/app/login/invoice/query/queryApply",
+            "method": "post",
+        },
+
+    }
+    # 最大翻页数，None表示跟随taiji_search_hasMore翻到最后一页
+    MAX_PAGE_NUM = None
+
+    def __init__(self, cookie="", headers=None, *args, workers=WORKERS, ledger=None, resume=False,
+                 site_url=SITE_URL, cache=None, refresh_cache=False, plate_index=None,
+                 apply_batch_size=APPLY_BATCH_SIZE, list_workers=None, file_workers=None, queue_size=QUEUE_SIZE,
+                 sync=None, archive=None, progress=None, **kwargs):
+        # 站点地址可替换为本地模拟服务器，Host/Origin请求头随之调整
+        self.site_url = site_url.rstrip("/") + "/"
+        netloc = urlsplit(self.site_url)
+        headers = dict(headers or {})
+        if "Host" in headers:
+            headers["Host"] = netloc.netloc
+        if "Origin" in headers:
+            headers["Origin"] = "%s://%s" % (netloc.scheme, netloc.netloc)
+        self.apis = {}
+        for name, api in self.APIS.items():
+            self.apis[name] = dict(api, url=urljoin(self.site_url, api["path"]), name=name)
+            del self.apis[name]["path"]
+        super(APIHandler, self).__init__(cookie, headers, *args, **kwargs)
+        self.workers = max(int(workers), 1)
+        # 下载流水线中发票列表和文件下载两个阶段的线程数，默认与workers相同
+        self.list_workers = max(int(list_workers or self.workers), 1)
+        self.file_workers = max(int(file_workers or self.workers), 1)
+        self.queue_size = queue_size
+        self.ledger = ledger
+        # 未指定任务账本时，开票记录只保存在内存中，同样可以避免本次运行内重复提交
+        self.__trade_ledger = ledger if ledger is not None else JobLedger(":memory:")
+        self.apply_batch_size = max(int(apply_batch_size), 1)
+        self.resume = resume
+        # 续传时不按卡片整体跳过的月份(当月之外仍可能开出新发票的月份，如守护模式同步的上个月)
+        self.open_months = ()
+        self.cache = cache
+        self.refresh_cache = refresh_cache
+        self.plate_index = plate_index if plate_index is not None else PlateIndex()
+        # 增量同步清单(SyncManifest)，为None时不做同步检查和去重
+        self.sync = sync
+        # 归档输出(ArchiveStore)，为None时每张发票保存为单独的文件
+        self.archive = archive
+        # 任务进度，下载时以发票文件计数，开票时以tradeid计数
+        self.progress = progress if progress is not None else Progress()
+
+    def file_write(self, data, filepath):
+        with open(filepath, "wb") as f:
+            f.write(data)
+
+    def download_handler(self, url, save_path, filename):
+        """流式下载文件，返回保存路径，失败时返回None"""
+        download = self.download_file(url, save_path, filename)
+        return download.path if download is not None else None
+
+    def download_file(self, url, save_path, filename):
+        """流式下载文件，返回Download记录，失败时返回None
+
+        数据先写入同目录下的.part临时文件，完整下载后再原子重命名为目标文件；
+        如果存在上次中断留下的.part文件，则通过Range请求续传。
+        失败时按重试策略退避重试，重试同样从.part文件处续传。
+        同步模式下目标文件与清单一致时直接跳过，下载完成后与已有的相同内容建立硬链接。
+        """
+        if self.sync is not None:
+            download = self.sync.fresh(os.path.join(save_path, filename))
+            if download is not None:
+                self.logger.info("文件[%s]与同步清单一致，跳过", filename)
+                return download
+
+        for attempt in range(self.retry_policy.max_retries + 1):
+            if attempt:
+                delay = self.retry_policy.delay(attempt)
+                self.logger.warning("%.1f秒后第%s次重试下载文件[%s]", delay, attempt, filename)
+                self.metrics.retry("download")
+                time.sleep(delay)
+            generation = self.session_guard.wait() if self.session_guard is not None else 0
+            self.rate_limiter.acquire()
+            download, retry = self.__download_once(url, save_path, filename, generation)
+            if download is not None and self.sync is not None and self.sync.store(download.path, download.sha256):
+                self.logger.info("文件[%s]与已有文件内容相同，已改为硬链接", filename)
+            if not retry:
+                return download
+        self.logger.error("文件[%s]下载%s次均失败: %s", filename, self.retry_policy.max_retries + 1, url)
+
+    def __download_once(self, url, save_path, filename, generation=0):
+        """执行一次下载，返回(Download或None, 是否值得重试)"""
+        filepath = os.path.join(save_path, filename)
+        part_path = filepath + PART_SUFFIX
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+
+        headers = self.request_headers()
+        if offset:
+            headers["Range"] = "bytes=%s-" % offset
+            self.logger.info("续传文件[%s]，已下载%s字节: %s", filename, offset, url)
+        else:
+            self.logger.debug("开始下载文件[%s]: %s", filename, url, extra={"event": "download_start"})
+
+        start = time.monotonic()
+        try:
+            response = self.session.get(url, headers=headers, stream=True, timeout=self.timeout)
+        except requests.RequestException as e:
+            self.rate_limiter.record(ok=False)
+            self.metrics.error("download", type(e).__name__)
+            self.logger.error("文件下载过程中出现异常，url: %s: %s", url, e)
+            return None, True
+
+        try:
+            # 下载的延迟统计到收到响应头为止，传输的字节数在写入完成后累加
+            latency = time.monotonic() - start
+            retryable = self.retry_policy.retryable(response.status_code)
+            self.rate_limiter.record(latency, ok=not retryable)
+            self.metrics.request("download", response.status_code, latency)
+            if response.status_code not in (200, 206):
+                self.metrics.error("download", "http_%s" % response.status_code)
+            if response.status_code == 416 and offset:
+                # 临时文件与服务器上的文件不一致，丢弃后重新下载
+                self.logger.warning("续传位置无效，重新下载[%s]", filename)
+                os.remove(part_path)
+                return None, True
+            hasher = hashlib.sha256()
+            if response.status_code == 206:
+                match = RE_CONTENT_RANGE.match(response.headers.get("Content-Range") or "")
+                if match is None or int(match.group(1)) != offset:
+                    # 返回的范围与临时文件接不上，追加会损坏文件，丢弃后重新下载
+                    self.logger.warning("续传返回的范围[%s]与已下载的%s字节不一致，重新下载[%s]",
+                                        response.headers.get("Content-Range"), offset, filename)
+                    if os.path.isfile(part_path):
+                        os.remove(part_path)
+                    return None, True
+                mode = "ab"
+                with open(part_path, "rb") as f:
+                    for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                        hasher.update(chunk)
+            elif response.status_code == 200:
+                # 服务器不支持Range时返回完整内容，从头写入
+                mode, offset = "wb", 0
+            elif response.status_code == 404 and self.session_guard is not None:
+                # 下载地址的404也可能是cookie失效导致的，确认会话后决定是否重试
+                self.logger.error("文件下载失败，状态码: 404，检查cookie是否有效")
+                return None, self.confirm_expired(generation)
+            else:
+                self.logger.error("文件下载失败，状态码: %s", response.status_code)
+                return None, retryable
+
+            try:
+                with ChunkWriter(part_path, mode, hasher=hasher) as writer:
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        if chunk:
+                            writer.write(chunk)
+            except requests.RequestException as e:
+                self.rate_limiter.record(ok=False)
+                self.metrics.error("download", type(e).__name__)
+                self.metrics.add_bytes("download", writer.written)
+                self.progress.add_bytes(writer.written)
+                self.logger.error("文件下载中断，保留临时文件以便续传[%s]: %s", filename, e)
+                return None, True
+            self.metrics.add_bytes("download", writer.written)
+            self.progress.add_bytes(writer.written)
+
+            expected = response.headers.get("Content-Length")
+            if expected is not None and expected.isdigit() and writer.written != int(expected):
+                self.logger.error("文件[%s]长度不完整(%s/%s)，保留临时文件以便续传",
+                                  filename, writer.written, expected)
+                return None, True
+            if not offset + writer.written:
+                self.logger.error("返回内容为空")
+                os.remove(part_path)
+                return None, False
+        finally:
+            response.close()
+
+        os.replace(part_path, filepath)
+        self.logger.debug("文件[%s]下载完成", filename, extra={
+            "event": "download", "size": offset + writer.written, "latency": round(latency, 4)})
+        return Download(filepath, offset + writer.written, hasher.hexdigest()), False
+
+    def api_inv_manage(self, id, month, page_num=1, tradeid_list="", title_id="", invoice_mail="", user_type=""):
+        data = {
+            "id": id,
+            "tradeIdList": tradeid_list,
+            "titleId": title_id,
+            "invoiceMail": invoice_mail,
+            "userType": user_type,
+            "month": month,
+            "pageNo": page_num,
+        }
+        headers = self.request_headers(
+            Referer=self.site_url + "pss/app/login/invoice/consumeTrans/manage/%s/COMPANY" % id
+        )
+        return self.api_handler(
+            headers=headers,
+            data=data,
+            **self.apis["inv_manage"],
+        )
+
+    def api_inv_apply(self, id, month, tradeid_list, title_id="", invoice_mail="", user_type=""):
+        data = {
+            "id": id,
+            "tradeIdList": ",".join(tradeid_list),
+            "titleId": title_id,
+            "invoiceMail": invoice_mail,
+            "userType": user_type,
+            "month": month
+        }
+        headers = self.request_headers(
+            Referer=self.site_url + "pss/app/login/invoice/consumeTrans/manage/%s/COMPANY" % id
+        )
+        return self.api_handler(
+            headers=headers,
+            data=data,
+            **self.apis["inv_apply"],
+        )
+
+    def api_inv_subapply(self, apply_id, id, user_type="COMPANY"):
+        data = {
+            "applyId": apply_id,
+            "id": id,
+            "userType": user_type,
+        }
+        headers = self.request_headers(
+            Referer=self.site_url + "pss/app/login/invoice/consumeTrans/manage/%s/COMPANY" % id
+        )
+        return self.api_handler(
+            headers=headers,
+            data=data,
+            **self.apis["inv_subapply"],
+        )
+
+    def api_card_list(self, page_num=1, user_type="COMPANY", type="invoiceApply", change_view="card", query_str="",
+                      verify_session=True):
+        data = {
+            "userType": user_type,
+            "type": type,
+            "changeView": change_view,
+            "queryStr": query_str,
+            "pageNo": page_num,
+        }
+        headers = self.request_headers(
+            Referer=self.site_url + "pss/app/login/cardList/manage/invoiceApply/PERSONAL"
+        )
+        return self.api_handler(
+            headers=headers,
+            data=data,
+            verify_session=verify_session,
+            **self.apis["card_list"],
+        )
+
+    def check_session(self):
+        """请求卡片列表第一页(不使用缓存)检查cookie是否有效
+
+        cookie有效时返回True，网络原因无法确认时返回False；
+        失效时有session_guard则暂停等待cookie更新后再次检查，否则抛出SessionExpiredException。
+        """
+        while True:
+            generation = self.session_guard.wait() if self.session_guard is not None else 0
+            # 卡片列表的404即可确认cookie失效，不再递归确认
+            html = self.api_card_list(verify_session=False)
+            if html is None:
+                self.logger.warning("无法确认cookie是否有效，继续执行")
+                return False
+            page = self.parse_page(html, "session")
+            if page.searchable():
+                self.logger.debug("cookie有效", extra={"event": "session_ok"})
+                if self.cache is not None:
+                    self.__bind_cache(page)
+                return True
+            self.logger.error("卡片列表页面内容异常，cookie可能已经失效")
+            if self.session_guard is None:
+                raise SessionExpiredException("cookie失效或过期，请更新cookie后重新运行")
+            self.session_guard.expired(self, generation)
+
+    def __bind_cache(self, page):
+        """以卡片列表第一页的卡片id作为账号标识，cookie换成其他账号时清空响应缓存"""
+        account = hashlib.sha1(",".join(sorted(card.id for card in page.cards())).encode("utf-8")).hexdigest()
+        if self.cache.bind(account):
+            self.logger.warning("cookie所属的账号与响应缓存不一致(或卡片有变化)，已清空响应缓存")
+
+    def confirm_expired(self, generation):
+        """请求返回404时请求卡片列表确认cookie是否失效，失效时check_session会暂停等待cookie更新
+
+        cookie在此期间被更新过(由本线程或其他线程)时返回True，应重新请求；否则是真正的404。
+        """
+        self.check_session()
+        return self.session_guard.generation != generation
+
+    def save_state(self):
+        """保存可以续传的状态，cookie失效暂停时调用
+
+        任务账本每次更新都已提交，这里只需写入车牌索引并记录账本的统计。
+        """
+        self.plate_index.save()
+        if self.ledger is not None:
+            self.logger.info("任务账本统计: 发票%s，交易%s", self.ledger.summary(), self.ledger.trade_summary())
+
+    def api_query_card(self, page_num, user_type="COMPANY", query_str="", change_view="card"):
+        data = {
+            "userType": user_type,
+            "queryStr": query_str,
+            "changeView": change_view,
+            "pageNo": page_num,
+        }
+        headers = self.request_headers(
+            Referer=self.site_url + "pss/app/login/invoice/query/card/PERSONAL"
+        )
+        return self.cached_api("query_card", headers, data, CACHE_TTL_CARDS)
+
+    def api_query_apply(self, card_id, month, page_size=6, user_type="COMPANY", title_name="", station_name="",
+                        page_num=1):
+        data = {
+            "pageNo": page_num,
+            "pageSize": page_size,
+            "cardId": card_id,
+            "userType": user_type,
+            "month": month,
+            "titleName": title_name,
+            "stationName": station_name,
+        }
+        headers = self.request_headers(
+            Referer=self.site_url + "pss/app/login/invoice/query/queryApply/%s/COMPANY" % card_id
+        )
+        ttl = CACHE_TTL_OPEN if self.month_open(month) else CACHE_TTL_CLOSED
+        return self.cached_api("query_apply", headers, data, ttl)
+
+    def cached_api(self, name, headers, data, ttl):
+        """带磁盘缓存的api请求，未启用缓存时直接请求
+
+        refresh_cache时跳过读取缓存，但会用新的响应刷新缓存。只缓存带有分页标签的完整页面。
+        """
+        if self.cache is None:
+            return self.api_handler(headers=headers, data=data, **self.apis[name])
+
+        key = dict(data, site=self.site_url)
+        if not self.refresh_cache:
+            html = self.cache.get(name, key)
+            if html is not None:
+                self.logger.debug("命中缓存: %s %s", name, data, extra={"event": "cache_hit", "endpoint": name})
+                self.metrics.cache_hit(name)
+                return html
+
+        html = self.api_handler(headers=headers, data=data, **self.apis[name])
+        if html is not None and "taiji_search_hasMore" in html:
+            self.cache.set(name, key, html, ttl)
+        return html
+
+    def paginate(self, fetch):
+        """对fetch(page_num)返回的分页内容进行迭代，得到(page_num, Page)"""
+        return Paginator(
+            fetch,
+            parse=self.parse_page,
+            workers=max(self.workers, 2),
+            max_page=self.MAX_PAGE_NUM,
+            logger=self.logger,
+        )
+
+    def parse_page(self, html, stage="page"):
+        """解析响应页面，耗时计入运行指标"""
+        with self.metrics.timed(stage):
+            return Page(html)
+
+    def submit_apply(self, id, month, invoice_mail="", car_num=""):
+        self.logger.info("开始对[%s %s]进行开票操作", car_num, month)
+
+        # 开票获取tradeid阶段
+        # 先完成全部分页的获取再提交，避免提交后列表前移导致后续分页漏项
+        self.progress.start_listing()
+        try:
+            tradeids = [t.id for t in self.iter_trade_ids(Card(id, car_num), month, invoice_mail)]
+        finally:
+            self.progress.finish_listing()
+
+        submitted = self.__trade_ledger.submitted_trades(id, month)
+        pending = [t for t in dict.fromkeys(tradeids) if t not in submitted]
+        if len(pending) < len(tradeids):
+            self.logger.warning("[%s %s]有%s条tradeid已提交或提交结果未知，跳过；"
+                                "提交结果未知的交易可用--list-unknown-trades查看，在站点确认未开票后用--release-trades释放",
+                                car_num, month, len(tradeids) - len(pending))
+        self.progress.add_total(len(pending))
+
+        # 多个分页的tradeid合并后分批提交
+        for start in range(0, len(pending), self.apply_batch_size):
+            self.__submit_batch(id, month, pending[start:start + self.apply_batch_size], invoice_mail, car_num)
+
+    def __submit_batch(self, card_id, month, tradeids, invoice_mail, car_num):
+        ok = False
+        try:
+            ok = self.__submit_trades(card_id, month, tradeids, invoice_mail, car_num)
+        finally:
+            self.progress.advance(ok, len(tradeids))
+
+    def __submit_trades(self, card_id, month, tradeids, invoice_mail, car_num):
+        """提交一批tradeid，站点受理时返回True"""
+        # 开票获取applyid阶段
+        apply_html = self.api_inv_apply(card_id, month, tradeids, invoice_mail=invoice_mail)
+        if apply_html is None:
+            self.logger.error("获取apply页面失败，跳过[%s]条tradeid", len(tradeids))
+            return False
+        page = self.parse_page(apply_html)
+        with self.metrics.timed("apply_info"):
+            apply_id, id, user_type = page.apply_info()
+        self.logger.info("获得applyId: [%s], id: [%s], user_type: [%s]", apply_id, id, user_type)
+        if not apply_id:
+            self.logger.error("获取apply id信息失败，跳过[%s]条tradeid，response: %s", len(tradeids), apply_html)
+            return False
+
+        # 开票最终阶段，提交前先登记，保证重试时不会重复提交
+        self.__trade_ledger.mark_trades(card_id, month, tradeids, apply_id, "submitting")
+        submit_html = self.api_inv_subapply(apply_id, id, user_type)
+        if submit_html is None:
+            self.logger.error("%s %s 提交[%s]条tradeid时出现异常，提交结果未知，applyId: %s，"
+                              "在站点确认未开票后可用--release-trades释放",
+                              car_num, month, len(tradeids), apply_id)
+            return False
+        status = "submitted" if self.__submit_succeeded(submit_html) else "failed"
+        self.__trade_ledger.mark_trades(card_id, month, tradeids, apply_id, status)
+        self.logger.info("%s %s 开票结果(%s条): %s", car_num, month, len(tradeids), submit_html.strip())
+        return status == "submitted"
+
+    @staticmethod
+    def __submit_succeeded(html):
+        """站点返回JSON时以success字段判断结果，其他内容视为已受理"""
+        try:
+            result = json.loads(html)
+        except ValueError:
+            return True
+        return not isinstance(result, dict) or result.get("success", True) is not False
+
+    def submit_apply_all(self, month, invoice_mail="", *args, **kwargs):
+        """对所有卡片执行开票，month可以是单个月份、月份区间或月份列表，卡片列表只获取一次"""
+        self.__submit_cards(self.iter_cards(PlateIndex.APPLY, *args, **kwargs), month, invoice_mail)
+
+    def submit_apply_plates(self, plates, month, invoice_mail=""):
+        """对指定车牌号(支持通配符)的卡片执行开票，卡片id从车牌号索引中查找"""
+        cards = self.lookup_plates(PlateIndex.APPLY, plates)
+        self.__submit_cards(cards, month, invoice_mail)
+
+    def __submit_cards(self, cards, month, invoice_mail):
+        months = as_months(month)
+        if self.workers <= 1:
+            for card in cards:
+                for month in months:
+                    self.submit_apply(card.id, month, invoice_mail=invoice_mail, car_num=card.car_num)
+            return
+
+        # 各(卡片, 月份)的获取tradeid、apply、submitApply三个阶段在线程池中交错执行
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="card") as card_pool:
+            futures = [
+                card_pool.submit(self.submit_apply, card.id, month, invoice_mail, card.car_num)
+                for card in cards
+                for month in months
+            ]
+            for future in futures:
+                future.result()
+
+    def iter_cards(self, kind=PlateIndex.QUERY, *args, **kwargs):
+        """逐页产出卡片(Card)，同时更新车牌号索引
+
+        kind为PlateIndex.QUERY时取发票查询页面的卡片，PlateIndex.APPLY时取开票页面的卡片，
+        两者的卡片id不同，分别用于iter_invoices和iter_trade_ids。
+        """
+        if kind == PlateIndex.QUERY:
+            fetch, parse = self.api_query_card, Page.query_cards
+        elif kind == PlateIndex.APPLY:
+            fetch, parse = self.api_card_list, Page.cards
+        else:
+            raise TypeException("未知的卡片类型: %s" % kind)
+        for page_num, page in self.paginate(lambda page_num: fetch(page_num, *args, **kwargs)):
+            with self.metrics.timed("cards"):
+                cards = parse(page)
+            self.plate_index.update(kind, cards)
+            for card in cards:
+                self.logger.debug("获得车牌号[%s]的id: %s", card.car_num, card.id,
+                                  extra={"event": "card", "plate": card.car_num, "card": card.id})
+                yield card
+
+    def iter_invoices(self, card, month, page_size=6):
+        """逐页产出卡片在指定月份的发票(Invoice)，card为Card或发票查询页面的卡片id"""
+        for page_num, page in self.__invoice_pages(as_card(card), month, page_size):
+            for invoice in self.__page_invoices(page):
+                yield invoice
+
+    def iter_trade_ids(self, card, month, invoice_mail=""):
+        """逐页产出卡片在指定月份待开票的交易(TradeId)，card为Card或开票页面的卡片id"""
+        card = as_card(card)
+        pages = self.paginate(
+            lambda page_num: self.api_inv_manage(card.id, month, page_num, invoice_mail=invoice_mail))
+        for page_num, page in pages:
+            with self.metrics.timed("trade_ids"):
+                tradeids = page.trade_ids()
+            self.logger.info("获得[%s]条tradeid信息", len(tradeids))
+            for tradeid in tradeids:
+                yield tradeid
+
+    def __page_invoices(self, page):
+        with self.metrics.timed("invoices"):
+            return page.invoices(self.site_url)
+
+    def __invoice_pages(self, card, month, page_size):
+        return self.paginate(
+            lambda page_num: self.api_query_apply(card.id, month, page_size, page_num=page_num))
+
+    def lookup_plates(self, kind, plates):
+        """在车牌号索引中查找卡片，有车牌号未命中时才遍历卡片列表刷新索引
+
+        刷新时不读取缓存的卡片列表，否则新增的车辆要等缓存过期后才能找到。
+        """
+        cards, missing = self.plate_index.lookup(kind, plates)
+        if missing:
+            self.logger.info("车牌号索引中没有找到%s，刷新索引", missing)
+            refresh_cache, self.refresh_cache = self.refresh_cache, True
+            try:
+                for card in self.iter_cards(kind):
+                    pass
+            finally:
+                self.refresh_cache = refresh_cache
+            self.plate_index.save()
+            cards, missing = self.plate_index.lookup(kind, plates)
+            if missing:
+                self.logger.warning("没有找到车牌号: %s", missing)
+        return cards
+
+    def month_open(self, month):
+        """当月以及open_months中的月份还会开出新的发票，发票列表只能短时间缓存，续传时也不能按卡片跳过"""
+        return month >= datetime.date.today().strftime("%Y%m") or month in self.open_months
+
+    def skip_card(self, card_id, month):
+        """续传模式下卡片该月份的发票已全部下载，可以不再获取发票列表
+
+        当月以及open_months中的月份还会开出新的发票，总是重新获取列表，由逐个文件的检查跳过已下载的发票。
+        """
+        if not self.resume or self.ledger is None:
+            return False
+        if self.month_open(month):
+            return False
+        return self.ledger.card_done(card_id, month)
+
+    def plan_download(self, cards, month, page_size=6):
+        """估算下载工作量，返回每个(卡片, 月份)的Estimate，请求失败的为None
+
+        只请求发票列表的第一页，按页面上的总页数估算发票数量；续传模式下已完成的卡片不发出请求。
+        """
+        def first_page(card, month):
+            if self.skip_card(card.id, month):
+                return Estimate(card, month, 0, 0, True, True)
+            html = self.api_query_apply(card.id, month, page_size, page_num=1)
+            if html is None:
+                return None
+            page = self.parse_page(html, "invoices")
+            return self.__estimate(card, month, page, len(page.invoices(self.site_url)))
+
+        return self.__plan(cards, month, first_page)
+
+    def plan_invoice(self, cards, month, invoice_mail=""):
+        """估算开票工作量，返回每个(卡片, 月份)的Estimate(请求失败的为None)，items为待开票的tradeid数量
+
+        只请求交易列表的第一页，任务账本中已提交或提交结果未知的tradeid不计入。
+        """
+        def first_page(card, month):
+            html = self.api_inv_manage(card.id, month, 1, invoice_mail=invoice_mail)
+            if html is None:
+                return None
+            page = self.parse_page(html, "trade_ids")
+            tradeids = page.trade_ids()
+            submitted = self.__trade_ledger.submitted_trades(card.id, month)
+            estimate = self.__estimate(card, month, page, len(tradeids))
+            estimate.items -= sum(1 for t in tradeids if t.id in submitted)
+            return estimate
+
+        return self.__plan(cards, month, first_page)
+
+    @staticmethod
+    def __estimate(card, month, page, count):
+        if not page.has_more():
+            return Estimate(card, month, 1, count, True, False)
+        total_pages = page.total_pages()
+        if total_pages:
+            return Estimate(card, month, total_pages, total_pages * count, False, False)
+        # 页面没有总页数时至少还有一页
+        return Estimate(card, month, 2, count + 1, False, False)
+
+    def __plan(self, cards, month, first_page):
+        months = as_months(month)
+        tasks = [(card, month) for card in cards for month in months]
+        if self.workers <= 1:
+            estimates = [first_page(card, month) for card, month in tasks]
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="plan") as pool:
+                estimates = list(pool.map(lambda task: first_page(*task), tasks))
+        return estimates
+
+    def inv_download(self, cardid, month, car_num, save_path, page_size=6):
+        """下载卡片在指定月份的全部发票，全部成功时返回True"""
+        if self.workers > 1:
+            return self.__download_cards([Card(cardid, car_num)], month, save_path, page_size)
+
+        if self.skip_card(cardid, month):
+            self.logger.info("[%s %s]的发票已全部下载，跳过", car_num, month)
+            return True
+
+        page_num = 0
+        results = []
+        pages = self.__invoice_pages(Card(cardid, car_num), month, page_size)
+        self.progress.start_listing()
+        try:
+            for page_num, page in pages:
+                for invoice in self.__page_invoices(page):
+                    self.logger.debug("获得发票目标数据: %s", invoice,
+                                      extra={"event": "invoice", "plate": car_num, "month": month})
+                    self.progress.add_total()
+                    filename = self.__create_filename(invoice, car_num)
+                    if self.archive is not None:
+                        ok = self.__archive_invoice(Card(cardid, car_num), month, invoice, filename)
+                    else:
+                        ok = self.__download_invoice(cardid, month, car_num, invoice.dwurl, save_path, filename)
+                    self.progress.advance(ok)
+                    results.append(ok)
+        finally:
+            self.progress.finish_listing()
+        self.logger.info("所有分页内容项目下载完毕，共%s页", page_num)
+        if self.archive is not None:
+            self.archive.finish(month, car_num)
+
+        done = pages.complete and all(results)
+        if self.ledger is not None:
+            self.ledger.mark_card(cardid, month, car_num, "done" if done else "partial")
+        return done
+
+    def __download_invoice(self, cardid, month, car_num, url, save_path, filename):
+        """下载单个发票文件并记录到任务账本，续传模式下跳过已完成的文件"""
+        if self.ledger is None:
+            return self.download_handler(url, save_path, filename) is not None
+
+        filepath = os.path.join(save_path, filename)
+        self.ledger.add_invoice(cardid, month, url, car_num, filepath)
+        if self.resume and self.ledger.invoice_done(cardid, month, url, filepath):
+            self.logger.info("文件[%s]已下载，跳过", filename)
+            return True
+
+        download = self.download_file(url, save_path, filename)
+        if download is None:
+            return False
+        self.ledger.finish_invoice(cardid, month, url, download.path, download.size, download.sha256)
+        return True
+
+    def __archive_invoice(self, card, month, invoice, filename):
+        """归档模式下载单个发票：已在归档中的跳过，否则下载到暂存目录后写入归档"""
+        if self.archive.has(month, card.car_num, filename):
+            self.logger.info("文件[%s]已在归档中，跳过", filename)
+            return True
+        if self.ledger is not None:
+            self.ledger.add_invoice(
+                card.id, month, invoice.dwurl, card.car_num, os.path.join(self.archive.staging_dir, filename))
+        download = self.download_file(invoice.dwurl, self.archive.staging_dir, filename)
+        if download is None:
+            return False
+        member = self.__store_archive(card, month, invoice, download)
+        if self.ledger is not None:
+            self.ledger.finish_invoice(card.id, month, invoice.dwurl, member, download.size, download.sha256)
+        return True
+
+    def __store_archive(self, card, month, invoice, download):
+        """写入归档，返回归档条目路径"""
+        record = {
+            "datetime": invoice.datetime,
+            "amount": invoice.amount,
+            "count": invoice.count,
+            "type": invoice.type,
+            "url": invoice.dwurl,
+        }
+        return self.archive.add(month, card.car_num, download, record)
+
+    def inv_download_all(self, month, save_path, *args, **kwargs):
+        """下载所有卡片的发票，month可以是单个月份、月份区间或月份列表
+
+        卡片列表只获取一次，并发模式下卡片发现、发票列表、文件下载和后处理以流水线方式同时进行。
+        """
+        return self.__download_cards(self.iter_cards(PlateIndex.QUERY, *args, **kwargs), month, save_path)
+
+    def inv_download_plates(self, plates, month, save_path):
+        """下载指定车牌号(支持通配符)的发票，卡片id从车牌号索引中查找"""
+        cards = self.lookup_plates(PlateIndex.QUERY, plates)
+        return self.__download_cards(cards, month, save_path)
+
+    def __download_cards(self, cards, month, save_path, page_size=6):
+        """下载一组卡片的发票，全部成功时返回True"""
+        months = as_months(month)
+        if self.workers <= 1:
+            results = [self.inv_download(card.id, month, card.car_num, save_path, page_size)
+                       for card in cards for month in months]
+            return all(results)
+
+        results = []
+        pipeline = Pipeline(self.queue_size, self.logger)
+        pipeline.add_stage("list", lambda job: self.__list_invoices(job, save_path, page_size), self.list_workers)
+        pipeline.add_stage("file", self.__fetch_invoice, self.file_workers)
+        pipeline.add_stage("post", lambda task: self.__finish_invoice(task, results))
+        # cards可以是边翻页边产出的生成器，卡片在被发现的同时进入流水线
+        pipeline.run(DownloadJob(card, month) for card in cards for month in months)
+        self.logger.info("下载流水线统计: %s", pipeline.counts)
+        return all(results)
+
+    def __list_invoices(self, job, save_path, page_size):
+        """流水线发票列表阶段：逐页产出(job, invoice, filepath)，最后产出(job, None, None)表示列表结束"""
+        card = job.card
+        if self.skip_card(card.id, job.month):
+            self.logger.info("[%s %s]的发票已全部下载，跳过", card.car_num, job.month)
+            yield job, None, None
+            return
+
+        if self.archive is not None:
+            save_path = self.archive.staging_dir
+        pages = self.__invoice_pages(card, job.month, page_size)
+        self.progress.start_listing()
+        try:
+            for page_num, page in pages:
+                for invoice in self.__page_invoices(page):
+                    self.logger.debug("获得发票目标数据: %s", invoice,
+                                      extra={"event": "invoice", "plate": card.car_num, "month": job.month})
+                    filepath = os.path.join(save_path, self.__create_filename(invoice, card.car_num))
+                    if self.ledger is not None:
+                        self.ledger.add_invoice(card.id, job.month, invoice.dwurl, card.car_num, filepath)
+                    with job.lock:
+                        job.total += 1
+                    self.progress.add_total()
+                    yield job, invoice, filepath
+        finally:
+            self.progress.finish_listing()
+        job.complete = pages.complete
+        yield job, None, None
+
+    def __fetch_invoice(self, task):
+        """流水线文件下载阶段：产出(job, invoice, 下载结果)，续传模式下已完成的文件结果为True"""
+        job, invoice, filepath = task
+        if invoice is None:
+            yield task
+            return
+        if self.archive is not None:
+            if self.archive.has(job.month, job.card.car_num, os.path.basename(filepath)):
+                self.logger.info("文件[%s]已在归档中，跳过", os.path.basename(filepath))
+                yield job, invoice, True
+                return
+        elif self.resume and self.ledger is not None and \
+                self.ledger.invoice_done(job.card.id, job.month, invoice.dwurl, filepath):
+            self.logger.info("文件[%s]已下载，跳过", os.path.basename(filepath))
+            yield job, invoice, True
+            return
+        yield job, invoice, self.download_file(invoice.dwurl, *os.path.split(filepath))
+
+    def __finish_invoice(self, task, results):
+        """流水线后处理阶段：记录下载结果，(卡片, 月份)的全部文件都有结果后更新卡片状态"""
+        job, invoice, download = task
+        if invoice is None:
+            finished = job.close_listing()
+        else:
+            if isinstance(download, Download):
+                # 归档模式下暂存文件写入归档后即被删除，账本中记录归档条目
+                path = download.path
+                if self.archive is not None:
+                    path = self.__store_archive(job.card, job.month, invoice, download)
+                if self.ledger is not None:
+                    self.ledger.finish_invoice(
+                        job.card.id, job.month, invoice.dwurl, path, download.size, download.sha256)
+            finished = job.finish(download is not None)
+            self.progress.advance(download is not None)
+        if finished:
+            results.append(job.done)
+            if self.ledger is not None:
+                self.ledger.mark_card(job.card.id, job.month, job.card.car_num, "done" if job.done else "partial")
+            if self.archive is not None:
+                self.archive.finish(job.month, job.card.car_num)
+            self.logger.info("[%s %s]的发票处理完毕，共%s个文件，失败%s个",
+                             job.card.car_num, job.month, job.total, job.failed)
+
+    def set_max_page_num(self, max_page_num):
+        """限制最大翻页数，None表示不限制"""
+        self.MAX_PAGE_NUM = max_page_num
+
+    def __create_filename(self, invoice, car_num, extention="zip"):
+        datetime_ = datetime.datetime.strptime(
+            invoice.datetime, "%Y-%m-%d %H:%M:%S")
+        template = "%(car_num)s_%(datetime)s_金额%(amount)s_数量%(count)s_%(type)s.%(ext)s"
+        filename = template % {
+            "car_num": car_num,
+            "datetime": datetime_.strftime("%Y%m%d_%H%M"),
+            "amount": invoice.amount,
+            "count": invoice.count,
+            "type": invoice.type,
+            "ext": extention,
+        }
+        return filename
+
+
+def execute(event_handler, options, months, savedir, email):
+    """执行下载或开票任务"""
+    try:
+        # 开始前确认cookie有效，避免任务进行到一半才发现失效
+        event_handler.check_session()
+        if options.plan:
+            print(plan(event_handler, options, months, email))
+        elif options.download:
+            execute_download(event_handler, options, months, savedir)
+        elif options.invoice:
+            execute_invoice(event_handler, options, months, email)
+    finally:
+        event_handler.plate_index.save()
+
+
+def execute_download(event_handler, options, months, savedir):
+    """下载"""
+    if options.cardid:
+        for month in months:
+            event_handler.inv_download(options.cardid, month, options.cardid, savedir)
+    elif options.plates:
+        event_handler.inv_download_plates(options.plates, months, savedir)
+    elif options.all:
+        event_handler.inv_download_all(months, savedir)
+    if options.index:
+        index_invoices(options, savedir, event_handler.logger)
+
+
+def execute_invoice(event_handler, options, months, email):
+    """开票"""
+    if options.cardid:
+        for month in months:
+            event_handler.submit_apply(options.cardid, month, email)
+    elif options.plates:
+        event_handler.submit_apply_plates(options.plates, months, email)
+    elif options.all:
+        event_handler.submit_apply_all(months, email)
+
+
+def plan(event_handler, options, months, email=""):
+    """--plan: 只请求卡片列表和各(卡片, 月份)列表的第一页，估算工作量和耗时，返回报告文本"""
+    kind = PlateIndex.QUERY if options.download else PlateIndex.APPLY
+    endpoint = "query_card" if options.download else "card_list"
+
+    def card_list_requests():
+        stats = event_handler.metrics.snapshot()["endpoints"].get(endpoint, {})
+        return sum(stats.get("requests", {}).values()) + stats.get("cache_hits", 0)
+
+    # 开始前检查cookie时也请求过一次卡片列表，不计入计划
+    card_pages = -card_list_requests()
+    if options.cardid:
+        cards = [Card(options.cardid, options.cardid)]
+    elif options.plates:
+        cards = event_handler.lookup_plates(kind, options.plates)
+    else:
+        cards = list(event_handler.iter_cards(kind))
+    if options.download:
+        estimates = event_handler.plan_download(cards, months)
+    else:
+        estimates = event_handler.plan_invoice(cards, months, email)
+
+    card_pages += card_list_requests()
+    item_name = "发票数" if options.download else "待开票交易数"
+    lines = [
+        "计划(%s): %s张卡片 × %s个月份，卡片列表%s页" % (
+            "下载" if options.download else "开票", len(cards), len(months), card_pages),
+        "\t".join(["月份", "卡片数", "已完成", "列表页数", item_name]),
+    ]
+    pages = items = done = 0
+    exact = True
+    for month in months:
+        rows = [e for e in estimates if e is not None and e.month == month]
+        row_pages = sum(e.pages for e in rows)
+        row_items = sum(e.items for e in rows)
+        row_done = sum(1 for e in rows if e.done)
+        lines.append("\t".join(str(v) for v in (month, len(rows), row_done, row_pages, row_items)))
+        pages += row_pages
+        items += row_items
+        done += row_done
+        exact = exact and all(e.exact for e in rows)
+    lines.append("\t".join(str(v) for v in ("合计", len(cards) * len(months), done, pages, items)))
+    failed = sum(1 for e in estimates if e is None)
+    if failed:
+        lines.append("有%s个(卡片, 月份)的列表请求失败，未计入合计" % failed)
+    if not exact:
+        lines.append("部分列表有多页，页数和%s按第一页和总页数估算(页面没有总页数时为下限)" % item_name)
+
+    # 按计划阶段各请求的平均延迟和配置的并发数、速率上限估算耗时
+    endpoints = event_handler.metrics.snapshot()["endpoints"]
+    latencies = [stats["latency"] for stats in endpoints.values() if stats["latency"]["count"]]
+    count = sum(latency["count"] for latency in latencies)
+    latency = sum(latency["mean"] * latency["count"] for latency in latencies) / count if count else None
+    rate = event_handler.rate_limiter.max_rate if event_handler.rate_limiter.enabled else 0
+    if options.download:
+        requests_count = card_pages + pages + items
+        concurrency = "列表%s线程/下载%s线程" % (event_handler.list_workers, event_handler.file_workers)
+        if latency is not None:
+            seconds = max(pages * latency / event_handler.list_workers, items * latency / event_handler.file_workers)
+        size = event_handler.ledger.average_size() if event_handler.ledger is not None else None
+        if size:
+            lines.append("预计数据量约%s(按任务账本中已下载文件的平均大小)" % format_bytes(items * size))
+    else:
+        batches = sum(-(-e.items // event_handler.apply_batch_size) for e in estimates if e is not None)
+        requests_count = card_pages + pages + 2 * batches
+        concurrency = "%s线程" % event_handler.workers
+        if latency is not None:
+            seconds = (pages + 2 * batches) * latency / event_handler.workers
+    lines.append("预计请求%s次，并发%s，速率上限%s" % (
+        requests_count, concurrency, "每秒%s次" % rate if rate else "不限"))
+    if latency is None:
+        lines.append("计划阶段的请求都命中了缓存，无法估算耗时")
+    else:
+        if rate:
+            seconds = max(seconds, requests_count / rate)
+        lines.append("列表请求平均延迟%.0fms，预计耗时约%s" % (latency * 1000, format_seconds(seconds)))
+    return "\n".join(lines)
+